@@ -0,0 +1,111 @@
+"""Proceso de audio: decodifica con ffmpeg, aplica ganancia y codifica a Opus.
+
+Los workers se lanzan con el contexto 'spawn', que en el hijo importa el
+módulo del `target` y, además, vuelve a ejecutar el script principal del
+padre como `__mp_main__`. Por eso este código vive fuera de main.py y los
+procesos se arrancan con `start_detached`, que omite el script principal: el
+hijo sólo importa discord.opus, el reproductor de ffmpeg y numpy, sin crear
+el bot ni abrir la base de datos. Toda la configuración llega por argumentos
+o por los mensajes del pipe.
+"""
+import sys
+import threading
+from typing import Dict
+
+from discord import opus
+from discord.player import FFmpegPCMAudio
+
+try:
+    import numpy as np
+except ImportError:  # Sin numpy la ganancia no se aplica en el worker
+    np = None
+
+
+def start_detached(process):
+    """Arranca un proceso 'spawn' sin que el hijo reejecute el script principal"""
+    main_module = sys.modules['__main__']
+    # spawn anota `__main__.__spec__` (python -m) o `__file__` al preparar el hijo; sin ellos no lo reimporta
+    main_spec = getattr(main_module, '__spec__', None)
+    main_path = main_module.__dict__.pop('__file__', None)
+    main_module.__spec__ = None
+    try:
+        process.start()
+    finally:
+        main_module.__spec__ = main_spec
+        if main_path is not None:
+            main_module.__file__ = main_path
+
+
+def _worker_stream(conn, lock: threading.Lock, stream_id: int, url: str, executable: str,
+                   before_options: str, options: str, bitrate: int, state: Dict):
+    """Hilo del worker: ffmpeg -> PCM -> ganancia -> Opus -> pipe al proceso principal"""
+    source = None
+    try:
+        source = FFmpegPCMAudio(url, executable=executable, before_options=before_options, options=options)
+        encoder = opus.Encoder()
+        encoder.set_bitrate(bitrate)
+        while not state['stop']:
+            # Control de flujo por créditos: no adelantarse más del buffer permitido
+            if not state['credits'].acquire(timeout=0.1):
+                continue
+            data = source.read()
+            if not data:
+                break
+            gain = state['gain']
+            if gain != 1.0 and np is not None:
+                samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+                samples *= gain
+                np.clip(samples, -32768, 32767, out=samples)
+                data = samples.astype(np.int16).tobytes()
+            packet = encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+            with lock:
+                conn.send(('frame', stream_id, packet))
+    except Exception as e:
+        print(f"[AudioWorker] Error en stream {stream_id}: {e}")
+    finally:
+        if source:
+            source.cleanup()
+        try:
+            with lock:
+                conn.send(('end', stream_id))
+        except (OSError, ValueError):
+            pass
+
+
+def audio_worker_main(conn, executable: str, buffer_frames: int):
+    """Bucle principal de un proceso de audio; recibe órdenes por IPC"""
+    lock = threading.Lock()
+    streams: Dict[int, Dict] = {}
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        command = message[0]
+        if command == 'ping':
+            with lock:
+                conn.send(('pong',))
+        elif command == 'start':
+            _, stream_id, url, before_options, options, gain, bitrate = message
+            state = {'stop': False, 'gain': gain, 'credits': threading.Semaphore(buffer_frames)}
+            streams[stream_id] = state
+            threading.Thread(
+                target=_worker_stream,
+                args=(conn, lock, stream_id, url, executable, before_options, options, bitrate, state),
+                daemon=True
+            ).start()
+        elif command == 'credit':
+            state = streams.get(message[1])
+            if state:
+                for _ in range(message[2]):
+                    state['credits'].release()
+        elif command == 'gain':
+            state = streams.get(message[1])
+            if state:
+                state['gain'] = message[2]
+        elif command == 'stop':
+            state = streams.pop(message[1], None)
+            if state:
+                state['stop'] = True
+    for state in streams.values():
+        state['stop'] = True
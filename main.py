@@ -4,17 +4,46 @@ from discord.ext import commands, tasks
 import os
 import asyncio
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 import sqlite3
 import yt_dlp
-from collections import deque
+from collections import deque, OrderedDict
 import time
 import traceback
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 from spotipy.exceptions import SpotifyException
-from typing import Dict, Deque, Optional, List
+from typing import Dict, Deque, Optional, List, Tuple
 import re
+import io
+import csv
+import tempfile
+import json
+import heapq
+import itertools
+import multiprocessing
+import queue as queue_module
+import threading
+import hashlib
+import secrets
+import sys
+import gc
+import tracemalloc
+import unicodedata
+import zlib
+import math
+
+from audio_worker import audio_worker_main, start_detached
+
+try:
+    import numpy as np
+except ImportError:  # Sin numpy se usa el pipeline de ffmpeg de siempre
+    np = None
+
+try:
+    import mutagen
+except ImportError:  # Sin mutagen los metadatos de la biblioteca salen del nombre del archivo
+    mutagen = None
 
 # --------------------------
 # Configuración Inicial
@@ -29,7 +58,34 @@ intents.message_content = True
 intents.members = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Grabación de tráfico del gateway (ver replay.py): TRACE_RECORD=<archivo.jsonl>
+TRACE_RECORD_PATH = os.getenv("TRACE_RECORD")
+
+# Política de caché de miembros:
+#   'full' -> cachea y chunkea a todos los miembros de cada servidor
+#   'lean' -> sólo miembros en voz; staff y autores recientes van a una caché con TTL
+#             y el resto se pide bajo demanda. No se chunkea al arrancar.
+# Por defecto 'full', el comportamiento de siempre. Con 'lean', guild.get_member()
+# y guild.members dejan de ver a casi todos: activarlo sólo si el código nuevo
+# usa la caché con TTL en lugar de esas llamadas.
+MEMBER_CACHE_POLICY = os.getenv("MEMBER_CACHE_POLICY", "full")
+MEMBER_CACHE_TTL = 600           # Segundos que se recuerda a un autor reciente
+MEMBER_CACHE_STAFF_TTL = 3600    # Segundos que se recuerda a un miembro del staff
+MEMBER_CACHE_MAX = 20000         # Miembros en la caché con TTL
+
+if MEMBER_CACHE_POLICY == "lean":
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+else:
+    member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+
+bot = commands.Bot(
+    command_prefix="!",
+    intents=intents,
+    member_cache_flags=member_cache_flags,
+    chunk_guilds_at_startup=MEMBER_CACHE_POLICY != "lean",
+    enable_debug_events=bool(TRACE_RECORD_PATH)
+)
 MUSIC_COMMANDS_CHANNEL_ID =958335891800207430
 OWNER_IDS = [617137933022920707]  
 
@@ -39,10 +95,22 @@ OWNER_IDS = [617137933022920707]
 
 # Configuración general
 DISCONNECT_AFTER = 60
+ALONE_GRACE = 15          # Segundos sin oyentes antes de desconectar
+REAPER_TICK = 5           # Intervalo del barrido de conexiones de voz inactivas
+PRESENCE_MIN_INTERVAL = 15  # Segundos mínimos entre actualizaciones de presencia
+PRESENCE_DEBOUNCE = 2       # Espera para agrupar cambios seguidos
 MUTE_ROLE_NAME = "Muted"
 MAX_ADVERTENCIAS = 7
 ALERTA_ADVERTENCIAS = 5
 
+# Escalado automático: advertencias activas -> (acción, duración en segundos)
+ESCALATION_ACTIONS = {
+    ALERTA_ADVERTENCIAS: ('mute', 3600),
+    MAX_ADVERTENCIAS: ('ban', None),
+}
+WARNING_DECAY_DAYS = 90          # Las advertencias más antiguas dejan de contar (None = nunca)
+INFRACTION_CACHE_SIZE = 10000    # Pares (servidor, usuario) en memoria
+
 # IDs de roles y canales
 STAFF_ROLES = [1380930376343752704, 1380930523668549703, 1380930573899665538, 1380930606191607949]
 LOG_CHANNEL_ID = 1381026786368032819
@@ -51,23 +119,153 @@ TICKET_CATEGORY_ID = 1380982177344520287
 # Configuración de audio
 FFMPEG_OPTIONS = {
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -probesize 32M -analyzeduration 32M',
-    'options': '-vn -c:a libopus -b:a 128k -ar 48000 -ac 2 -filter:a "volume=0.8"',
+    'options': '-vn -c:a libopus -b:a 128k -ar 48000 -ac 2 -filter:a "{loudness}"',
     'executable': 'ffmpeg',
 }
 
 AUDIO_QUALITIES = {
     'low': {'bitrate': '64k', 'options': '-vn -af "volume=0.9"'},
-    'medium': {'bitrate': '128k', 'options': '-vn -af "dynaudnorm=f=150:g=15"'},
-    'high': {'bitrate': '192k', 'options': '-vn -ar 48000 -ac 2 -af "dynaudnorm=f=150:g=15"'}
+    'medium': {'bitrate': '128k', 'options': '-vn -af "{loudness}"'},
+    'high': {'bitrate': '192k', 'options': '-vn -ar 48000 -ac 2 -af "{loudness}"'}
 }
 
+# Normalización de volumen precalculada (reemplaza a dynaudnorm en vivo)
+# "{loudness}" en las opciones de ffmpeg se sustituye por una ganancia fija por pista
+LOUDNESS_TARGET = -14.0          # LUFS integrados objetivo
+LOUDNESS_MAX_GAIN = 12.0         # dB máximos de ganancia/atenuación
+LOUDNESS_FALLBACK = 'volume=0.8' # Filtro mientras la pista no fue analizada
+LOUDNESS_MAX_JOBS = 1            # Análisis simultáneos
+LOUDNESS_MAX_DURATION = 1800     # No se analizan pistas más largas (segundos)
+
+# Mezclador PCM en proceso (requiere numpy)
+MIXER_ENABLED = True
+CROSSFADE_SECONDS = 4            # Duración del fundido entre pistas (0 = sin fundido)
+PREFETCH_LEAD = 10               # Segundos antes del fundido en que se abre la siguiente pista
+DUCK_LEVEL = 0.3                 # Volumen relativo con ducking activo
+MAX_VOLUME = 200                 # Porcentaje máximo para !volume
+PCM_FRAME_BYTES = 3840           # 20 ms de PCM s16le estéreo a 48 kHz
+PCM_FRAME_SAMPLES = 1920         # 960 muestras x 2 canales
+
+# Procesos de audio separados del gateway
+AUDIO_WORKERS = 0                # Procesos de audio (0 = todo en el proceso principal)
+WORKER_BUFFER_FRAMES = 50        # Frames Opus que un worker puede adelantar por stream
+WORKER_CREDIT_BATCH = 25         # Frames consumidos antes de devolver crédito al worker
+WORKER_READ_TIMEOUT = 0.02       # Espera máxima por frame antes de enviar silencio
+WORKER_HEALTH_INTERVAL = 5       # Segundos entre pings de salud
+OPUS_SILENCE = b'\xf8\xff\xfe'  # Frame Opus de silencio
+
+# Diagnóstico de memoria
+MEMPROF_ENABLED = os.getenv("MEMPROF") == "1"  # Inicia tracemalloc al arrancar
+MEMPROF_FRAMES = 5               # Profundidad de traceback de tracemalloc
+MEMPROF_INTERVAL = 15            # Minutos entre snapshots periódicos a disco
+MEMPROF_PATH = 'memprof.jsonl'
+MEMPROF_TOP = 10                 # Entradas por reporte
+
+# Spotify: los links se resuelven a YouTube y la correspondencia queda en la base
+SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
+SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL")      # Para apuntar a un stub local (ver spotify_stub.py)
+SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL")
+SPOTIFY_BATCH_SIZE = 50          # IDs por llamada a /tracks (máximo de la API)
+SPOTIFY_BATCH_WINDOW = 0.05      # Segundos en que se juntan pedidos de metadatos
+SPOTIFY_MAX_TRACKS = 50          # Canciones tomadas de un álbum o playlist
+SPOTIFY_METADATA_CACHE = 2000    # Metadatos de canciones recordados en memoria
+
+# Mantenimiento de la base de moderación
+DB_PATH = 'moderacion.db'
+RETENTION_DAYS = 365             # Días que se conservan infracciones y tickets cerrados (por defecto)
+MAINTENANCE_WINDOW = (4, 6)      # Horas locales [desde, hasta) de baja actividad
+MAINTENANCE_CHECK_MINUTES = 30   # Cada cuánto se revisa si toca mantenimiento
+MAINTENANCE_BATCH = 500          # Filas archivadas por transacción
+MAINTENANCE_VACUUM_PAGES = 2000  # Páginas libres devueltas al sistema por corrida
+DB_BUSY_TIMEOUT_MS = 2000        # Espera máxima por un lock antes de fallar (ms)
+
+# Biblioteca local: MUSIC_LIBRARY=<directorio> activa la búsqueda en archivos propios
+MUSIC_LIBRARY_PATH = os.getenv("MUSIC_LIBRARY")
+LIBRARY_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.wma')
+LIBRARY_SCAN_MINUTES = 30        # Minutos entre re-escaneos incrementales
+LIBRARY_COMMIT_EVERY = 50        # Archivos indexados por transacción
+LIBRARY_DB_PATH = 'biblioteca.db'  # Índice propio, separado de la base de moderación
+LIBRARY_MIN_COVERAGE = 0.5       # Fracción mínima de palabras del título presentes en la búsqueda
+
+# Control de admisión para comandos que disparan extracciones y ffmpeg
+ADMISSION_USER_RATE = 0.2        # Extracciones por segundo que recupera cada usuario
+ADMISSION_USER_BURST = 5
+ADMISSION_GUILD_RATE = 1.0       # Extracciones por segundo que recupera cada servidor
+ADMISSION_GUILD_BURST = 15
+ADMISSION_MAX_WAIT = 20          # Segundos máximos de espera en cola antes de rechazar
+ADMISSION_MAX_EXTRACTIONS = 6    # Extracciones simultáneas con el host libre
+ADMISSION_FFMPEG_PER_SLOT = 4    # Cada tantos ffmpeg vivos se resta una extracción al presupuesto
+ADMISSION_MAX_FFMPEG = 40        # Con tantos ffmpeg vivos no se abren reproducciones nuevas
+ADMISSION_CPU_HIGH = 0.75        # Carga por núcleo desde la que el presupuesto se reduce a la mitad
+ADMISSION_CPU_CRITICAL = 0.95    # Carga por núcleo desde la que no se admiten extracciones nuevas
+ADMISSION_POLL = 0.25            # Segundos entre revisiones de la cola global
+
+# Pool de instancias de yt-dlp
+YDL_POOL_SIZE = 5       # Instancias YoutubeDL precalentadas
+PLAY_BATCH_MAX = 10     # Canciones por comando !play, contadas tras expandir álbumes y playlists
+PLAY_BATCH_CONCURRENCY = 5  # Extracciones simultáneas por comando
+PANEL_REFRESH_DELAY = 1.0   # Segundos en que se agrupan los cambios antes de editar el panel
+INTERACTION_EDIT_TTL = 14 * 60  # Segundos en que todavía se puede editar la respuesta de un slash
+YDL_MAX_USES = 50       # Extracciones antes de reciclar una instancia
+
+# Recuperación de streams caídos
+FRAME_DURATION = 0.02        # Cada lectura de un AudioSource son 20 ms
+RESUME_TOLERANCE = 3         # Segundos finales en los que un corte se toma como fin de pista
+MAX_RESUME_ATTEMPTS = 3      # Reintentos de reanudación por pista
+
+# Planificador de mensajes salientes
+LOG_COALESCE_WINDOW = 2.0    # Segundos para agrupar eventos de log en un solo mensaje
+CHANNEL_SEND_INTERVAL = 1.0  # Separación mínima entre envíos de fondo al mismo canal
+INTERACTION_PRIORITY = 0.5   # Pausa de los envíos de fondo tras una interacción
+
+# Tickets
+MAX_TICKETS_POR_USUARIO = 1  # Tickets abiertos simultáneos por usuario
+
+# Purga de mensajes (/limpiar)
+PURGE_MAX_DELETE = 10000     # Máximo de mensajes a borrar por trabajo
+PURGE_MAX_SCAN = 50000       # Máximo de mensajes revisados por trabajo
+PURGE_BULK_SIZE = 100        # Límite de la API para borrado masivo
+PURGE_BULK_MAX_AGE = timedelta(days=14, minutes=-5)  # Margen ante el límite de 14 días
+PURGE_SINGLE_DELAY = 1.2     # Pausa entre borrados individuales de mensajes antiguos
+PURGE_PROGRESS_INTERVAL = 5  # Segundos entre actualizaciones de progreso
+PURGE_PATTERN_MAX = 100      # Largo máximo de la expresión regular de /limpiar
+
+# Auto-moderación (límite, ventana en segundos)
+AUTOMOD_ENABLED = True
+AUTOMOD_USER_RATE = (6, 5)       # Mensajes por usuario
+AUTOMOD_DUPLICATES = (3, 15)     # Mensajes idénticos seguidos por usuario
+AUTOMOD_GUILD_RATE = (200, 5)    # Mensajes por servidor antes de endurecer límites...
+AUTOMOD_RAID_MIN_JOINS = 5       # ...si además hubo tantos ingresos en la ventana de AUTOMOD_JOIN_BURST
+AUTOMOD_JOIN_BURST = (10, 10)    # Ingresos por servidor que activan el modo raid
+AUTOMOD_RAID_SECONDS = 300       # Duración del modo raid
+AUTOMOD_MUTE_SECONDS = 600       # Mute automático por spam
+AUTOMOD_MAX_TRACKED = 50000      # Usuarios seguidos simultáneamente (LRU)
+
+# Navegador de infracciones
+INFRACCIONES_POR_PAGINA = 5
+INFRACCIONES_CACHE_PAGINAS = 10  # Páginas guardadas por vista
+EXPORT_CHUNK = 500               # Filas por lectura al exportar
+
+# Reinicio en caliente
+SNAPSHOT_PATH = 'music_state.json'
+SNAPSHOT_INTERVAL = 60           # Segundos entre snapshots periódicos
+TITLE_INDEX_SIZE = 500           # Canciones reproducidas indexadas por servidor
+TITLE_MATCH_THRESHOLD = 0.5      # Puntaje mínimo (0-1) para aceptar una coincidencia aproximada
+STREAM_URL_TTL = 5 * 3600        # Segundos que se reutiliza una URL de stream ya resuelta
+
 # --------------------------
 # Base de Datos
 # --------------------------
 
 def setup_database():
-    conn = sqlite3.connect('moderacion.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
+    # Sólo tiene efecto en una base nueva; las existentes se convierten con `!mantenimiento run`
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    # WAL: el mantenimiento en su hilo no bloquea las lecturas del bot
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
     
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS infracciones (
@@ -78,6 +276,73 @@ def setup_database():
         PRIMARY KEY (user_id, guild_id, fecha)
     )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_infracciones_guild_fecha ON infracciones (guild_id, fecha)')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tickets (
+        channel_id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        creator_id INTEGER NOT NULL,
+        claimer_id INTEGER,
+        motivo TEXT,
+        estado TEXT NOT NULL DEFAULT 'abierto',
+        creado TEXT NOT NULL,
+        reclamado TEXT,
+        cerrado TEXT,
+        motivo_cierre TEXT
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_creator ON tickets (guild_id, creator_id, estado)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_estado ON tickets (guild_id, estado)')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS guild_config (
+        guild_id INTEGER PRIMARY KEY,
+        staff_roles TEXT NOT NULL,
+        log_channel_id INTEGER,
+        ticket_category_id INTEGER,
+        mute_role_name TEXT,
+        mute_role_id INTEGER,
+        music_commands_channel_id INTEGER,
+        retention_days INTEGER
+    )
+    ''')
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(guild_config)')}
+    if 'retention_days' not in columns:
+        cursor.execute('ALTER TABLE guild_config ADD COLUMN retention_days INTEGER')
+
+    # Filas vencidas, comprimidas en bloques (ver DatabaseMaintenance)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archivo (
+        id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        tabla TEXT NOT NULL,
+        desde TEXT,
+        hasta TEXT,
+        filas INTEGER NOT NULL,
+        datos BLOB NOT NULL,
+        fecha TEXT NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archivo_guild ON archivo (guild_id, tabla, hasta)')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS spotify_map (
+        spotify_id TEXT PRIMARY KEY,
+        isrc TEXT,
+        video_id TEXT NOT NULL,
+        fecha TEXT NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_spotify_map_isrc ON spotify_map(isrc)')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS loudness (
+        track_id TEXT PRIMARY KEY,
+        lufs REAL NOT NULL,
+        fecha TEXT NOT NULL
+    )
+    ''')
     conn.commit()
     return conn, cursor
 
@@ -98,12 +363,20 @@ class MusicQueue:
     def __init__(self):
         self.queues: Dict[int, Deque] = {}
         self.current: Dict[int, Dict] = {}
-        self.disconnect_timers: Dict[int, asyncio.Task] = {}
         self.locks: Dict[int, asyncio.Lock] = {}
         self.is_playing: Dict[int, bool] = {}
         self.loop_modes: Dict[int, str] = {}  # 'none', 'song', 'queue'
         self.playlists: Dict[int, Dict[str, List[Dict]]] = {}  # Guild ID -> {playlist_name: [songs]}
         self.autoplay_enabled = {}
+        self.sources: Dict[int, 'TrackedSource'] = {}  # Fuente activa por servidor
+        self.resume_attempts: Dict[int, int] = {}
+        self.volumes: Dict[int, float] = {}   # Volumen del mezclador (1.0 = 100%)
+        self.ducked: Dict[int, bool] = {}
+
+    def get_position(self, guild_id: int) -> float:
+        """Segundos reproducidos de la canción actual"""
+        source = self.sources.get(guild_id)
+        return source.position if source else 0.0
 
     def get_queue(self, guild_id: int) -> Deque:
         if guild_id not in self.queues:
@@ -117,16 +390,11 @@ class MusicQueue:
             self.queues[guild_id].clear()
         if guild_id in self.current:
             del self.current[guild_id]
+        self.sources.pop(guild_id, None)
+        self.resume_attempts.pop(guild_id, None)
         if guild_id in self.is_playing:
             self.is_playing[guild_id] = False
-
-    async def cancel_disconnect_timer(self, guild_id: int):
-        if guild_id in self.disconnect_timers:
-            try:
-                self.disconnect_timers[guild_id].cancel()
-            except:
-                pass
-            del self.disconnect_timers[guild_id]
+        music_panels.refresh(guild_id)
 
     async def safe_get_queue(self, guild_id: int) -> Deque:
         """Obtiene la cola de manera segura usando un lock"""
@@ -176,6 +444,7 @@ class MusicQueue:
         
         if songs:
             self.playlists[guild_id][name] = songs
+            title_index.add_playlist(guild_id, name)
             return True
         return False
     
@@ -190,6 +459,7 @@ class MusicQueue:
     def delete_playlist(self, guild_id: int, name: str) -> bool:
         if guild_id in self.playlists and name in self.playlists[guild_id]:
             del self.playlists[guild_id][name]
+            title_index.remove_playlist(guild_id, name)
             return True
         return False
     
@@ -202,11 +472,465 @@ class MusicQueue:
 
 
 
+class MessageScheduler:
+    """Cola de salida por canal para mensajes de fondo (logs y avisos de estado).
+
+    - Los eventos de log que llegan dentro de `LOG_COALESCE_WINDOW` se envían
+      juntos como un único mensaje con varios embeds.
+    - Los avisos con la misma `key` se reemplazan mientras siguen pendientes,
+      así sólo sale el último (p. ej. sucesivos "reproduciendo ahora").
+    - Los envíos se espacian por canal y ceden el paso cuando acaba de llegar
+      una interacción, que siempre tiene prioridad.
+    """
+
+    def __init__(self):
+        self.pending: Dict[int, Deque[Dict]] = {}
+        self.log_buffers: Dict[int, List[discord.Embed]] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.last_interaction = 0.0
+        self.sent = 0
+        self.superseded = 0
+        self.coalesced = 0
+
+    def post(self, channel, content: str = None, *, embed: discord.Embed = None, key: str = None):
+        """Encola un aviso de estado; reemplaza uno pendiente con la misma key"""
+        queue = self.pending.setdefault(channel.id, deque())
+        if key:
+            for item in queue:
+                if item.get('key') == key:
+                    item['content'] = content
+                    item['embeds'] = [embed] if embed else None
+                    self.superseded += 1
+                    return
+        queue.append({
+            'channel': channel,
+            'content': content,
+            'embeds': [embed] if embed else None,
+            'key': key
+        })
+        self._wake(channel)
+
+    def log(self, channel, content: str = None, *, embed: discord.Embed = None):
+        """Registra un evento de log que se agrupará con los siguientes"""
+        if embed is None:
+            embed = discord.Embed(description=content, color=discord.Color.dark_grey())
+        buffer = self.log_buffers.setdefault(channel.id, [])
+        buffer.append(embed)
+        if len(buffer) == 1:
+            asyncio.create_task(self._flush_logs(channel))
+
+    async def _flush_logs(self, channel):
+        await asyncio.sleep(LOG_COALESCE_WINDOW)
+        embeds = self.log_buffers.pop(channel.id, [])
+        queue = self.pending.setdefault(channel.id, deque())
+        # Discord admite hasta 10 embeds por mensaje
+        for i in range(0, len(embeds), 10):
+            chunk = embeds[i:i + 10]
+            self.coalesced += len(chunk) - 1
+            queue.append({'channel': channel, 'content': None, 'embeds': chunk, 'key': None})
+        self._wake(channel)
+
+    def note_interaction(self):
+        self.last_interaction = time.monotonic()
+
+    def _wake(self, channel):
+        worker = self.workers.get(channel.id)
+        if worker is None or worker.done():
+            self.workers[channel.id] = asyncio.create_task(self._worker(channel.id))
+
+    async def _yield_to_interactions(self):
+        # Espera acotada: las interacciones tienen prioridad, pero sin dejar sin salida al fondo
+        deadline = time.monotonic() + INTERACTION_PRIORITY * 4
+        while time.monotonic() - self.last_interaction < INTERACTION_PRIORITY and time.monotonic() < deadline:
+            await asyncio.sleep(INTERACTION_PRIORITY / 2)
+
+    async def _worker(self, channel_id: int):
+        queue = self.pending.get(channel_id)
+        try:
+            while queue:
+                await self._yield_to_interactions()
+                item = queue.popleft()
+                kwargs = {}
+                if item['content']:
+                    kwargs['content'] = item['content']
+                if item['embeds']:
+                    kwargs['embeds'] = item['embeds']
+                try:
+                    await item['channel'].send(**kwargs)
+                    self.sent += 1
+                except discord.HTTPException as e:
+                    print(f"[Scheduler] Error enviando a {channel_id}: {e}")
+                await asyncio.sleep(CHANNEL_SEND_INTERVAL)
+        finally:
+            if not self.pending.get(channel_id):
+                self.pending.pop(channel_id, None)
+            self.workers.pop(channel_id, None)
+
+
+class IdleReaper:
+    """Barrido central de conexiones de voz inactivas.
+
+    En lugar de una tarea de desconexión por servidor, se mantiene un heap de
+    plazos que un único loop revisa cada `REAPER_TICK` segundos. Al vencer un
+    plazo se vuelve a comprobar el estado real: se desconecta si el canal no
+    tiene oyentes o si lleva `DISCONNECT_AFTER` segundos sin reproducir nada.
+    """
+
+    def __init__(self):
+        self.heap: List[tuple] = []               # (plazo, guild_id), con borrado perezoso
+        self.deadlines: Dict[int, float] = {}
+        self.idle_since: Dict[int, float] = {}
+        self.reclaimed = 0
+
+    def _schedule(self, guild_id: int, deadline: float):
+        current = self.deadlines.get(guild_id)
+        if current is not None and current <= deadline:
+            return
+        self.deadlines[guild_id] = deadline
+        heapq.heappush(self.heap, (deadline, guild_id))
+
+    def mark_idle(self, guild_id: int):
+        """La cola quedó vacía: desconectar tras DISCONNECT_AFTER"""
+        now = time.monotonic()
+        self.idle_since.setdefault(guild_id, now)
+        self._schedule(guild_id, self.idle_since[guild_id] + DISCONNECT_AFTER)
+
+    def mark_alone(self, guild_id: int):
+        """No quedan oyentes en el canal: desconectar tras ALONE_GRACE"""
+        self._schedule(guild_id, time.monotonic() + ALONE_GRACE)
+
+    def mark_active(self, guild_id: int):
+        self.idle_since.pop(guild_id, None)
+        self.deadlines.pop(guild_id, None)
+        # Reproducir no cuenta como actividad si nadie escucha
+        guild = bot.get_guild(guild_id)
+        voice_client = guild.voice_client if guild else None
+        if voice_client and voice_client.is_connected() and not self.has_listeners(voice_client):
+            self.mark_alone(guild_id)
+
+    @staticmethod
+    def has_listeners(voice_client: discord.VoiceClient) -> bool:
+        return any(not member.bot for member in voice_client.channel.members)
+
+    async def sweep(self):
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, guild_id = heapq.heappop(self.heap)
+            if self.deadlines.get(guild_id) != deadline:
+                continue  # Plazo reemplazado o cancelado
+            del self.deadlines[guild_id]
+
+            voice_client = discord.utils.get(bot.voice_clients, guild=bot.get_guild(guild_id))
+            if not voice_client or not voice_client.is_connected():
+                self.idle_since.pop(guild_id, None)
+                continue
+
+            alone = not self.has_listeners(voice_client)
+            idle_since = self.idle_since.get(guild_id)
+            busy = voice_client.is_playing() or voice_client.is_paused() or music_queue.get_queue(guild_id)
+            if busy:
+                idle_since = self.idle_since.pop(guild_id, None)
+            if not alone and not idle_since:
+                continue
+            if not alone and now - idle_since < DISCONNECT_AFTER:
+                self._schedule(guild_id, idle_since + DISCONNECT_AFTER)
+                continue
+
+            try:
+                motivo = "sin oyentes" if alone else "por inactividad"
+                message_scheduler.post(voice_client.channel, f"🔌 Desconectando {motivo}...", key="idle")
+                music_queue.clear(guild_id)
+                if voice_client.is_playing() or voice_client.is_paused():
+                    voice_client.stop()
+                await voice_client.disconnect()
+                self.reclaimed += 1
+            except Exception as e:
+                print(f"Error en desconexión automática: {e}")
+            finally:
+                self.idle_since.pop(guild_id, None)
+
+
+class PresenceManager:
+    """Presencia global del bot con presupuesto de envíos al gateway.
+
+    Los cambios sólo marcan la presencia como pendiente; una única tarea la
+    envía tras `PRESENCE_DEBOUNCE` segundos y como mucho una vez cada
+    `PRESENCE_MIN_INTERVAL`. Sólo se envía si el texto cambió.
+    """
+
+    def __init__(self):
+        self.last_sent = 0.0
+        self.last_name: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.dirty = False
+        self.sent = 0
+        self.skipped = 0
+
+    def request(self):
+        """Pide una actualización sin bloquear a quien la solicita"""
+        self.dirty = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush())
+        else:
+            self.skipped += 1
+
+    @staticmethod
+    def current_name() -> str:
+        playing = [guild_id for guild_id, status in music_queue.is_playing.items() if status]
+        if not playing:
+            return "!help"
+        if len(playing) == 1 and playing[0] in music_queue.current:
+            return music_queue.current[playing[0]]['title'][:50]
+        return f"música en {len(playing)} servidores"
+
+    async def _flush(self):
+        while self.dirty:
+            wait = max(PRESENCE_DEBOUNCE, self.last_sent + PRESENCE_MIN_INTERVAL - time.monotonic())
+            await asyncio.sleep(wait)
+            self.dirty = False
+            name = self.current_name()
+            if name == self.last_name:
+                continue
+            try:
+                await bot.change_presence(activity=discord.Activity(
+                    type=discord.ActivityType.listening,
+                    name=name
+                ))
+                self.last_name = name
+                self.last_sent = time.monotonic()
+                self.sent += 1
+            except Exception as e:
+                print(f"Error actualizando presencia: {e}")
+
+
 music_queue = MusicQueue()
+message_scheduler = MessageScheduler()
+idle_reaper = IdleReaper()
+presence_manager = PresenceManager()
+
+@tasks.loop(seconds=REAPER_TICK)
+async def reaper_loop():
+    await idle_reaper.sweep()
 
 song_history: Dict[int, List[Dict]] = {} 
 
 
+# --------------------------
+# Índice de títulos
+# --------------------------
+
+class TrigramIndex:
+    """Índice invertido de trigramas para búsquedas aproximadas por texto.
+
+    Los candidatos salen de las listas invertidas de los trigramas de la
+    consulta y sólo esos se puntúan; cada entrada guarda su número de inserción
+    para desempatar por recencia sin recorrer el índice completo.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.entries: OrderedDict = OrderedDict()  # clave -> (trigramas, payload, orden), de más viejo a más nuevo
+        self.postings: Dict[str, set] = {}
+        self.max_entries = max_entries
+        self.sequence = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = unicodedata.normalize('NFKD', text.lower())
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+        return ' '.join(re.findall(r'\w+', text))
+
+    @classmethod
+    def trigrams(cls, text: str) -> frozenset:
+        # Cada palabra se rellena por separado, como en pg_trgm
+        return frozenset(
+            padded[i:i + 3]
+            for padded in (f"  {word} " for word in cls.normalize(text).split())
+            for i in range(len(padded) - 2)
+        )
+
+    def add(self, key: str, text: str, payload):
+        self.remove(key)
+        grams = self.trigrams(text)
+        self.sequence += 1
+        self.entries[key] = (grams, payload, self.sequence)
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(key)
+        if self.max_entries and len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if not entry:
+            return
+        for gram in entry[0]:
+            keys = self.postings.get(gram)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[gram]
+
+    def search(self, text: str, limit: int = 5) -> List[tuple]:
+        """[(puntaje, payload)] de mayor a menor; a igual puntaje gana lo más reciente"""
+        grams = self.trigrams(text)
+        shared: Dict[str, int] = {}
+        for gram in grams:
+            for key in self.postings.get(gram, ()):
+                shared[key] = shared.get(key, 0) + 1
+
+        results = []
+        for key, count in shared.items():
+            entry_grams, payload, order = self.entries[key]
+            # Cobertura de la consulta, corregida por el largo del título (Dice)
+            score = 0.7 * count / len(grams) + 0.3 * 2 * count / (len(grams) + len(entry_grams))
+            if score >= TITLE_MATCH_THRESHOLD:
+                results.append((score, order, payload))
+        return [(score, payload) for score, _, payload in heapq.nlargest(limit, results, key=lambda r: r[:2])]
+
+
+class TitleIndex:
+    """Índices por servidor de canciones reproducidas y nombres de playlists"""
+
+    def __init__(self):
+        self.tracks: Dict[int, TrigramIndex] = {}
+        self.playlists: Dict[int, TrigramIndex] = {}
+
+    def add_track(self, guild_id: int, song: Dict):
+        if not song.get('title'):
+            return
+        index = self.tracks.get(guild_id)
+        if index is None:
+            index = self.tracks[guild_id] = TrigramIndex(TITLE_INDEX_SIZE)
+        payload = snapshot_song(song)
+        if song.get('url') and song.get('resolved_at'):
+            payload['url'] = song['url']
+            payload['resolved_at'] = song['resolved_at']
+        index.add(song.get('webpage_url') or TrigramIndex.normalize(song['title']), song['title'], payload)
+
+    def find_track(self, guild_id: int, text: str) -> Optional[Dict]:
+        """Copia de la canción conocida más parecida, lista para encolar sin buscar de nuevo"""
+        index = self.tracks.get(guild_id)
+        matches = index.search(text, limit=1) if index else []
+        if not matches:
+            return None
+        song = dict(matches[0][1])
+        if time.time() - song.get('resolved_at', 0) > STREAM_URL_TTL:
+            # La URL firmada ya caducó: ensure_stream_url la resuelve desde webpage_url
+            song.pop('url', None)
+            song.pop('resolved_at', None)
+        return song
+
+    def add_playlist(self, guild_id: int, name: str):
+        index = self.playlists.get(guild_id)
+        if index is None:
+            index = self.playlists[guild_id] = TrigramIndex()
+        index.add(name, name, name)
+
+    def remove_playlist(self, guild_id: int, name: str):
+        if guild_id in self.playlists:
+            self.playlists[guild_id].remove(name)
+
+    def find_playlist(self, guild_id: int, name: str) -> Optional[str]:
+        """Nombre guardado que coincide exactamente (sin mayúsculas ni acentos)"""
+        index = self.playlists.get(guild_id)
+        if not index:
+            return None
+        if name in index.entries:
+            return name
+        wanted = TrigramIndex.normalize(name)
+        return next((key for key in index.entries if TrigramIndex.normalize(key) == wanted), None)
+
+    def suggest_playlist(self, guild_id: int, name: str) -> Optional[str]:
+        """Playlist de nombre parecido, para sugerirla sin cargarla"""
+        index = self.playlists.get(guild_id)
+        matches = index.search(name, limit=1) if index else []
+        return matches[0][1] if matches else None
+
+
+title_index = TitleIndex()
+
+
+class YDLPool:
+    """Pool de instancias YoutubeDL reutilizables.
+
+    Cada instancia conserva sus extractores, cookies y conexiones HTTP abiertas,
+    así el costo de construcción y el handshake TCP/TLS se pagan una sola vez.
+    Las instancias se prestan por extracción y se reciclan tras `max_uses` usos
+    o cuando una extracción falla.
+    """
+
+    def __init__(self, options: Dict, size: int = YDL_POOL_SIZE, max_uses: int = YDL_MAX_USES):
+        self.options = options
+        self.size = size
+        self.max_uses = max_uses
+        self._idle: Optional[asyncio.Queue] = None
+        self._uses: Dict[int, int] = {}
+        self._created = 0
+        self.recycled = 0
+
+    def _get_idle(self) -> asyncio.Queue:
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        return self._idle
+
+    async def _new_instance(self) -> yt_dlp.YoutubeDL:
+        # La construcción carga todos los extractores: se hace fuera del event loop
+        ydl = await bot.loop.run_in_executor(None, lambda: yt_dlp.YoutubeDL(self.options))
+        self._uses[id(ydl)] = 0
+        return ydl
+
+    async def warm(self):
+        """Crea las instancias que falten hasta completar el pool"""
+        idle = self._get_idle()
+        while self._created < self.size:
+            self._created += 1
+            try:
+                idle.put_nowait(await self._new_instance())
+            except Exception as e:
+                self._created -= 1
+                print(f"[YDLPool] Error creando instancia: {e}")
+                return
+
+    async def acquire(self) -> yt_dlp.YoutubeDL:
+        idle = self._get_idle()
+        if idle.empty() and self._created < self.size:
+            self._created += 1
+            try:
+                return await self._new_instance()
+            except Exception:
+                self._created -= 1
+                raise
+        return await idle.get()
+
+    def release(self, ydl: yt_dlp.YoutubeDL, failed: bool = False):
+        uses = self._uses.get(id(ydl), 0) + 1
+        if failed or uses >= self.max_uses:
+            self._discard(ydl)
+            return
+        self._uses[id(ydl)] = uses
+        self._get_idle().put_nowait(ydl)
+
+    def _discard(self, ydl: yt_dlp.YoutubeDL):
+        self._uses.pop(id(ydl), None)
+        self.recycled += 1
+        try:
+            ydl.close()
+        except Exception:
+            pass
+        # Reponer la instancia en segundo plano para no dejar esperando a nadie
+        self._created -= 1
+        asyncio.create_task(self.warm())
+
+    async def extract_info(self, query: str) -> Dict:
+        ydl = await self.acquire()
+        try:
+            info = await bot.loop.run_in_executor(None, lambda: ydl.extract_info(query, download=False))
+        except Exception:
+            self.release(ydl, failed=True)
+            raise
+        self.release(ydl)
+        return info
+
+
 class MusicPlayer:
     YDL_OPTIONS = {
         'format': 'bestaudio/best',
@@ -233,199 +957,1449 @@ class MusicPlayer:
     }
 
     @classmethod
-    async def get_audio_source(cls, query: str) -> Optional[Dict]:
+    async def get_audio_source(cls, query: str, gated: bool = False) -> Optional[Dict]:
+        """Resuelve una consulta; con `gated` la extracción pasa por el presupuesto global.
+
+        Las resoluciones de la reproducción en curso (reanudar, URLs caducadas)
+        no van con `gated`: nunca esperan detrás de comandos nuevos.
+        """
         try:
-            with yt_dlp.YoutubeDL(cls.YDL_OPTIONS) as ydl:
-                if not query.startswith(('http://', 'https://')):
-                    query = f"ytsearch:{query}"
-                
-                info = await bot.loop.run_in_executor(None, lambda: ydl.extract_info(query, download=False))
-                
-                if 'entries' in info:
-                    info = info['entries'][0]
-                
-                return {
-                    'url': info['url'],
-                    'title': info.get('title', 'Audio desconocido'),
-                    'duration': info.get('duration', 0)
-                }
+            if spotify_resolver.parse(query):
+                # Álbumes y playlists llegan ya expandidos desde !play; acá sólo se toma la primera
+                track_ids = await spotify_resolver.expand(query)
+                return await spotify_resolver.resolve(track_ids[0], gated) if track_ids else None
+
+            if media_library.enabled() and not query.startswith(('http://', 'https://')):
+                # Biblioteca local primero: una consulta FTS en lugar de una extracción
+                song = media_library.search(query)
+                if song:
+                    return song
+
+            if not query.startswith(('http://', 'https://')):
+                query = f"ytsearch:{query}"
+
+            if gated:
+                if not await admission.acquire_extraction():
+                    return None
+                started = time.monotonic()
+                try:
+                    info = await ydl_pool.extract_info(query)
+                finally:
+                    admission.release_extraction(time.monotonic() - started)
+            else:
+                info = await ydl_pool.extract_info(query)
+
+            if 'entries' in info:
+                info = info['entries'][0]
+
+            return {
+                'url': info['url'],
+                'title': info.get('title', 'Audio desconocido'),
+                'duration': info.get('duration', 0),
+                'webpage_url': info.get('webpage_url'),
+                'resolved_at': time.time()
+            }
         except Exception:
             print(f"Error al obtener audio: {traceback.format_exc()}")
             return None
 
-async def play_next(guild_id: int, error=None):
-    voice_client = discord.utils.get(bot.voice_clients, guild=bot.get_guild(guild_id))
-    
-    if error:
-        print(f"Error en reproducción: {error}")
-        music_queue.set_playing(guild_id, False)
-    
-    if not voice_client or not voice_client.is_connected():
-        music_queue.set_playing(guild_id, False)
-        return
 
-    await music_queue.cancel_disconnect_timer(guild_id)
-    await asyncio.sleep(1.5)
-    
-    loop_mode = music_queue.get_loop_mode(guild_id)
-    current_song = music_queue.current.get(guild_id, None)
-    
-    # Manejo de loops
-    if loop_mode == 'song' and current_song:
-        queue = await music_queue.safe_get_queue(guild_id)
-        queue.appendleft(current_song)
-    
-    queue = await music_queue.safe_get_queue(guild_id)
-    
-    if not queue:
-        if loop_mode == 'queue' and current_song:
-            queue.append(current_song)
-        else:
-    # Autoplay activado
-            if music_queue.is_autoplay(guild_id) and current_song:
-                related = await get_related_song(current_song['title'])
-                if related:
-                    queue.append(related)
-                    return await play_next(guild_id)
+ydl_pool = YDLPool(MusicPlayer.YDL_OPTIONS)
 
-            music_queue.set_playing(guild_id, False)
-            await asyncio.sleep(1)
-            queue = await music_queue.safe_get_queue(guild_id)
-            if not queue:
-                channel = voice_client.channel
-                await channel.send(f"🛑 No hay más canciones en la cola. Me desconectaré en {DISCONNECT_AFTER} segundos...")
-                
-                async def disconnect_task():
-                    try:
-                        await asyncio.sleep(DISCONNECT_AFTER)
-                        current_queue = await music_queue.safe_get_queue(guild_id)
-                        await music_queue.cancel_disconnect_timer(guild_id)
-                        if not current_queue and voice_client.is_connected():
-                            if not voice_client.is_playing():
-                                await channel.send("🔌 Desconectando por inactividad...")
-                                await voice_client.disconnect()
-                    except Exception as e:
-                        print(f"Error en desconexión automática: {e}")
-                    finally:
-                        if guild_id in music_queue.disconnect_timers:
-                            del music_queue.disconnect_timers[guild_id]
-                
-                music_queue.disconnect_timers[guild_id] = asyncio.create_task(disconnect_task())
-                return
-    
-    next_song = queue.popleft()
-    music_queue.current[guild_id] = next_song
-    
-    # Anunciar canción si fue por autoplay
-    if next_song.get("requested_by") == "Autoplay":
-        channel = voice_client.channel
-        await channel.send(f"🎶 Reproduciendo sugerencia por autoplay: **{next_song['title']}**")
 
-    
-    # Registrar en historial
-    if guild_id not in song_history:
-        song_history[guild_id] = []
+# --------------------------
+# Control de admisión
+# --------------------------
 
-    song_history[guild_id].append(next_song)
+class TokenBucket:
+    """Cubeta de tokens que admite reservar a futuro: la espera sale del déficit"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
 
-    # Limitar historial a 10 canciones
-    if len(song_history[guild_id]) > 20:
-        song_history[guild_id].pop(0)
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
 
-    
-    music_queue.set_playing(guild_id, True)
-    
-    try:
-        adaptive_options = FFMPEG_OPTIONS.copy()
-        if voice_client.latency > 0.3:
-            adaptive_options['options'] = '-vn -b:a 96k'
-            
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, cost: float) -> float:
+        """Segundos hasta poder pagar `cost`, sin consumir nada"""
+        self._refill()
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    def take(self, cost: float):
+        self._refill()
+        self.tokens -= cost
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class AdmissionController:
+    """Limita cuántas extracciones y ffmpeg pueden disparar los comandos.
+
+    Dos niveles: cubetas de tokens por usuario y por servidor al recibir el
+    comando (se encola con ETA si la espera es corta, si no se rechaza), y un
+    presupuesto global de extracciones simultáneas que se achica con los ffmpeg
+    vivos y la carga de CPU. La reproducción en curso nunca pasa por acá, y con
+    el host cargado se posterga el análisis de loudness en segundo plano.
+    """
+
+    def __init__(self):
+        self.user_buckets: Dict[tuple, TokenBucket] = {}
+        self.guild_buckets: Dict[int, TokenBucket] = {}
+        self.waiters: Deque[object] = deque()
+        self.active = 0
+        self.avg_extraction = 3.0   # Media móvil de la duración de una extracción (s)
+        self.admitted = 0
+        self.queued: Dict[str, int] = {'usuario': 0, 'global': 0}
+        self.shed: Dict[str, int] = {'usuario': 0, 'global': 0, 'ffmpeg': 0}
+
+    # Estado del host
+
+    def live_ffmpeg(self) -> int:
+        # Con crossfade el mezclador ya tiene abierto el ffmpeg de la pista siguiente
+        prefetched = sum(1 for source in music_queue.sources.values()
+                         if getattr(source.original, 'next_source', None) is not None)
+        return len(music_queue.sources) + prefetched + len(loudness_analyzer.in_progress)
+
+    @staticmethod
+    def cpu_load() -> float:
+        """Carga media del último minuto por núcleo (0 donde no hay getloadavg)"""
         try:
-            source = await discord.FFmpegOpusAudio.from_probe(
-                next_song['url'],
-                **adaptive_options,
-                method='fallback'
-            )
-        except:
-            source = discord.FFmpegPCMAudio(
-                next_song['url'],
-                **adaptive_options
-            )
-        
-        if hasattr(source, '_player'):
-            source._player.opus_encoder.set_bitrate(128000)
-            source._player.buffer_size = 960 * 5
-            
-        voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(play_next(guild_id, e), bot.loop))
-        
-        await bot.change_presence(activity=discord.Activity(
-            type=discord.ActivityType.listening,
-            name=next_song['title'][:50]
-        ))
-        
-    except Exception as e:
-        print(f"Error al reproducir: {traceback.format_exc()}")
-        music_queue.set_playing(guild_id, False)
-        await asyncio.sleep(2)
-        await play_next(guild_id)
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except (AttributeError, OSError):
+            return 0.0
 
+    def capacity(self) -> int:
+        load = self.cpu_load()
+        if load >= ADMISSION_CPU_CRITICAL:
+            return 0
+        budget = ADMISSION_MAX_EXTRACTIONS - self.live_ffmpeg() // ADMISSION_FFMPEG_PER_SLOT
+        if load >= ADMISSION_CPU_HIGH:
+            budget //= 2
+        return max(1, budget)
 
-# ------------------------------------------
-# Comandos de Música
-# ------------------------------------------
+    def overloaded(self) -> bool:
+        return self.cpu_load() >= ADMISSION_CPU_HIGH or self.live_ffmpeg() >= ADMISSION_MAX_FFMPEG
 
-@bot.command(name="play", aliases=["p"])
-async def play(ctx, *, query: str):
-    """Reproduce música desde YouTube o la añade a la cola"""
-    if not ctx.author.voice:
-        return await ctx.send("🚨 Debes estar en un canal de voz para usar este comando!")
+    def global_eta(self, position: int) -> float:
+        capacity = self.capacity()
+        if capacity == 0:
+            return float('inf')
+        return math.ceil(position / capacity) * self.avg_extraction
 
-    try:
-        # Cancelar cualquier temporizador de desconexión primero
-        await music_queue.cancel_disconnect_timer(ctx.guild.id)
-        
-        data = await MusicPlayer.get_audio_source(query)
-        data["requested_by"] = ctx.author.display_name
-        if not data:
-            return await ctx.send("❌ No se pudo encontrar el video o la canción")
+    # Nivel 1: cubetas por comando
 
-        voice_client = ctx.voice_client or await ctx.author.voice.channel.connect()
-        
-        # Añadir a la cola de manera segura
-        queue = await music_queue.safe_get_queue(ctx.guild.id)
-        queue.append(data)
+    async def admit(self, guild: discord.Guild, user_id: int, cost: int = 1, notify=None) -> Optional[str]:
+        """None si el comando puede seguir (ya esperó lo necesario); si no, el motivo del rechazo"""
+        voice_client = guild.voice_client
+        starts_stream = not voice_client or not (voice_client.is_playing() or voice_client.is_paused())
+        if starts_stream and self.live_ffmpeg() >= ADMISSION_MAX_FFMPEG:
+            self.shed['ffmpeg'] += 1
+            return "🚦 El bot está al máximo de reproducciones simultáneas. Intenta de nuevo en unos minutos."
 
-        # Verificar si debemos empezar a reproducir
-        if not voice_client.is_playing() and not music_queue.get_playing(ctx.guild.id):
-            await play_next(ctx.guild.id)
-            await ctx.send(f"🎶 **Reproduciendo:** {data['title']}")
-        else:
-            await ctx.send(f"🎵 **Añadido a la cola:** {data['title']}")
+        user_bucket = self.user_buckets.get((guild.id, user_id))
+        if user_bucket is None:
+            user_bucket = self.user_buckets[(guild.id, user_id)] = TokenBucket(ADMISSION_USER_RATE, ADMISSION_USER_BURST)
+        guild_bucket = self.guild_buckets.get(guild.id)
+        if guild_bucket is None:
+            guild_bucket = self.guild_buckets[guild.id] = TokenBucket(ADMISSION_GUILD_RATE, ADMISSION_GUILD_BURST)
 
-    except Exception as e:
-        await ctx.send("❌ Error al reproducir")
-        print(f"Error en play: {traceback.format_exc()}")
+        # Un comando más grande que la ráfaga se cobra como una ráfaga completa
+        cost = min(cost, ADMISSION_USER_BURST)
+        wait = max(user_bucket.wait_for(cost), guild_bucket.wait_for(cost))
+        if wait > ADMISSION_MAX_WAIT:
+            self.shed['usuario'] += 1
+            return f"🚦 Demasiadas solicitudes seguidas. Intenta de nuevo en {math.ceil(wait)}s."
+        global_wait = self.global_eta(len(self.waiters) + 1) if self.active >= self.capacity() else 0.0
+        if global_wait > ADMISSION_MAX_WAIT:
+            self.shed['global'] += 1
+            return "🚦 El bot está muy cargado ahora mismo. Intenta de nuevo en un momento."
+        user_bucket.take(cost)
+        guild_bucket.take(cost)
+        self._prune()
 
-@bot.command(name="skip")
-async def skip(ctx):
-    """Salta la canción actual"""
-    voice_client = ctx.voice_client
-    if not voice_client:
-        return await ctx.send("❌ No estoy conectado a un canal de voz")
-    
-    queue = await music_queue.safe_get_queue(ctx.guild.id)
+        eta = wait + global_wait
+        if eta > 0 and notify:
+            await notify(eta)
+        if wait > 0:
+            self.queued['usuario'] += 1
+            await asyncio.sleep(wait)
+        self.admitted += 1
+        return None
+
+    def _prune(self):
+        # Las cubetas llenas equivalen a no tener historial: se descartan
+        if len(self.user_buckets) > 5000:
+            for key in [key for key, bucket in self.user_buckets.items() if bucket.is_full()]:
+                del self.user_buckets[key]
+        if len(self.guild_buckets) > 1000:
+            for key in [key for key, bucket in self.guild_buckets.items() if bucket.is_full()]:
+                del self.guild_buckets[key]
+
+    # Nivel 2: presupuesto global de extracciones
+
+    async def acquire_extraction(self) -> bool:
+        if not self.waiters and self.active < self.capacity():
+            self.active += 1
+            return True
+
+        ticket = object()
+        self.waiters.append(ticket)
+        self.queued['global'] += 1
+        deadline = time.monotonic() + ADMISSION_MAX_WAIT
+        try:
+            # Sondeo FIFO: la capacidad cambia con la carga aunque nadie libere
+            while not (self.waiters[0] is ticket and self.active < self.capacity()):
+                if time.monotonic() > deadline:
+                    self.shed['global'] += 1
+                    return False
+                await asyncio.sleep(ADMISSION_POLL)
+            self.active += 1
+            return True
+        finally:
+            self.waiters.remove(ticket)
+
+    def release_extraction(self, elapsed: float):
+        self.active -= 1
+        self.avg_extraction = 0.8 * self.avg_extraction + 0.2 * elapsed
+
+    def stats(self) -> Dict:
+        return {
+            'capacidad': self.capacity(),
+            'activas': self.active,
+            'en_cola': len(self.waiters),
+            'ffmpeg': self.live_ffmpeg(),
+            'cpu': self.cpu_load(),
+            'admitidos': self.admitted,
+            'encolados': dict(self.queued),
+            'rechazados': dict(self.shed),
+        }
+
+
+admission = AdmissionController()
+
+
+class MediaLibrary:
+    """Biblioteca de archivos locales indexada en su propio archivo SQLite.
+
+    El índice vive en `LIBRARY_DB_PATH`, así los escaneos nunca compiten por
+    el lock de la base de moderación, y sólo se crea si la biblioteca está
+    activada. El escaneo corre en un hilo con su propia conexión, lee las
+    etiquetas fuera de cualquier transacción y sólo para archivos nuevos o
+    cuyo mtime/tamaño cambió; luego escribe en lotes cortos de
+    `LIBRARY_COMMIT_EVERY`. Las búsquedas van contra `biblioteca_fts` (FTS5,
+    sin acentos ni mayúsculas), o con LIKE si este SQLite no trae FTS5, y el
+    archivo se reproduce directo con ffmpeg, sin extracción.
+    """
+
+    def __init__(self, root: Optional[str], db_path: str = LIBRARY_DB_PATH):
+        self.root = os.path.abspath(root) if root else None
+        self.db_path = db_path
+        self.scanning = False
+        self.last_scan: Optional[Dict] = None
+        self.hits = 0
+        self.fts: Optional[bool] = None  # Se averigua al crear el esquema
+        self.conn: Optional[sqlite3.Connection] = None  # Conexión de lectura del event loop
+
+    def enabled(self) -> bool:
+        return bool(self.root) and os.path.isdir(self.root)
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.create_function('normalizar', 1, TrigramIndex.normalize, deterministic=True)
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS biblioteca (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            artist TEXT,
+            album TEXT,
+            duration INTEGER
+        )
+        ''')
+        if self.fts is None:
+            try:
+                # Índice FTS5 con el mismo rowid que `biblioteca`
+                conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS biblioteca_fts
+                USING fts5(title, artist, album, tokenize='unicode61 remove_diacritics 2')
+                ''')
+                self.fts = True
+            except sqlite3.OperationalError:
+                print("[Biblioteca] SQLite sin FTS5: las búsquedas usarán LIKE")
+                self.fts = False
+        conn.commit()
+        return conn
+
+    @staticmethod
+    def read_tags(path: str) -> Dict:
+        title = artist = album = None
+        duration = 0
+        if mutagen:
+            try:
+                audio = mutagen.File(path, easy=True)
+                if audio is not None:
+                    tags = audio.tags or {}
+                    title = (tags.get('title') or [None])[0]
+                    artist = (tags.get('artist') or [None])[0]
+                    album = (tags.get('album') or [None])[0]
+                    duration = int(getattr(audio.info, 'length', 0) or 0)
+            except Exception as e:
+                print(f"[Biblioteca] Etiquetas ilegibles en {path}: {e}")
+        if not title:
+            # Convención habitual de nombres: "Artista - Título.ext"
+            stem = os.path.splitext(os.path.basename(path))[0]
+            parts = stem.split(' - ', 1)
+            if len(parts) == 2:
+                artist, title = artist or parts[0].strip(), parts[1].strip()
+            else:
+                title = stem
+        return {'title': title, 'artist': artist, 'album': album, 'duration': duration}
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[Tuple]) -> Tuple[int, int]:
+        added = updated = 0
+        with conn:
+            for path, previous, stat, tags in batch:
+                values = (stat.st_mtime, stat.st_size, tags['title'], tags['artist'], tags['album'], tags['duration'])
+                if previous:
+                    row_id = previous[0]
+                    conn.execute('''
+                    UPDATE biblioteca SET mtime = ?, size = ?, title = ?, artist = ?, album = ?, duration = ?
+                    WHERE id = ?
+                    ''', values + (row_id,))
+                    if self.fts:
+                        conn.execute('DELETE FROM biblioteca_fts WHERE rowid = ?', (row_id,))
+                    updated += 1
+                else:
+                    row_id = conn.execute('''
+                    INSERT INTO biblioteca (path, mtime, size, title, artist, album, duration)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', (path,) + values).lastrowid
+                    added += 1
+                if self.fts:
+                    conn.execute('''
+                    INSERT INTO biblioteca_fts (rowid, title, artist, album) VALUES (?, ?, ?, ?)
+                    ''', (row_id, tags['title'], tags['artist'] or '', tags['album'] or ''))
+        return added, updated
+
+    def scan(self) -> Dict:
+        """Escaneo incremental; corre fuera del event loop"""
+        started = time.perf_counter()
+        conn = self.connect()
+        added = updated = 0
+        try:
+            known = {path: (row_id, mtime, size) for row_id, path, mtime, size
+                     in conn.execute('SELECT id, path, mtime, size FROM biblioteca')}
+            seen = set()
+            batch = []
+            for dirpath, _, filenames in os.walk(self.root, followlinks=True):
+                for filename in filenames:
+                    if not filename.lower().endswith(LIBRARY_EXTENSIONS):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    seen.add(path)
+                    previous = known.get(path)
+                    if previous and previous[1:] == (stat.st_mtime, stat.st_size):
+                        continue
+
+                    # Las etiquetas se leen sin transacción abierta: sólo se escribe el lote
+                    batch.append((path, previous, stat, self.read_tags(path)))
+                    if len(batch) >= LIBRARY_COMMIT_EVERY:
+                        batch_added, batch_updated = self._write_batch(conn, batch)
+                        added, updated = added + batch_added, updated + batch_updated
+                        batch = []
+            if batch:
+                batch_added, batch_updated = self._write_batch(conn, batch)
+                added, updated = added + batch_added, updated + batch_updated
+
+            removed = [(row_id,) for path, (row_id, _, _) in known.items() if path not in seen]
+            with conn:
+                if self.fts:
+                    conn.executemany('DELETE FROM biblioteca_fts WHERE rowid = ?', removed)
+                conn.executemany('DELETE FROM biblioteca WHERE id = ?', removed)
+            total = conn.execute('SELECT COUNT(*) FROM biblioteca').fetchone()[0]
+        finally:
+            conn.close()
+        return {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'duracion': time.perf_counter() - started,
+            'total': total,
+            'nuevos': added,
+            'actualizados': updated,
+            'eliminados': len(removed),
+        }
+
+    async def scan_async(self) -> Optional[Dict]:
+        if self.scanning or not self.enabled():
+            return None
+        self.scanning = True
+        try:
+            result = await bot.loop.run_in_executor(None, self.scan)
+        finally:
+            self.scanning = False
+        self.last_scan = result
+        print(f"[Biblioteca] {result['total']} archivos ({result['nuevos']} nuevos, {result['actualizados']} "
+              f"actualizados, {result['eliminados']} eliminados) en {result['duracion']:.1f}s")
+        return result
+
+    @staticmethod
+    def relevant(tokens: List[str], title: str, artist: Optional[str], album: Optional[str]) -> bool:
+        """Cada palabra buscada debe aparecer entera, y cubrir buena parte del título"""
+        words = set(TrigramIndex.normalize(' '.join(filter(None, (title, artist, album)))).split())
+        if not words.issuperset(tokens):
+            return False
+        title_words = TrigramIndex.normalize(title).split()
+        covered = sum(1 for word in title_words if word in tokens)
+        return bool(title_words) and covered / len(title_words) >= LIBRARY_MIN_COVERAGE
+
+    def search(self, query: str) -> Optional[Dict]:
+        tokens = TrigramIndex.normalize(query).split()
+        if not tokens:
+            return None
+        if self.conn is None:
+            self.conn = self.connect()
+        if self.fts:
+            # Cada palabra entre comillas: nunca se interpreta como sintaxis FTS
+            rows = self.conn.execute('''
+            SELECT b.path, b.title, b.artist, b.album, b.duration
+            FROM biblioteca_fts JOIN biblioteca b ON b.id = biblioteca_fts.rowid
+            WHERE biblioteca_fts MATCH ?
+            ORDER BY bm25(biblioteca_fts) LIMIT 10
+            ''', (' '.join(f'"{token}"' for token in tokens),)).fetchall()
+        else:
+            # Sin FTS5: LIKE por palabra sobre el texto normalizado; relevant() filtra después
+            haystack = "normalizar(title || ' ' || coalesce(artist, '') || ' ' || coalesce(album, ''))"
+            rows = self.conn.execute(f'''
+            SELECT path, title, artist, album, duration FROM biblioteca
+            WHERE {' AND '.join(f'{haystack} LIKE ?' for _ in tokens)}
+            LIMIT 50
+            ''', [f'%{token}%' for token in tokens]).fetchall()
+
+        for path, title, artist, album, duration in rows:
+            if not self.relevant(tokens, title, artist, album) or not os.path.exists(path):
+                continue
+            self.hits += 1
+            return {
+                'url': path,
+                'local_path': path,
+                'title': f"{artist} - {title}" if artist else title,
+                'duration': duration or 0,
+                'webpage_url': None,
+                'resolved_at': time.time()
+            }
+        return None
+
+
+media_library = MediaLibrary(MUSIC_LIBRARY_PATH)
+
+@tasks.loop(minutes=LIBRARY_SCAN_MINUTES)
+async def library_loop():
+    try:
+        await media_library.scan_async()
+    except Exception:
+        print(f"Error escaneando la biblioteca: {traceback.format_exc()}")
+
+
+class SpotifyResolver:
+    """Convierte links de Spotify en canciones de YouTube.
+
+    Los metadatos se piden por lotes de hasta `SPOTIFY_BATCH_SIZE` IDs: los
+    pedidos que llegan dentro de `SPOTIFY_BATCH_WINDOW` comparten una sola
+    llamada a /tracks. Un único cliente reutiliza el token de client
+    credentials hasta que vence. Cada coincidencia se guarda en `spotify_map`
+    (ID de Spotify e ISRC -> video de YouTube), así volver a pedir la misma
+    canción no consulta a Spotify ni busca en YouTube.
+    """
+
+    LINK_RE = re.compile(
+        r'(?:https?://open\.spotify\.com/(?:intl-[\w-]+/)?(track|album|playlist)/|spotify:(track|album|playlist):)([A-Za-z0-9]{22})'
+    )
+    VIDEO_ID_RE = re.compile(r'(?:v=|youtu\.be/|/shorts/)([\w-]{11})')
+
+    def __init__(self):
+        self.client: Optional[spotipy.Spotify] = None
+        self.metadata: OrderedDict = OrderedDict()     # spotify_id -> metadatos
+        self.waiting: Dict[str, List[asyncio.Future]] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.api_calls = 0
+        self.map_hits = 0
+
+    def enabled(self) -> bool:
+        return bool(SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET)
+
+    def parse(self, query: str) -> Optional[tuple]:
+        """(tipo, id) si la consulta es un link o URI de Spotify"""
+        match = self.LINK_RE.search(query)
+        if not match:
+            return None
+        return match.group(1) or match.group(2), match.group(3)
+
+    def _get_client(self) -> spotipy.Spotify:
+        if self.client is None:
+            auth = SpotifyClientCredentials(client_id=SPOTIFY_CLIENT_ID, client_secret=SPOTIFY_CLIENT_SECRET)
+            if SPOTIFY_TOKEN_URL:
+                auth.OAUTH_TOKEN_URL = SPOTIFY_TOKEN_URL
+            self.client = spotipy.Spotify(auth_manager=auth, requests_timeout=10)
+            if SPOTIFY_API_URL:
+                self.client.prefix = SPOTIFY_API_URL.rstrip('/') + '/'
+        return self.client
+
+    async def _call(self, method: str, *args, **kwargs):
+        # spotipy es bloqueante: cada llamada HTTP va al executor
+        client = self._get_client()
+        self.api_calls += 1
+        return await bot.loop.run_in_executor(None, lambda: getattr(client, method)(*args, **kwargs))
+
+    def _remember(self, track: Dict) -> Dict:
+        meta = {
+            'id': track['id'],
+            'isrc': (track.get('external_ids') or {}).get('isrc'),
+            'title': track.get('name', ''),
+            'artists': ', '.join(artist['name'] for artist in track.get('artists', [])),
+            'duration': (track.get('duration_ms') or 0) // 1000,
+        }
+        self.metadata[meta['id']] = meta
+        self.metadata.move_to_end(meta['id'])
+        if len(self.metadata) > SPOTIFY_METADATA_CACHE:
+            self.metadata.popitem(last=False)
+        return meta
+
+    async def get_track(self, track_id: str) -> Optional[Dict]:
+        """Metadatos de una canción, agrupando el pedido con los demás en curso"""
+        if track_id in self.metadata:
+            self.metadata.move_to_end(track_id)
+            return self.metadata[track_id]
+        future = bot.loop.create_future()
+        self.waiting.setdefault(track_id, []).append(future)
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush())
+        return await future
+
+    async def _flush(self):
+        await asyncio.sleep(SPOTIFY_BATCH_WINDOW)
+        self.flush_task = None
+        waiting, self.waiting = self.waiting, {}
+        track_ids = list(waiting)
+        for i in range(0, len(track_ids), SPOTIFY_BATCH_SIZE):
+            chunk = track_ids[i:i + SPOTIFY_BATCH_SIZE]
+            try:
+                tracks = (await self._call('tracks', chunk)).get('tracks') or []
+            except Exception as e:
+                print(f"[Spotify] Error obteniendo {len(chunk)} canciones: {e}")
+                tracks = []
+            found = {track['id']: track for track in tracks if track}
+            for track_id in chunk:
+                meta = self._remember(found[track_id]) if track_id in found else None
+                for future in waiting[track_id]:
+                    if not future.done():
+                        future.set_result(meta)
+
+    async def expand(self, query: str) -> List[str]:
+        """IDs de las canciones de un link (una sola si es una canción)"""
+        kind, spotify_id = self.parse(query)
+        if kind == 'track':
+            return [spotify_id]
+        if not self.enabled():
+            print("[Spotify] Faltan SPOTIFY_CLIENT_ID/SPOTIFY_CLIENT_SECRET para álbumes y playlists")
+            return []
+
+        track_ids = []
+        try:
+            if kind == 'album':
+                # Las canciones de un álbum vienen sin ISRC: se completan luego por lotes
+                page = await self._call('album_tracks', spotify_id, limit=50)
+                while page:
+                    track_ids.extend(item['id'] for item in page['items'] if item.get('id'))
+                    if len(track_ids) >= SPOTIFY_MAX_TRACKS or not page.get('next'):
+                        break
+                    page = await self._call('next', page)
+                # Metadatos de todo el álbum por adelantado, en lotes de SPOTIFY_BATCH_SIZE
+                await asyncio.gather(*(self.get_track(track_id) for track_id in track_ids[:SPOTIFY_MAX_TRACKS]))
+            else:
+                # Las playlists traen la canción completa: no hace falta pedirla de nuevo
+                page = await self._call('playlist_items', spotify_id, limit=100, additional_types=('track',))
+                while page:
+                    for item in page['items']:
+                        track = item.get('track')
+                        if track and track.get('id'):
+                            self._remember(track)
+                            track_ids.append(track['id'])
+                    if len(track_ids) >= SPOTIFY_MAX_TRACKS or not page.get('next'):
+                        break
+                    page = await self._call('next', page)
+        except Exception as e:
+            print(f"[Spotify] Error expandiendo {kind} {spotify_id}: {e}")
+        return track_ids[:SPOTIFY_MAX_TRACKS]
+
+    def lookup_video(self, spotify_id: str, isrc: Optional[str] = None) -> Optional[str]:
+        db_cursor.execute('SELECT video_id FROM spotify_map WHERE spotify_id = ?', (spotify_id,))
+        row = db_cursor.fetchone()
+        if not row and isrc:
+            # Otra edición de la misma grabación (single, álbum, recopilatorio)
+            db_cursor.execute('SELECT video_id FROM spotify_map WHERE isrc = ? LIMIT 1', (isrc,))
+            row = db_cursor.fetchone()
+        return row[0] if row else None
+
+    def store_video(self, spotify_id: str, isrc: Optional[str], video_id: str):
+        db_cursor.execute('''
+        INSERT OR REPLACE INTO spotify_map (spotify_id, isrc, video_id, fecha) VALUES (?, ?, ?, ?)
+        ''', (spotify_id, isrc, video_id, datetime.now().isoformat()))
+        db_conn.commit()
+
+    async def resolve(self, spotify_id: str, gated: bool = False) -> Optional[Dict]:
+        video_id = self.lookup_video(spotify_id)
+        if video_id:
+            # Ya resuelta antes: ni Spotify ni búsqueda en YouTube
+            self.map_hits += 1
+            return await MusicPlayer.get_audio_source(f"https://www.youtube.com/watch?v={video_id}", gated)
+
+        if not self.enabled():
+            print("[Spotify] Faltan SPOTIFY_CLIENT_ID/SPOTIFY_CLIENT_SECRET")
+            return None
+        meta = await self.get_track(spotify_id)
+        if not meta:
+            return None
+
+        video_id = self.lookup_video(spotify_id, meta['isrc'])
+        if video_id:
+            self.map_hits += 1
+            self.store_video(spotify_id, meta['isrc'], video_id)
+            return await MusicPlayer.get_audio_source(f"https://www.youtube.com/watch?v={video_id}", gated)
+
+        song = await MusicPlayer.get_audio_source(f"{meta['artists']} - {meta['title']} audio", gated)
+        match = self.VIDEO_ID_RE.search((song or {}).get('webpage_url') or '')
+        if match:
+            self.store_video(spotify_id, meta['isrc'], match.group(1))
+        return song
+
+
+spotify_resolver = SpotifyResolver()
+
+async def expand_queries(queries: List[str]) -> List[str]:
+    """Reemplaza álbumes y playlists de Spotify por sus canciones"""
+    expanded = []
+    for query in queries:
+        link = spotify_resolver.parse(query)
+        if link and link[0] != 'track':
+            expanded.extend(f"spotify:track:{track_id}" for track_id in await spotify_resolver.expand(query))
+        else:
+            expanded.append(query)
+    return expanded
+
+def truncation_notice(total: int) -> Optional[str]:
+    """Aviso para un pedido que, ya expandido, supera PLAY_BATCH_MAX canciones"""
+    if total <= PLAY_BATCH_MAX:
+        return None
+    return f"✂️ El pedido tiene {total} canciones: sólo se añaden las primeras {PLAY_BATCH_MAX}"
+
+
+class LoudnessAnalyzer:
+    """Mide una vez la sonoridad integrada (EBU R128) de cada pista.
+
+    El resultado se guarda en la tabla `loudness` y en el propio dict de la
+    canción, y se aplica después como una ganancia fija `volume=XdB`, que no
+    cuesta prácticamente CPU frente a `dynaudnorm` en cada reproducción.
+    """
+
+    LUFS_PATTERN = re.compile(r"I:\s+(-?[\d.]+) LUFS")
+
+    def __init__(self):
+        self.cache: Dict[str, float] = {}
+        self.in_progress: set = set()
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.analyzed = 0
+
+    @staticmethod
+    def track_id(song: Dict) -> str:
+        return song.get('webpage_url') or song.get('local_path') or song['title']
+
+    def get_lufs(self, song: Dict) -> Optional[float]:
+        if song.get('lufs') is not None:
+            return song['lufs']
+        key = self.track_id(song)
+        if key not in self.cache:
+            db_cursor.execute('SELECT lufs FROM loudness WHERE track_id = ?', (key,))
+            row = db_cursor.fetchone()
+            if not row:
+                return None
+            self.cache[key] = row[0]
+        song['lufs'] = self.cache[key]
+        return song['lufs']
+
+    def filter_for(self, song: Dict) -> str:
+        lufs = self.get_lufs(song)
+        if lufs is None:
+            return LOUDNESS_FALLBACK
+        gain = max(-LOUDNESS_MAX_GAIN, min(LOUDNESS_MAX_GAIN, LOUDNESS_TARGET - lufs))
+        return f"volume={gain:.1f}dB"
+
+    def schedule(self, song: Dict):
+        """Lanza el análisis en segundo plano si la pista todavía no tiene medida"""
+        key = self.track_id(song)
+        if key in self.in_progress or self.get_lufs(song) is not None:
+            return
+        if (song.get('duration') or 0) > LOUDNESS_MAX_DURATION:
+            return
+        if admission.overloaded():
+            # Trabajo de fondo: se mide la próxima vez que suene, no a costa del audio actual
+            return
+        self.in_progress.add(key)
+        asyncio.create_task(self._analyze(key, song['url'], input_options(song)))
+
+    async def _analyze(self, key: str, url: str, before_options: str):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(LOUDNESS_MAX_JOBS)
+        try:
+            async with self.semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    FFMPEG_OPTIONS['executable'], '-nostats', '-hide_banner',
+                    *before_options.split(),
+                    '-i', url, '-vn', '-af', 'ebur128=framelog=quiet', '-f', 'null', '-',
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                _, stderr = await process.communicate()
+
+            matches = self.LUFS_PATTERN.findall(stderr.decode('utf-8', 'ignore'))
+            if process.returncode != 0 or not matches:
+                return
+            # El último valor es el del resumen final
+            lufs = float(matches[-1])
+            self.cache[key] = lufs
+            db_cursor.execute('''
+            INSERT OR REPLACE INTO loudness (track_id, lufs, fecha) VALUES (?, ?, ?)
+            ''', (key, lufs, datetime.now().isoformat()))
+            db_conn.commit()
+            self.analyzed += 1
+        except Exception as e:
+            print(f"[Loudness] Error analizando {key}: {e}")
+        finally:
+            self.in_progress.discard(key)
+
+
+loudness_analyzer = LoudnessAnalyzer()
+
+
+class TrackedSource(discord.AudioSource):
+    """Envuelve un AudioSource y cuenta los frames enviados para conocer la posición"""
+
+    def __init__(self, original: discord.AudioSource, start_at: float = 0.0):
+        self.original = original
+        self.start_at = start_at
+        self.frames = 0
+        self.exhausted = False  # True si ffmpeg dejó de entregar audio por sí solo
+
+    @property
+    def position(self) -> float:
+        return self.start_at + self.frames * FRAME_DURATION
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if data is OPUS_SILENCE:
+            # Relleno de RemoteAudioSource mientras el worker se atrasa: no avanza la pista
+            pass
+        elif data:
+            self.frames += 1
+        else:
+            self.exhausted = True
+        return data
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
+class PCMMixer(discord.AudioSource):
+    """Mezclador PCM por servidor: volumen, ducking y fundido entre pistas.
+
+    Decodifica con ffmpeg a PCM y aplica todo en proceso sobre frames de 20 ms
+    con operaciones vectorizadas de numpy sobre buffers preasignados, así
+    `!volume` y el ducking se aplican en el siguiente frame sin reiniciar
+    ffmpeg. Cerca del final de la pista abre la siguiente de la cola y las
+    funde durante `CROSSFADE_SECONDS`.
+    """
+
+    def __init__(self, guild_id: int, source: discord.AudioSource, song: Dict, start_at: float = 0.0):
+        self.guild_id = guild_id
+        self.source = source
+        self.song = song
+        self.start_frames = int(start_at / FRAME_DURATION)
+        self.frames = 0
+        self.next_source: Optional[discord.AudioSource] = None
+        self.next_song: Optional[Dict] = None
+        self.fade_frames = max(1, int(CROSSFADE_SECONDS / FRAME_DURATION))
+        self.fade_index = 0
+        self.prefetch_requested = CROSSFADE_SECONDS <= 0
+        self.on_advance = None
+
+        # Buffers preasignados: el camino por frame no crea arrays nuevos
+        self._current = np.zeros(PCM_FRAME_SAMPLES, dtype=np.float32)
+        self._next = np.zeros(PCM_FRAME_SAMPLES, dtype=np.float32)
+        self._gain = np.zeros(PCM_FRAME_SAMPLES, dtype=np.float32)
+        self._out = np.zeros(PCM_FRAME_SAMPLES, dtype=np.int16)
+        self._ramp = np.repeat(np.linspace(0, 1, PCM_FRAME_SAMPLES // 2, endpoint=False, dtype=np.float32), 2)
+        self._last_gain = self._target_gain()
+
+    def is_opus(self) -> bool:
+        return False
+
+    def _target_gain(self) -> float:
+        return current_gain(self.guild_id)
+
+    def _remaining_frames(self) -> float:
+        duration = self.song.get('duration') or 0
+        if not duration:
+            return float('inf')
+        return duration / FRAME_DURATION - self.start_frames - self.frames
+
+    @staticmethod
+    def _load(source: discord.AudioSource, buffer) -> bool:
+        data = source.read()
+        if len(data) != PCM_FRAME_BYTES:
+            return False
+        np.copyto(buffer, np.frombuffer(data, dtype=np.int16))
+        return True
+
+    def _apply_ramp(self, buffer, start: float, end: float):
+        # buffer *= start + (end - start) * rampa, muestra a muestra
+        np.multiply(self._ramp, end - start, out=self._gain)
+        np.add(self._gain, start, out=self._gain)
+        np.multiply(buffer, self._gain, out=buffer)
+
+    def _advance(self):
+        """La pista siguiente pasa a ser la actual sin cortar el reproductor"""
+        self.source.cleanup()
+        consumed = self.fade_index
+        self.source, self.song = self.next_source, self.next_song
+        self.next_source = self.next_song = None
+        self.start_frames = 0
+        self.frames = consumed
+        self.fade_index = 0
+        self.prefetch_requested = False
+        if self.on_advance:
+            self.on_advance(self.song, consumed)
+
+    def read(self) -> bytes:
+        if not self._load(self.source, self._current):
+            if self.next_source is None:
+                return b''
+            self._advance()
+            if not self._load(self.source, self._current):
+                return b''
+        self.frames += 1
+
+        remaining = self._remaining_frames()
+        if not self.prefetch_requested and remaining <= self.fade_frames + PREFETCH_LEAD / FRAME_DURATION:
+            self.prefetch_requested = True
+            asyncio.run_coroutine_threadsafe(prefetch_next(self), bot.loop)
+
+        if self.next_source is not None and remaining <= self.fade_frames:
+            if self._load(self.next_source, self._next):
+                start = self.fade_index / self.fade_frames
+                end = min(1.0, (self.fade_index + 1) / self.fade_frames)
+                self._apply_ramp(self._current, 1 - start, 1 - end)
+                self._apply_ramp(self._next, start, end)
+                np.add(self._current, self._next, out=self._current)
+                self.fade_index += 1
+                if self.fade_index >= self.fade_frames:
+                    self._advance()
+
+        target = self._target_gain()
+        self._apply_ramp(self._current, self._last_gain, target)
+        self._last_gain = target
+
+        np.clip(self._current, -32768, 32767, out=self._current)
+        np.copyto(self._out, self._current, casting='unsafe')
+        return self._out.tobytes()
+
+    def cleanup(self):
+        self.source.cleanup()
+        if self.next_source is not None:
+            self.next_source.cleanup()
+            self.next_source = None
+
+
+def mixer_available() -> bool:
+    return MIXER_ENABLED and np is not None
+
+
+def input_options(song: Dict) -> str:
+    # Las opciones -reconnect son del protocolo HTTP: un archivo local no las necesita
+    return '' if song.get('local_path') else FFMPEG_OPTIONS['before_options']
+
+def output_options(song: Dict, latency: float = 0.0) -> str:
+    """Opciones de salida de ffmpeg: perfil de `!quality`, bitrate adaptativo y ganancia"""
+    options = FFMPEG_OPTIONS['options']
+    if latency > 0.3:
+        options = '-vn -b:a 96k'
+    return options.replace('{loudness}', loudness_analyzer.filter_for(song))
+
+def pcm_output_options(options: str) -> str:
+    # Salida PCM cruda: se conservan filtros y formato, no el códec ni el bitrate
+    return re.sub(r'\s*-(?:c:a|b:a)\s+\S+', '', options)
+
+def output_bitrate(options: str) -> int:
+    """Bitrate Opus en kbps pedido por las opciones de salida (128 si no dicen nada)"""
+    match = re.search(r'-b:a\s+(\d+)k', options)
+    return int(match.group(1)) if match else 128
+
+def pcm_source(song: Dict, before_options: str, options: Optional[str] = None) -> discord.FFmpegPCMAudio:
+    # El mezclador necesita PCM crudo
+    options = pcm_output_options(options or output_options(song))
+    return discord.FFmpegPCMAudio(
+        song['url'],
+        executable=FFMPEG_OPTIONS['executable'],
+        before_options=before_options,
+        options=options
+    )
+
+
+async def ensure_stream_url(song: Dict):
+    if song.get('local_path'):
+        if not os.path.exists(song['local_path']):
+            raise RuntimeError(f"El archivo '{song['local_path']}' ya no existe")
+        song['url'] = song['local_path']
+        return
+    if not song.get('url'):
+        # Canción restaurada de un snapshot: la URL firmada se resuelve recién ahora
+        fresh = await MusicPlayer.get_audio_source(song.get('webpage_url') or song['title'])
+        if not fresh:
+            raise RuntimeError(f"No se pudo resolver '{song['title']}'")
+        song['url'] = fresh['url']
+        song['resolved_at'] = fresh['resolved_at']
+
+
+async def prefetch_next(mixer: PCMMixer):
+    """Abre la siguiente canción de la cola para el fundido"""
+    guild_id = mixer.guild_id
+    if music_queue.get_loop_mode(guild_id) == 'song':
+        return
+    queue = music_queue.get_queue(guild_id)
+    if not queue:
+        return
+    song = queue[0]
+    try:
+        await ensure_stream_url(song)
+        source = pcm_source(song, input_options(song))
+    except Exception as e:
+        print(f"[Mixer] No se pudo precargar '{song.get('title')}': {e}")
+        return
+    loudness_analyzer.schedule(song)
+    mixer.next_song = song
+    mixer.next_source = source
+
+
+async def advance_track(guild_id: int, song: Dict):
+    """Actualiza cola, historial y presencia cuando el mezclador pasa a la siguiente pista"""
+    voice_client = discord.utils.get(bot.voice_clients, guild=bot.get_guild(guild_id))
+    queue = await music_queue.safe_get_queue(guild_id)
+    previous = music_queue.current.get(guild_id)
+    if song in queue:
+        queue.remove(song)
+    if music_queue.get_loop_mode(guild_id) == 'queue' and previous:
+        queue.append(previous)
+    if voice_client:
+        register_now_playing(guild_id, voice_client, song)
+    presence_manager.request()
+
+
+def should_resume(song: Dict, source: TrackedSource, error) -> bool:
+    """Decide si un corte fue un fallo del stream y no el final real de la pista"""
+    if not source.exhausted and not error:
+        return False  # Detenido a propósito (skip/stop)
+    duration = song.get('duration') or 0
+    if not duration:
+        return bool(error)
+    return source.position < duration - RESUME_TOLERANCE
+
+
+async def start_playback(guild_id: int, voice_client: discord.VoiceClient, song: Dict, start_at: float = 0.0):
+    """Lanza ffmpeg para `song` desde `start_at` segundos y conecta el callback de fin"""
+    await ensure_stream_url(song)
+
+    adaptive_options = FFMPEG_OPTIONS.copy()
+    adaptive_options['before_options'] = input_options(song)
+    adaptive_options['options'] = output_options(song, voice_client.latency)
+    if start_at == 0:
+        loudness_analyzer.schedule(song)
+    if start_at > 0:
+        # -ss del lado de la entrada: ffmpeg salta sin decodificar lo anterior
+        adaptive_options['before_options'] = f"-ss {start_at:.2f} {adaptive_options['before_options']}"
+
+    if audio_workers.enabled():
+        # Decodificación y codificación Opus en un proceso de audio aparte
+        # El worker codifica él mismo: recibe PCM y el bitrate pedido aparte
+        source = audio_workers.open_stream(
+            guild_id, song['url'], adaptive_options['before_options'],
+            pcm_output_options(adaptive_options['options']), current_gain(guild_id),
+            output_bitrate(adaptive_options['options'])
+        )
+        tracked = TrackedSource(source, start_at)
+        music_queue.sources[guild_id] = tracked
+        voice_client.play(tracked, after=lambda e: asyncio.run_coroutine_threadsafe(on_track_end(guild_id, tracked, e), bot.loop))
+        return
+
+    if mixer_available():
+        mixer = PCMMixer(guild_id, pcm_source(song, adaptive_options['before_options'], adaptive_options['options']),
+                         song, start_at)
+        tracked = TrackedSource(mixer, start_at)
+
+        def on_advance(next_song: Dict, consumed_frames: int):
+            # Corre en el hilo de audio: la posición pasa a ser la de la nueva pista
+            tracked.start_at = 0.0
+            tracked.frames = consumed_frames
+            asyncio.run_coroutine_threadsafe(advance_track(guild_id, next_song), bot.loop)
+
+        mixer.on_advance = on_advance
+        music_queue.sources[guild_id] = tracked
+        voice_client.play(tracked, after=lambda e: asyncio.run_coroutine_threadsafe(on_track_end(guild_id, tracked, e), bot.loop))
+        return
+
+    try:
+        source = await discord.FFmpegOpusAudio.from_probe(
+            song['url'],
+            **adaptive_options,
+            method='fallback'
+        )
+    except:
+        source = discord.FFmpegPCMAudio(
+            song['url'],
+            **adaptive_options
+        )
+
+    if hasattr(source, '_player'):
+        source._player.opus_encoder.set_bitrate(128000)
+        source._player.buffer_size = 960 * 5
+
+    tracked = TrackedSource(source, start_at)
+    music_queue.sources[guild_id] = tracked
+    voice_client.play(tracked, after=lambda e: asyncio.run_coroutine_threadsafe(on_track_end(guild_id, tracked, e), bot.loop))
+
+
+async def on_track_end(guild_id: int, source: TrackedSource, error=None):
+    """Callback de fin de pista: reanuda si el stream se cayó, si no pasa a la siguiente"""
+    song = music_queue.current.get(guild_id)
+    if music_queue.sources.get(guild_id) is source:
+        del music_queue.sources[guild_id]
+
+    attempts = music_queue.resume_attempts.get(guild_id, 0)
+    if song and attempts < MAX_RESUME_ATTEMPTS and should_resume(song, source, error):
+        music_queue.resume_attempts[guild_id] = attempts + 1
+        if await resume_track(guild_id, song, source.position):
+            return
+    await play_next(guild_id, error)
+
+
+async def resume_track(guild_id: int, song: Dict, position: float) -> bool:
+    """Vuelve a resolver la URL firmada y reinicia ffmpeg en la última posición"""
+    voice_client = discord.utils.get(bot.voice_clients, guild=bot.get_guild(guild_id))
+    if not voice_client or not voice_client.is_connected():
+        return False
+
+    print(f"[Resume] Stream caído en {guild_id}, reanudando '{song['title']}' en {position:.1f}s")
+    if song.get('local_path'):
+        fresh = {'url': song['local_path'], 'resolved_at': time.time()}
+    else:
+        fresh = await MusicPlayer.get_audio_source(song.get('webpage_url') or song['title'])
+    if not fresh:
+        return False
+
+    song['url'] = fresh['url']
+    song['resolved_at'] = fresh['resolved_at']
+    try:
+        await start_playback(guild_id, voice_client, song, start_at=position)
+        return True
+    except Exception:
+        print(f"Error al reanudar: {traceback.format_exc()}")
+        return False
+
+def register_now_playing(guild_id: int, voice_client: discord.VoiceClient, song: Dict):
+    music_queue.current[guild_id] = song
+    music_queue.resume_attempts[guild_id] = 0
+    
+    # Anunciar canción si fue por autoplay
+    if song.get("requested_by") == "Autoplay":
+        channel = voice_client.channel
+        message_scheduler.post(channel, f"🎶 Reproduciendo sugerencia por autoplay: **{song['title']}**", key="nowplaying")
+
+    
+    # Registrar en historial
+    if guild_id not in song_history:
+        song_history[guild_id] = []
+
+    song_history[guild_id].append(song)
+    title_index.add_track(guild_id, song)
+    music_panels.song_started(guild_id, song)
+
+    # Limitar historial a 10 canciones
+    if len(song_history[guild_id]) > 20:
+        song_history[guild_id].pop(0)
+
+
+async def play_next(guild_id: int, error=None):
+    voice_client = discord.utils.get(bot.voice_clients, guild=bot.get_guild(guild_id))
+    
+    if error:
+        print(f"Error en reproducción: {error}")
+        music_queue.set_playing(guild_id, False)
+    
+    if not voice_client or not voice_client.is_connected():
+        music_queue.set_playing(guild_id, False)
+        return
+
+    idle_reaper.mark_active(guild_id)
+    await asyncio.sleep(1.5)
+    
+    loop_mode = music_queue.get_loop_mode(guild_id)
+    current_song = music_queue.current.get(guild_id, None)
+    
+    # Manejo de loops
+    if loop_mode == 'song' and current_song:
+        queue = await music_queue.safe_get_queue(guild_id)
+        queue.appendleft(current_song)
+    
+    queue = await music_queue.safe_get_queue(guild_id)
+    
+    if not queue:
+        if loop_mode == 'queue' and current_song:
+            queue.append(current_song)
+        else:
+    # Autoplay activado
+            if music_queue.is_autoplay(guild_id) and current_song:
+                related = await get_related_song(current_song['title'])
+                if related:
+                    queue.append(related)
+                    return await play_next(guild_id)
+
+            music_queue.set_playing(guild_id, False)
+            presence_manager.request()
+            await asyncio.sleep(1)
+            queue = await music_queue.safe_get_queue(guild_id)
+            if not queue:
+                channel = voice_client.channel
+                message_scheduler.post(channel, f"🛑 No hay más canciones en la cola. Me desconectaré en {DISCONNECT_AFTER} segundos...", key="idle")
+                idle_reaper.mark_idle(guild_id)
+                music_panels.refresh(guild_id)
+                return
+    
+    next_song = queue.popleft()
+    register_now_playing(guild_id, voice_client, next_song)
+    
+    music_queue.set_playing(guild_id, True)
+    
+    try:
+        await start_playback(guild_id, voice_client, next_song, start_at=next_song.pop('resume_at', 0.0))
+        presence_manager.request()
+        
+    except Exception as e:
+        print(f"Error al reproducir: {traceback.format_exc()}")
+        music_queue.set_playing(guild_id, False)
+        await asyncio.sleep(2)
+        await play_next(guild_id)
+
+
+# ------------------------------------------
+# Workers de audio
+# ------------------------------------------
+
+class RemoteAudioSource(discord.AudioSource):
+    """Frames Opus producidos por un worker; el proceso principal sólo los envía"""
+
+    def __init__(self, worker: 'AudioWorker', stream_id: int, frames: queue_module.Queue):
+        self.worker = worker
+        self.stream_id = stream_id
+        self.frames = frames
+        self.consumed = 0
+        self.finished = False
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        if self.finished:
+            return b''
+        try:
+            packet = self.frames.get(timeout=WORKER_READ_TIMEOUT)
+        except queue_module.Empty:
+            return OPUS_SILENCE
+        if packet is None:
+            self.finished = True
+            return b''
+        self.consumed += 1
+        if self.consumed % WORKER_CREDIT_BATCH == 0:
+            self.worker.send('credit', self.stream_id, WORKER_CREDIT_BATCH)
+        return packet
+
+    def set_gain(self, gain: float):
+        self.worker.send('gain', self.stream_id, gain)
+
+    def cleanup(self):
+        self.worker.send('stop', self.stream_id)
+        self.worker.streams.pop(self.stream_id, None)
+
+
+class AudioWorker:
+    """Proceso de audio y el hilo que reparte sus frames a cada stream"""
+
+    def __init__(self, index: int):
+        self.index = index
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        # El target vive en audio_worker.py y start_detached evita que el hijo reejecute main.py
+        self.process = context.Process(target=audio_worker_main,
+                                       args=(child_conn, FFMPEG_OPTIONS['executable'], WORKER_BUFFER_FRAMES),
+                                       daemon=True, name=f"audio-worker-{index}")
+        start_detached(self.process)
+        child_conn.close()
+        self.streams: Dict[int, queue_module.Queue] = {}
+        self.send_lock = threading.Lock()
+        self.last_pong = time.monotonic()
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def _reader(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == 'frame':
+                frames = self.streams.get(message[1])
+                if frames is not None:
+                    frames.put(message[2])
+            elif kind == 'end':
+                frames = self.streams.get(message[1])
+                if frames is not None:
+                    frames.put(None)
+            elif kind == 'pong':
+                self.last_pong = time.monotonic()
+        self._end_all()
+
+    def _end_all(self):
+        # Los streams cortados terminan y la recuperación los reanuda en otro worker
+        for frames in list(self.streams.values()):
+            frames.put(None)
+
+    def send(self, *message):
+        try:
+            with self.send_lock:
+                self.conn.send(message)
+        except (OSError, ValueError):
+            pass
+
+    def open_stream(self, stream_id: int, url: str, before_options: str, options: str, gain: float,
+                    bitrate: int) -> RemoteAudioSource:
+        frames = queue_module.Queue()
+        self.streams[stream_id] = frames
+        self.send('start', stream_id, url, before_options, options, gain, bitrate)
+        return RemoteAudioSource(self, stream_id, frames)
+
+    def healthy(self) -> bool:
+        return self.process.is_alive() and time.monotonic() - self.last_pong < WORKER_HEALTH_INTERVAL * 3
+
+    def terminate(self):
+        self.process.terminate()
+        self.conn.close()
+        self._end_all()
+
+
+class AudioWorkerPool:
+    """Reparte la reproducción de cada servidor a un proceso de audio fijo"""
+
+    def __init__(self, size: int = AUDIO_WORKERS):
+        self.size = size
+        self.workers: List[Optional[AudioWorker]] = [None] * size
+        self.stream_ids = itertools.count(1)
+        self.respawns = 0
+
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def for_guild(self, guild_id: int) -> AudioWorker:
+        index = guild_id % self.size
+        if self.workers[index] is None:
+            self.workers[index] = AudioWorker(index)
+        return self.workers[index]
+
+    def open_stream(self, guild_id: int, url: str, before_options: str, options: str, gain: float,
+                    bitrate: int) -> RemoteAudioSource:
+        return self.for_guild(guild_id).open_stream(next(self.stream_ids), url, before_options, options, gain, bitrate)
+
+    def check_health(self):
+        for index, worker in enumerate(self.workers):
+            if worker is None:
+                continue
+            if worker.healthy():
+                worker.send('ping')
+                continue
+            print(f"[AudioWorker] Worker {index} sin respuesta, reiniciando")
+            worker.terminate()
+            self.workers[index] = AudioWorker(index)
+            self.respawns += 1
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker:
+                worker.terminate()
+
+
+audio_workers = AudioWorkerPool()
+
+@tasks.loop(seconds=WORKER_HEALTH_INTERVAL)
+async def worker_health_loop():
+    audio_workers.check_health()
+
+
+def current_gain(guild_id: int) -> float:
+    gain = music_queue.volumes.get(guild_id, 1.0)
+    if music_queue.ducked.get(guild_id):
+        gain *= DUCK_LEVEL
+    return gain
+
+
+def push_gain(guild_id: int):
+    """Aplica volumen/ducking al stream remoto activo, si lo hay"""
+    tracked = music_queue.sources.get(guild_id)
+    if tracked and isinstance(tracked.original, RemoteAudioSource):
+        tracked.original.set_gain(current_gain(guild_id))
+
+
+# ------------------------------------------
+# Comandos de Música
+# ------------------------------------------
+
+def split_queries(query: str) -> List[str]:
+    """Separa un setlist pegado en varias líneas o con `;`"""
+    return [part.strip() for part in re.split(r'[;\n]', query) if part.strip()]
+
+async def resolve_queries(queries: List[str]):
+    """Resuelve las consultas en paralelo y las entrega en el orden original.
+
+    Todas las extracciones arrancan juntas (acotadas por un semáforo), pero
+    cada resultado se entrega recién cuando terminaron los anteriores: el
+    primero sale apenas se resuelve y el total tarda lo que la más lenta.
+    """
+    semaphore = asyncio.Semaphore(PLAY_BATCH_CONCURRENCY)
+
+    async def resolve(query: str) -> Optional[Dict]:
+        async with semaphore:
+            return await MusicPlayer.get_audio_source(query, gated=True)
+
+    pending = [asyncio.create_task(resolve(query)) for query in queries]
+    try:
+        for query, task in zip(queries, pending):
+            yield query, await task
+    finally:
+        for task in pending:
+            task.cancel()
+
+@bot.command(name="play", aliases=["p"])
+async def play(ctx, *, query: str):
+    """Reproduce música desde YouTube o la añade a la cola (varias canciones separadas por línea o `;`)"""
+    if not ctx.author.voice:
+        return await ctx.send("🚨 Debes estar en un canal de voz para usar este comando!")
+
+    queries = split_queries(query)
+    if not queries:
+        return await ctx.send("❌ Indica qué canción quieres escuchar")
+    if len(queries) > PLAY_BATCH_MAX:
+        return await ctx.send(f"❌ Máximo {PLAY_BATCH_MAX} canciones por comando")
+
+    try:
+        # El tope y el costo de admisión se aplican a la lista expandida: un link de playlist no los evade
+        queries = await expand_queries(queries)
+        notice = truncation_notice(len(queries))
+        queries = queries[:PLAY_BATCH_MAX]
+
+        rejection = await admission.admit(
+            ctx.guild, ctx.author.id, len(queries),
+            notify=lambda eta: ctx.send(f"⏳ Hay mucha demanda: tu pedido empieza en ~{math.ceil(eta)}s")
+        )
+        if rejection:
+            return await ctx.send(rejection)
+        if notice:
+            await ctx.send(notice)
+
+        # Cancelar cualquier desconexión pendiente primero
+        idle_reaper.mark_active(ctx.guild.id)
+
+        status = await ctx.send(f"🔎 Buscando {len(queries)} canciones...") if len(queries) > 1 else None
+        started = None
+        added: List[Dict] = []
+        failed: List[str] = []
+
+        async for query_text, data in resolve_queries(queries):
+            if not data:
+                failed.append(query_text)
+                continue
+            data["requested_by"] = ctx.author.display_name
+
+            # Empezar a reproducir en cuanto llega la primera canción
+            result = await enqueue_song(ctx.guild, ctx.author, data)
+            if result is None:
+                return await ctx.send("🚨 Saliste del canal de voz: se canceló el pedido")
+            added.append(data)
+            if result:
+                started = data
+
+        if status is None:
+            if not added:
+                return await ctx.send("❌ No se pudo encontrar el video o la canción")
+            if started:
+                return await ctx.send(f"🎶 **Reproduciendo:** {started['title']}")
+            return await ctx.send(f"🎵 **Añadido a la cola:** {added[0]['title']}")
+
+        lines = []
+        if started:
+            lines.append(f"🎶 **Reproduciendo:** {started['title']}")
+        queued = [song for song in added if song is not started]
+        if queued:
+            lines.append(f"🎵 **Añadidas a la cola ({len(queued)}):**")
+            lines.extend(f"{i}. {song['title']}" for i, song in enumerate(queued[:PLAY_BATCH_MAX], 1))
+        if failed:
+            lines.append(f"❌ Sin resultados: {', '.join(failed)}"[:300])
+        await status.edit(content="\n".join(lines) or "❌ No se pudo encontrar ninguna canción")
+
+    except Exception as e:
+        await ctx.send("❌ Error al reproducir")
+        print(f"Error en play: {traceback.format_exc()}")
+
+@bot.command(name="skip")
+async def skip(ctx):
+    """Salta la canción actual"""
+    voice_client = ctx.voice_client
+    if not voice_client:
+        return await ctx.send("❌ No estoy conectado a un canal de voz")
+    
+    queue = await music_queue.safe_get_queue(ctx.guild.id)
     if not queue and not music_queue.get_playing(ctx.guild.id):
         return await ctx.send("❌ No hay música en la cola")
     
     if voice_client.is_playing() or voice_client.is_paused():
         await ctx.send("⏭️ Saltando canción...")
         await asyncio.sleep(1.5)
-        await music_queue.cancel_disconnect_timer(ctx.guild.id)  # <-- añadido
+        idle_reaper.mark_active(ctx.guild.id)
         voice_client.stop()
     else:
         if queue:
             await ctx.send("⏭️ Saltando a la siguiente canción...")
-            await music_queue.cancel_disconnect_timer(ctx.guild.id)  # <-- añadido
+            idle_reaper.mark_active(ctx.guild.id)
             await play_next(ctx.guild.id)
         else:
             await ctx.send("❌ No hay música reproduciéndose")
@@ -443,7 +2417,7 @@ async def stop(ctx):
             return
             
         music_queue.clear(ctx.guild.id)
-        await music_queue.cancel_disconnect_timer(ctx.guild.id)
+        idle_reaper.mark_active(ctx.guild.id)
         if voice_client.is_playing():
             voice_client.stop()
         await voice_client.disconnect()
@@ -483,9 +2457,41 @@ async def set_quality(ctx, quality: str = 'medium'):
     if quality not in AUDIO_QUALITIES:
         return await ctx.send("❌ Calidad no válida. Usa low/medium/high")
     
-    FFMPEG_OPTIONS['options'] = AUDIO_QUALITIES[quality]['options']
+    # El bitrate va en las opciones: lo usan ffmpeg (Opus) y el encoder de los workers
+    FFMPEG_OPTIONS['options'] = f"{AUDIO_QUALITIES[quality]['options']} -b:a {AUDIO_QUALITIES[quality]['bitrate']}"
     await ctx.send(f"✅ Calidad establecida a **{quality}** (Bitrate: {AUDIO_QUALITIES[quality]['bitrate']})")
 
+@bot.command(name="volume", aliases=["vol"])
+async def volume(ctx, porcentaje: int = None):
+    """Ajusta el volumen al instante (0-200%)"""
+    if not mixer_available() and not audio_workers.enabled():
+        return await ctx.send("❌ El control de volumen en vivo no está disponible (falta numpy)")
+    
+    if porcentaje is None:
+        actual = int(music_queue.volumes.get(ctx.guild.id, 1.0) * 100)
+        return await ctx.send(f"🔊 Volumen actual: **{actual}%**")
+    
+    if porcentaje < 0 or porcentaje > MAX_VOLUME:
+        return await ctx.send(f"❌ El volumen debe estar entre 0 y {MAX_VOLUME}")
+    
+    music_queue.volumes[ctx.guild.id] = porcentaje / 100
+    push_gain(ctx.guild.id)
+    await ctx.send(f"🔊 Volumen ajustado a **{porcentaje}%**")
+
+@bot.command(name="duck")
+async def duck(ctx, modo: str = None):
+    """Baja temporalmente la música (on/off)"""
+    if not mixer_available() and not audio_workers.enabled():
+        return await ctx.send("❌ El ducking no está disponible (falta numpy)")
+    
+    if modo not in ["on", "off"]:
+        estado = "activado" if music_queue.ducked.get(ctx.guild.id) else "desactivado"
+        return await ctx.send(f"🔉 Ducking actualmente **{estado}**. Usa `!duck on` o `!duck off`.")
+    
+    music_queue.ducked[ctx.guild.id] = modo == "on"
+    push_gain(ctx.guild.id)
+    await ctx.send(f"✅ Ducking {'activado' if modo == 'on' else 'desactivado'}")
+
 @bot.command(name="pause")
 async def pause(ctx):
     """Pausa la reproducción actual"""
@@ -542,7 +2548,7 @@ async def playlist_command(ctx, action: str = None, *, name: str = None):
         return await ctx.send(
             "📋 **Uso de listas de reproducción:**\n"
             "`!playlist save <nombre>` - Guarda la cola actual como playlist\n"
-            "`!playlist load <nombre>` - Carga una playlist\n"
+            "`!playlist load <nombre>` - Carga una playlist (sugiere nombres parecidos)\n"
             "`!playlist list` - Muestra tus playlists\n"
             "`!playlist delete <nombre>` - Elimina una playlist"
         )
@@ -562,13 +2568,21 @@ async def playlist_command(ctx, action: str = None, *, name: str = None):
             await ctx.send("❌ No se pudo guardar la playlist (cola vacía)")
     
     elif action == "load" and name:
+        name = title_index.find_playlist(ctx.guild.id, name) or name
         playlist = await music_queue.load_playlist(ctx.guild.id, name)
         if not playlist:
-            return await ctx.send(f"❌ No se encontró la playlist **{name}**")
+            # Un nombre aproximado nunca se carga solo: se sugiere y el usuario lo confirma
+            suggestion = title_index.suggest_playlist(ctx.guild.id, name)
+            hint = f" ¿Quisiste decir **{suggestion}**? Usa `!playlist load {suggestion}`" if suggestion else ""
+            return await ctx.send(f"❌ No se encontró la playlist **{name}**.{hint}")
         
         if not ctx.author.voice:
             return await ctx.send("🚨 Debes estar en un canal de voz para cargar una playlist!")
         
+        rejection = await admission.admit(ctx.guild, ctx.author.id)
+        if rejection:
+            return await ctx.send(rejection)
+        
         voice_client = ctx.voice_client or await ctx.author.voice.channel.connect()
         
         # Añadir todas las canciones de la playlist
@@ -623,17 +2637,24 @@ async def history(ctx, cantidad: int = 5):
 
 
 @bot.command(name="replay")
-async def replay(ctx, indice: int):
-    """Vuelve a reproducir una canción del historial (!replay <número>)"""
-    history_list = song_history.get(ctx.guild.id, [])
-    if not history_list:
-        return await ctx.send("❌ No hay canciones en el historial.")
+async def replay(ctx, *, consulta: str):
+    """Vuelve a reproducir una canción ya escuchada (!replay <número> o !replay <título>)"""
+    if consulta.isdigit():
+        history_list = song_history.get(ctx.guild.id, [])
+        if not history_list:
+            return await ctx.send("❌ No hay canciones en el historial.")
 
-    if indice < 1 or indice > min(10, len(history_list)):
-        return await ctx.send(f"❌ Índice inválido. Usa `!history` para ver el historial.")
+        indice = int(consulta)
+        if indice < 1 or indice > min(10, len(history_list)):
+            return await ctx.send(f"❌ Índice inválido. Usa `!history` para ver el historial.")
 
-    # Obtener la canción desde el historial más reciente
-    song = list(reversed(history_list[-10:]))[indice - 1]
+        # Obtener la canción desde el historial más reciente
+        song = list(reversed(history_list[-10:]))[indice - 1]
+    else:
+        # Coincidencia aproximada sobre todo lo reproducido: sin nueva búsqueda en YouTube
+        song = title_index.find_track(ctx.guild.id, consulta)
+        if not song:
+            return await ctx.send("❌ No encontré ninguna canción parecida entre las ya reproducidas.")
 
     if not ctx.author.voice:
         return await ctx.send("🚨 Debes estar en un canal de voz para usar este comando.")
@@ -660,25 +2681,469 @@ async def autoplay(ctx, modo: str = None):
     music_queue.set_autoplay(ctx.guild.id, activar)
     await ctx.send(f"✅ Autoplay {'activado' if activar else 'desactivado'}")
 
+# --------------------------
+# Comandos de música (slash) y panel de control
+# --------------------------
+
+def format_duration(seconds) -> str:
+    seconds = int(seconds or 0)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}" if seconds >= 3600 else f"{seconds // 60}:{seconds % 60:02d}"
+
+def build_queue_embed(guild_id: int) -> discord.Embed:
+    guild = bot.get_guild(guild_id)
+    voice_client = guild.voice_client if guild else None
+    current = music_queue.current.get(guild_id)
+    queue = music_queue.get_queue(guild_id)
+
+    embed = discord.Embed(title="🎶 Cola de reproducción", color=discord.Color.blurple())
+    if current:
+        estado = "⏸️ En pausa" if voice_client and voice_client.is_paused() else "▶️ Reproduciendo"
+        embed.description = (
+            f"{estado}: **{current['title']}**\n"
+            f"⏱️ {format_duration(music_queue.get_position(guild_id))} / {format_duration(current.get('duration'))}"
+            f" — 🎧 {current.get('requested_by', 'Desconocido')}"
+        )
+    else:
+        embed.description = "⏹️ No hay nada reproduciéndose"
+
+    if queue:
+        lines = [f"{i}. {song['title']} ({format_duration(song.get('duration'))})" for i, song in enumerate(list(queue)[:10], 1)]
+        if len(queue) > 10:
+            lines.append(f"... y {len(queue) - 10} más")
+        embed.add_field(name=f"En cola ({len(queue)})", value="\n".join(lines)[:1024], inline=False)
+
+    loop_labels = {'none': 'desactivado', 'song': '🔂 canción', 'queue': '🔁 cola'}
+    embed.set_footer(
+        text=f"Loop: {loop_labels[music_queue.get_loop_mode(guild_id)]} | "
+             f"Autoplay: {'activado' if music_queue.is_autoplay(guild_id) else 'desactivado'} | "
+             f"Total en cola: {format_duration(sum(song.get('duration') or 0 for song in queue))}"
+    )
+    return embed
+
+
+class MusicPanels:
+    """Un mensaje de control por servidor que se edita en lugar de enviar mensajes nuevos.
+
+    Los cambios de pista y de cola se agrupan durante `PANEL_REFRESH_DELAY`
+    segundos en una sola edición. El mensaje se edita con el token del bot,
+    así sigue vivo después de que caduca el de la interacción que lo creó.
+    """
+
+    def __init__(self):
+        self.messages: Dict[int, tuple] = {}       # guild_id -> (channel_id, message_id)
+        self.pending: Dict[int, asyncio.Task] = {}
+        self.announcements: Dict[int, tuple] = {}  # id(canción) -> (interacción, plazo)
+        self.edits = 0
+
+    def attach(self, guild_id: int, message: discord.Message):
+        self.messages[guild_id] = (message.channel.id, message.id)
+
+    def jump_url(self, guild_id: int, channel_id: int) -> Optional[str]:
+        entry = self.messages.get(guild_id)
+        if not entry or entry[0] != channel_id:
+            return None
+        return f"https://discord.com/channels/{guild_id}/{entry[0]}/{entry[1]}"
+
+    def refresh(self, guild_id: int):
+        if guild_id not in self.messages or guild_id in self.pending:
+            return
+        self.pending[guild_id] = asyncio.create_task(self._edit(guild_id))
+
+    async def _edit(self, guild_id: int):
+        try:
+            await asyncio.sleep(PANEL_REFRESH_DELAY)
+        finally:
+            # Un cambio durante la edición programa otra
+            self.pending.pop(guild_id, None)
+        entry = self.messages.get(guild_id)
+        channel = bot.get_channel(entry[0]) if entry else None
+        if not channel:
+            self.messages.pop(guild_id, None)
+            return
+        try:
+            await channel.get_partial_message(entry[1]).edit(embed=build_queue_embed(guild_id), view=MusicPanel())
+            self.edits += 1
+        except discord.NotFound:
+            self.messages.pop(guild_id, None)
+        except discord.HTTPException as e:
+            print(f"[Panel] Error editando panel en {guild_id}: {e}")
+
+    def announce_when_playing(self, song: Dict, interaction: discord.Interaction):
+        """Edita la respuesta del slash cuando la canción encolada empieza a sonar"""
+        now = time.monotonic()
+        for key in [key for key, (_, deadline) in self.announcements.items() if deadline < now]:
+            del self.announcements[key]
+        self.announcements[id(song)] = (interaction, now + INTERACTION_EDIT_TTL)
+
+    def song_started(self, guild_id: int, song: Dict):
+        entry = self.announcements.pop(id(song), None)
+        if entry and time.monotonic() < entry[1]:
+            asyncio.create_task(edit_response(entry[0], f"🎶 **Reproduciendo:** {song['title']}"))
+        self.refresh(guild_id)
+
+
+music_panels = MusicPanels()
+
+async def edit_response(interaction: discord.Interaction, content: str):
+    try:
+        await interaction.edit_original_response(content=content)
+    except discord.HTTPException:
+        pass
+
+async def enqueue_song(guild: discord.Guild, member: discord.Member, data: Dict) -> Optional[bool]:
+    """Encola una canción ya resuelta; devuelve True si arrancó la reproducción.
+
+    Devuelve None sin encolar si el bot no está en voz y el usuario salió del
+    canal mientras se resolvía la búsqueda.
+    """
+    voice_client = guild.voice_client
+    if not voice_client:
+        if not member.voice or not member.voice.channel:
+            return None
+        voice_client = await member.voice.channel.connect()
+
+    # Añadir a la cola de manera segura
+    queue = await music_queue.safe_get_queue(guild.id)
+    queue.append(data)
+    music_panels.refresh(guild.id)
+
+    if not voice_client.is_playing() and not music_queue.get_playing(guild.id):
+        await play_next(guild.id)
+        return True
+    return False
+
+def skip_track(guild: discord.Guild) -> Optional[str]:
+    """Salta la canción actual; devuelve el motivo si no se pudo"""
+    voice_client = guild.voice_client
+    if not voice_client:
+        return "❌ No estoy conectado a un canal de voz"
+    queue = music_queue.get_queue(guild.id)
+    if voice_client.is_playing() or voice_client.is_paused():
+        idle_reaper.mark_active(guild.id)
+        voice_client.stop()
+    elif queue:
+        idle_reaper.mark_active(guild.id)
+        asyncio.create_task(play_next(guild.id))
+    else:
+        return "❌ No hay música reproduciéndose"
+    return None
+
+def toggle_pause(guild: discord.Guild) -> Optional[str]:
+    voice_client = guild.voice_client
+    if voice_client and voice_client.is_playing():
+        voice_client.pause()
+        return "⏸️ Música pausada"
+    if voice_client and voice_client.is_paused():
+        voice_client.resume()
+        return "▶️ Música reanudada"
+    return None
+
+
+class MusicPanel(ui.View):
+    """Controles persistentes del panel de música; sus botones editan el propio panel"""
+
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    async def _update(self, interaction: discord.Interaction):
+        # Un panel viejo (p. ej. de antes de un reinicio) vuelve a ser el panel del servidor
+        music_panels.attach(interaction.guild.id, interaction.message)
+        await interaction.response.edit_message(embed=build_queue_embed(interaction.guild.id), view=self)
+
+    async def _check_listener(self, interaction: discord.Interaction) -> bool:
+        voice_client = interaction.guild.voice_client
+        if voice_client and interaction.user.voice and interaction.user.voice.channel == voice_client.channel:
+            return True
+        await interaction.response.send_message("🚨 Debes estar en mi canal de voz para usar los controles.", ephemeral=True)
+        return False
+
+    @ui.button(emoji="⏯️", style=discord.ButtonStyle.secondary, custom_id="music:pause")
+    async def pause_button(self, interaction: discord.Interaction, button: ui.Button):
+        if not await self._check_listener(interaction):
+            return
+        toggle_pause(interaction.guild)
+        await self._update(interaction)
+
+    @ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary, custom_id="music:skip")
+    async def skip_button(self, interaction: discord.Interaction, button: ui.Button):
+        if not await self._check_listener(interaction):
+            return
+        error = skip_track(interaction.guild)
+        if error:
+            return await interaction.response.send_message(error, ephemeral=True)
+        # El cambio de pista vuelve a editar el panel cuando arranca la siguiente
+        await self._update(interaction)
+
+    @ui.button(emoji="🔁", style=discord.ButtonStyle.secondary, custom_id="music:loop")
+    async def loop_button(self, interaction: discord.Interaction, button: ui.Button):
+        if not await self._check_listener(interaction):
+            return
+        music_queue.toggle_loop_mode(interaction.guild.id)
+        await self._update(interaction)
+
+    @ui.button(emoji="🔄", style=discord.ButtonStyle.secondary, custom_id="music:refresh")
+    async def refresh_button(self, interaction: discord.Interaction, button: ui.Button):
+        await self._update(interaction)
+
+
+@bot.tree.command(name="play", description="Reproduce música o la añade a la cola (varias separadas por ;)")
+@app_commands.describe(consulta="Nombre o link; varias canciones separadas por ;")
+@app_commands.guild_only()
+async def slash_play(interaction: discord.Interaction, consulta: str):
+    if not interaction.user.voice:
+        return await interaction.response.send_message("🚨 Debes estar en un canal de voz para usar este comando!", ephemeral=True)
+
+    queries = split_queries(consulta)
+    if not queries:
+        return await interaction.response.send_message("❌ Indica qué canción quieres escuchar", ephemeral=True)
+    if len(queries) > PLAY_BATCH_MAX:
+        return await interaction.response.send_message(f"❌ Máximo {PLAY_BATCH_MAX} canciones por comando", ephemeral=True)
+
+    # Acuse inmediato: la extracción puede tardar varios segundos
+    await interaction.response.defer(thinking=True)
+    # El tope y el costo de admisión se aplican a la lista expandida: un link de playlist no los evade
+    queries = await expand_queries(queries)
+    if not queries:
+        return await edit_response(interaction, "❌ No se pudo encontrar el video o la canción")
+    notice = truncation_notice(len(queries))
+    queries = queries[:PLAY_BATCH_MAX]
+    rejection = await admission.admit(
+        interaction.guild, interaction.user.id, len(queries),
+        notify=lambda eta: edit_response(interaction, f"⏳ Hay mucha demanda: tu pedido empieza en ~{math.ceil(eta)}s")
+    )
+    if rejection:
+        return await edit_response(interaction, rejection)
+    idle_reaper.mark_active(interaction.guild.id)
+    await edit_response(interaction, f"🔎 Buscando **{queries[0]}**..." if len(queries) == 1 else f"🔎 Buscando {len(queries)} canciones...")
+
+    lines: List[str] = [notice] if notice else []
+    failed: List[str] = []
+    resolved = 0
+    last_edit = time.monotonic()
+    try:
+        async for query_text, data in resolve_queries(queries):
+            resolved += 1
+            if not data:
+                failed.append(query_text)
+                continue
+            data["requested_by"] = interaction.user.display_name
+
+            result = await enqueue_song(interaction.guild, interaction.user, data)
+            if result is None:
+                return await edit_response(interaction, "🚨 Saliste del canal de voz: se canceló el pedido")
+            if result:
+                lines.append(f"🎶 **Reproduciendo:** {data['title']}")
+            else:
+                lines.append(f"🎵 **En cola (#{len(music_queue.get_queue(interaction.guild.id))}):** {data['title']}")
+                if len(queries) == 1:
+                    music_panels.announce_when_playing(data, interaction)
+
+            # Ediciones progresivas, sin pasar el límite de ediciones del webhook
+            remaining = len(queries) - resolved
+            if remaining and time.monotonic() - last_edit >= PANEL_REFRESH_DELAY:
+                last_edit = time.monotonic()
+                await edit_response(interaction, "\n".join(lines + [f"🔎 Buscando {remaining} más..."])[:2000])
+    except Exception:
+        print(f"Error en /play: {traceback.format_exc()}")
+        return await edit_response(interaction, "❌ Error al reproducir")
+
+    if failed:
+        lines.append(f"❌ Sin resultados: {', '.join(failed)}"[:300])
+    await edit_response(interaction, "\n".join(lines)[:2000] or "❌ No se pudo encontrar el video o la canción")
+
+@bot.tree.command(name="queue", description="Muestra el panel de control de la cola")
+@app_commands.guild_only()
+async def slash_queue(interaction: discord.Interaction):
+    jump_url = music_panels.jump_url(interaction.guild.id, interaction.channel.id)
+    if jump_url:
+        # Ya hay panel en este canal: se actualiza en lugar de enviar otro
+        music_panels.refresh(interaction.guild.id)
+        return await interaction.response.send_message(f"📋 Panel de la cola: {jump_url}", ephemeral=True)
+
+    await interaction.response.send_message(embed=build_queue_embed(interaction.guild.id), view=MusicPanel())
+    music_panels.attach(interaction.guild.id, await interaction.original_response())
+
+@bot.tree.command(name="skip", description="Salta la canción actual")
+@app_commands.guild_only()
+async def slash_skip(interaction: discord.Interaction):
+    error = skip_track(interaction.guild)
+    await interaction.response.send_message(error or "⏭️ Saltando canción...", ephemeral=bool(error))
+
+@bot.tree.command(name="pause", description="Pausa o reanuda la reproducción")
+@app_commands.guild_only()
+async def slash_pause(interaction: discord.Interaction):
+    result = toggle_pause(interaction.guild)
+    if result:
+        music_panels.refresh(interaction.guild.id)
+    await interaction.response.send_message(result or "❌ No hay música reproduciéndose", ephemeral=not result)
+
+@bot.tree.command(name="nowplaying", description="Muestra la canción actual")
+@app_commands.guild_only()
+async def slash_nowplaying(interaction: discord.Interaction):
+    current = music_queue.current.get(interaction.guild.id)
+    if not current:
+        return await interaction.response.send_message("❌ No hay música reproduciéndose", ephemeral=True)
+    await interaction.response.send_message(
+        f"🎶 Reproduciendo ahora: **{current['title']}** "
+        f"({format_duration(music_queue.get_position(interaction.guild.id))} / {format_duration(current.get('duration'))})",
+        ephemeral=True
+    )
+
+@bot.tree.command(name="loop", description="Cambia el modo de repetición")
+@app_commands.guild_only()
+async def slash_loop(interaction: discord.Interaction):
+    new_mode = music_queue.toggle_loop_mode(interaction.guild.id)
+    music_panels.refresh(interaction.guild.id)
+    modes = {
+        'none': '🔁 Loop desactivado',
+        'song': '🔂 Repitiendo canción actual',
+        'queue': '🔁 Repitiendo toda la cola'
+    }
+    await interaction.response.send_message(modes[new_mode])
+
+@bot.tree.command(name="stop", description="Detiene la música y desconecta al bot")
+@app_commands.guild_only()
+async def slash_stop(interaction: discord.Interaction):
+    voice_client = interaction.guild.voice_client
+    if not voice_client:
+        return await interaction.response.send_message("❌ No estoy conectado a un canal de voz", ephemeral=True)
+    if music_queue.get_queue(interaction.guild.id):
+        return await interaction.response.send_message("⚠️ Hay canciones en cola. Usa /skip para saltar o espera a que terminen.", ephemeral=True)
+
+    music_queue.clear(interaction.guild.id)
+    idle_reaper.mark_active(interaction.guild.id)
+    if voice_client.is_playing():
+        voice_client.stop()
+    await voice_client.disconnect()
+    await interaction.response.send_message("⏹️ Música detenida y bot desconectado")
+
+
 async def get_related_song(title: str) -> Optional[Dict]:
+    if not await admission.acquire_extraction():
+        return None
+    started = time.monotonic()
     try:
-        with yt_dlp.YoutubeDL(MusicPlayer.YDL_OPTIONS) as ydl:
-            query = f"ytsearch:{title} audio"
-            info = await bot.loop.run_in_executor(None, lambda: ydl.extract_info(query, download=False))
-            if 'entries' in info and info['entries']:
-                video = info['entries'][0]
-                return {
-                    'url': video['url'],
-                    'title': video.get('title', 'Sugerido'),
-                    'duration': video.get('duration', 0),
-                    'requested_by': "Autoplay"
-                }
+        info = await ydl_pool.extract_info(f"ytsearch:{title} audio")
+        if 'entries' in info and info['entries']:
+            video = info['entries'][0]
+            return {
+                'url': video['url'],
+                'title': video.get('title', 'Sugerido'),
+                'duration': video.get('duration', 0),
+                'webpage_url': video.get('webpage_url'),
+                'requested_by': "Autoplay"
+            }
     except Exception as e:
         print(f"[Autoplay] Error buscando canción relacionada: {e}")
+    finally:
+        admission.release_extraction(time.monotonic() - started)
     return None
 
 
 
+# ------------------------------------------
+# Snapshot del estado de música
+# ------------------------------------------
+
+SNAPSHOT_SONG_KEYS = ('title', 'duration', 'webpage_url', 'local_path', 'requested_by', 'lufs')
+
+def snapshot_song(song: Dict) -> Dict:
+    # La URL del stream caduca: sólo se guarda lo necesario para resolverla de nuevo
+    return {key: song[key] for key in SNAPSHOT_SONG_KEYS if key in song}
+
+def build_snapshot() -> Dict:
+    guilds = {}
+    guild_ids = set(music_queue.queues) | set(music_queue.playlists) | set(song_history)
+    for guild_id in guild_ids:
+        voice_client = discord.utils.get(bot.voice_clients, guild=bot.get_guild(guild_id))
+        current = music_queue.current.get(guild_id)
+        guilds[str(guild_id)] = {
+            'voice_channel_id': voice_client.channel.id if voice_client and voice_client.is_connected() else None,
+            'current': snapshot_song(current) if current else None,
+            'position': music_queue.get_position(guild_id),
+            'queue': [snapshot_song(song) for song in music_queue.queues.get(guild_id, [])],
+            'loop_mode': music_queue.get_loop_mode(guild_id),
+            'autoplay': music_queue.is_autoplay(guild_id),
+            'history': [snapshot_song(song) for song in song_history.get(guild_id, [])],
+            'playlists': {
+                name: [snapshot_song(song) for song in songs]
+                for name, songs in music_queue.playlists.get(guild_id, {}).items()
+            },
+        }
+    return {'saved_at': datetime.now().isoformat(), 'guilds': guilds}
+
+def write_snapshot(data: Dict):
+    # Escritura atómica: nunca queda un archivo a medio escribir
+    tmp_path = f"{SNAPSHOT_PATH}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+async def save_snapshot():
+    try:
+        data = build_snapshot()
+        await bot.loop.run_in_executor(None, write_snapshot, data)
+    except Exception:
+        print(f"Error guardando snapshot: {traceback.format_exc()}")
+
+@tasks.loop(seconds=SNAPSHOT_INTERVAL)
+async def snapshot_loop():
+    await save_snapshot()
+
+async def restore_snapshot():
+    """Restaura colas, modos e historial; reconecta donde todavía hay oyentes"""
+    if not os.path.exists(SNAPSHOT_PATH):
+        return
+    try:
+        with open(SNAPSHOT_PATH, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error leyendo snapshot: {e}")
+        return
+
+    restored = 0
+    for guild_key, state in data.get('guilds', {}).items():
+        guild_id = int(guild_key)
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            continue
+
+        music_queue.set_loop_mode(guild_id, state.get('loop_mode', 'none'))
+        music_queue.set_autoplay(guild_id, state.get('autoplay', False))
+        if state.get('history'):
+            song_history[guild_id] = state['history']
+            for song in state['history']:
+                title_index.add_track(guild_id, song)
+        if state.get('playlists'):
+            music_queue.playlists[guild_id] = state['playlists']
+            for name in state['playlists']:
+                title_index.add_playlist(guild_id, name)
+
+        channel = guild.get_channel(state.get('voice_channel_id') or 0)
+        if not channel or not any(not m.bot for m in channel.members):
+            continue
+
+        queue = await music_queue.safe_get_queue(guild_id)
+        if state.get('current'):
+            current = dict(state['current'], resume_at=state.get('position', 0.0))
+            queue.append(current)
+        queue.extend(state.get('queue', []))
+        if not queue:
+            continue
+
+        try:
+            voice_client = guild.voice_client or await channel.connect()
+        except Exception as e:
+            print(f"Error reconectando a {channel.id}: {e}")
+            music_queue.clear(guild_id)
+            continue
+        if not voice_client.is_playing() and not music_queue.get_playing(guild_id):
+            asyncio.create_task(play_next(guild_id))
+        restored += 1
+
+    print(f"♻️ Sesiones de música restauradas: {restored}")
+
+
 @bot.command()
 async def latency(ctx):
     """Mide la latencia del bot"""
@@ -691,44 +3156,170 @@ async def latency(ctx):
     await message.edit(content=content)
 
 
-# Constantes de configuración
-STAFF_ROLES = [1380930376343752704, 1380930523668549703, 1380930573899665538, 1380930606191607949]
-LOG_CHANNEL_ID = 1381026786368032819
-TICKET_CATEGORY_ID = 1380982177344520287
-MAX_ADVERTENCIAS = 7
-ALERTA_ADVERTENCIAS = 5
-MUTE_ROLE_NAME = "Muted"
+# --------------------------
+# Configuración por servidor
+# --------------------------
 
-# Base de datos
-conn = sqlite3.connect('moderacion.db')
-cursor = conn.cursor()
-
-# Tabla de infracciones
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS infracciones (
-    user_id INTEGER,
-    guild_id INTEGER,
-    motivo TEXT,
-    fecha TEXT,
-    PRIMARY KEY (user_id, guild_id, fecha)
-)
-''')
-conn.commit()
+class GuildConfig:
+    """Configuración resuelta de un servidor, lista para consultas O(1)"""
+    __slots__ = ('guild_id', 'staff_roles', 'staff_role_set', 'log_channel_id', 'ticket_category_id',
+                 'mute_role_name', 'mute_role_id', 'music_commands_channel_id', 'retention_days')
+
+    def __init__(self, guild_id: int, staff_roles: List[int], log_channel_id: Optional[int],
+                 ticket_category_id: Optional[int], mute_role_name: str, mute_role_id: Optional[int],
+                 music_commands_channel_id: Optional[int], retention_days: Optional[int] = None):
+        self.guild_id = guild_id
+        self.staff_roles = staff_roles
+        self.staff_role_set = frozenset(staff_roles)
+        self.log_channel_id = log_channel_id
+        self.ticket_category_id = ticket_category_id
+        self.mute_role_name = mute_role_name
+        self.mute_role_id = mute_role_id
+        self.music_commands_channel_id = music_commands_channel_id
+        self.retention_days = retention_days
+
+
+class GuildConfigStore:
+    """Configuración por servidor persistida en SQLite con caché en memoria.
+
+    Los servidores sin fila usan las constantes de arriba como valores por
+    defecto. Cada cambio se escribe en la base e invalida la entrada en caché.
+    """
+
+    FIELDS = ('staff_roles', 'log_channel_id', 'ticket_category_id', 'mute_role_name',
+              'mute_role_id', 'music_commands_channel_id', 'retention_days')
+
+    def __init__(self):
+        self.cache: Dict[int, GuildConfig] = {}
+
+    def get(self, guild_id: int) -> GuildConfig:
+        config = self.cache.get(guild_id)
+        if config is None:
+            config = self.cache[guild_id] = self._load(guild_id)
+        return config
+
+    def _load(self, guild_id: int) -> GuildConfig:
+        db_cursor.execute('''
+        SELECT staff_roles, log_channel_id, ticket_category_id, mute_role_name, mute_role_id,
+               music_commands_channel_id, retention_days
+        FROM guild_config WHERE guild_id = ?
+        ''', (guild_id,))
+        row = db_cursor.fetchone()
+        if not row:
+            return GuildConfig(guild_id, list(STAFF_ROLES), LOG_CHANNEL_ID, TICKET_CATEGORY_ID,
+                               MUTE_ROLE_NAME, None, MUSIC_COMMANDS_CHANNEL_ID)
+        staff_roles, log_channel_id, ticket_category_id, mute_role_name, mute_role_id, music_channel_id, retention_days = row
+        return GuildConfig(guild_id, json.loads(staff_roles), log_channel_id, ticket_category_id,
+                           mute_role_name or MUTE_ROLE_NAME, mute_role_id, music_channel_id, retention_days)
+
+    def update(self, guild_id: int, **changes):
+        config = self.get(guild_id)
+        values = {field: getattr(config, field) for field in self.FIELDS}
+        values.update(changes)
+        db_cursor.execute('''
+        INSERT OR REPLACE INTO guild_config
+            (guild_id, staff_roles, log_channel_id, ticket_category_id, mute_role_name, mute_role_id,
+             music_commands_channel_id, retention_days)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (guild_id, json.dumps(values['staff_roles']), values['log_channel_id'], values['ticket_category_id'],
+              values['mute_role_name'], values['mute_role_id'], values['music_commands_channel_id'],
+              values['retention_days']))
+        db_conn.commit()
+        self.cache.pop(guild_id, None)
+
+
+guild_configs = GuildConfigStore()
+
+def get_guild_channel(guild: discord.Guild, channel_id: Optional[int]):
+    # Sólo canales del propio servidor: nunca se filtran logs a otro servidor
+    return guild.get_channel(channel_id) if channel_id else None
+
+def get_log_channel(guild: Optional[discord.Guild]):
+    if guild is None:
+        return None
+    return get_guild_channel(guild, guild_configs.get(guild.id).log_channel_id)
+
+def get_mute_role(guild: discord.Guild) -> Optional[discord.Role]:
+    """Rol de mute por ID; la búsqueda por nombre se hace una sola vez y se guarda"""
+    config = guild_configs.get(guild.id)
+    if config.mute_role_id:
+        role = guild.get_role(config.mute_role_id)
+        if role:
+            return role
+    role = discord.utils.get(guild.roles, name=config.mute_role_name)
+    if role:
+        guild_configs.update(guild.id, mute_role_id=role.id)
+    return role
+
+class InfractionCache:
+    """Caché write-through de las fechas de advertencias activas por (servidor, usuario).
+
+    Se carga desde la base una vez por par y luego se mantiene en memoria,
+    así contar advertencias no requiere consultas. Las advertencias más
+    antiguas que `WARNING_DECAY_DAYS` se descartan al contar.
+    """
+
+    def __init__(self, max_size: int = INFRACTION_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()  # (guild_id, user_id) -> deque de fechas
+
+    def _load(self, guild_id: int, user_id: int) -> Deque[datetime]:
+        key = (guild_id, user_id)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        db_cursor.execute('''
+        SELECT fecha FROM infracciones
+        WHERE user_id = ? AND guild_id = ?
+        ORDER BY fecha
+        ''', (user_id, guild_id))
+        fechas = deque(datetime.fromisoformat(fecha) for (fecha,) in db_cursor.fetchall())
+        self.entries[key] = fechas
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return fechas
+
+    def _prune(self, fechas: Deque[datetime]):
+        if not WARNING_DECAY_DAYS:
+            return
+        cutoff = datetime.now() - timedelta(days=WARNING_DECAY_DAYS)
+        while fechas and fechas[0] < cutoff:
+            fechas.popleft()
+
+    def add(self, guild_id: int, user_id: int, fecha: datetime) -> int:
+        fechas = self._load(guild_id, user_id)
+        fechas.append(fecha)
+        self._prune(fechas)
+        return len(fechas)
+
+    def count(self, guild_id: int, user_id: int) -> int:
+        fechas = self._load(guild_id, user_id)
+        self._prune(fechas)
+        return len(fechas)
+
+    def clear(self, guild_id: int, user_id: int):
+        self.entries.pop((guild_id, user_id), None)
+
+
+infraction_cache = InfractionCache()
 
 # Funciones de utilidad
-async def add_infraction(user_id: int, guild_id: int, reason: str):
+async def add_infraction(user_id: int, guild_id: int, reason: str) -> int:
+    """Registra una advertencia y devuelve el total de advertencias activas"""
+    fecha = datetime.now()
+    # Cargar la caché antes del INSERT: si no, _load leería la fila nueva
+    # y add() la volvería a añadir
+    infraction_cache.count(guild_id, user_id)
     db_cursor.execute('''
     INSERT INTO infracciones (user_id, guild_id, motivo, fecha)
     VALUES (?, ?, ?, ?)
-    ''', (user_id, guild_id, reason, datetime.now().isoformat()))
+    ''', (user_id, guild_id, reason, fecha.isoformat()))
     db_conn.commit()
+    return infraction_cache.add(guild_id, user_id, fecha)
 
 async def get_infractions(user_id: int, guild_id: int) -> int:
-    db_cursor.execute('''
-    SELECT COUNT(*) FROM infracciones 
-    WHERE user_id = ? AND guild_id = ?
-    ''', (user_id, guild_id))
-    return db_cursor.fetchone()[0]
+    return infraction_cache.count(guild_id, user_id)
 
 async def clear_infractions(user_id: int, guild_id: int):
     db_cursor.execute('''
@@ -736,18 +3327,158 @@ async def clear_infractions(user_id: int, guild_id: int):
     WHERE user_id = ? AND guild_id = ?
     ''', (user_id, guild_id))
     db_conn.commit()
+    infraction_cache.clear(guild_id, user_id)
+
+async def schedule_unmute(member: discord.Member, mute_role: discord.Role, seconds: int):
+    await asyncio.sleep(seconds)
+    # Sin caché completa el objeto puede estar desactualizado: se quita el rol igualmente
+    try:
+        await member.remove_roles(mute_role)
+    except discord.HTTPException:
+        pass
+
+async def apply_mute(member: discord.Member, seconds: int, reason: str) -> bool:
+    """Aplica el rol de mute y programa su retiro. Devuelve False si no existe el rol"""
+    mute_role = get_mute_role(member.guild)
+    if not mute_role:
+        return False
+    await member.add_roles(mute_role, reason=reason)
+    asyncio.create_task(schedule_unmute(member, mute_role, seconds))
+    return True
+
+def crossed_threshold(previous: int, total: int) -> Optional[int]:
+    """Mayor umbral de escalado cruzado al pasar de `previous` a `total` advertencias"""
+    crossed = [threshold for threshold in ESCALATION_ACTIONS if previous < threshold <= total]
+    return max(crossed) if crossed else None
+
+async def apply_escalation(member: discord.Member, total: int, previous: Optional[int] = None) -> Optional[str]:
+    """Ejecuta la acción del umbral cruzado al llegar a `total` advertencias"""
+    threshold = crossed_threshold(total - 1 if previous is None else previous, total)
+    if threshold is None:
+        return None
+
+    kind, duration = ESCALATION_ACTIONS[threshold]
+    reason = f"Escalado automático: {total} advertencias"
+    try:
+        if kind == 'mute':
+            if await apply_mute(member, duration, reason):
+                return f"🔇 Muteado automáticamente por {duration // 60} minutos"
+        elif kind == 'ban':
+            await member.ban(reason=reason)
+            return "🔨 Baneado automáticamente"
+    except discord.HTTPException as e:
+        print(f"[Escalado] Error aplicando {kind} a {member.id}: {e}")
+    return None
+
+def is_staff_member(member) -> bool:
+    if not isinstance(member, discord.Member):
+        return False
+    staff_roles = guild_configs.get(member.guild.id).staff_role_set
+    return not staff_roles.isdisjoint(role.id for role in member.roles)
 
 async def is_staff(member: discord.Member) -> bool:
-    return any(role.id in STAFF_ROLES for role in member.roles)
+    return is_staff_member(member)
+
+class MemberCache:
+    """Caché LRU con TTL para miembros fuera de la caché de discord.py.
+
+    Con la política 'lean' sólo se guardan aquí el staff y los autores
+    recientes de comandos; el resto se pide a la API cuando hace falta. Con
+    'full' discord.py ya tiene a todos: no se guarda nada y se usa get_member.
+    """
+
+    def __init__(self, max_size: int = MEMBER_CACHE_MAX):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()  # (guild_id, user_id) -> (member, expira)
+        self.fetches = 0
+
+    def remember(self, member: discord.Member):
+        if MEMBER_CACHE_POLICY != "lean" or not isinstance(member, discord.Member):
+            return
+        staff = is_staff_member(member)
+        ttl = MEMBER_CACHE_STAFF_TTL if staff else MEMBER_CACHE_TTL
+        key = (member.guild.id, member.id)
+        self.entries[key] = (member, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def resolve(self, guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+        member = guild.get_member(user_id)
+        if member:
+            return member
+
+        entry = self.entries.get((guild.id, user_id))
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.HTTPException:
+            return None
+        self.fetches += 1
+        self.remember(member)
+        return member
+
+
+member_cache = MemberCache()
+
+# Registro de tickets
+async def create_ticket_record(channel_id: int, guild_id: int, creator_id: int, motivo: str):
+    db_cursor.execute('''
+    INSERT INTO tickets (channel_id, guild_id, creator_id, motivo, estado, creado)
+    VALUES (?, ?, ?, ?, 'abierto', ?)
+    ''', (channel_id, guild_id, creator_id, motivo, datetime.now().isoformat()))
+    db_conn.commit()
+
+async def get_ticket(channel_id: int) -> Optional[tuple]:
+    db_cursor.execute('''
+    SELECT channel_id, guild_id, creator_id, claimer_id, motivo, estado, creado
+    FROM tickets WHERE channel_id = ?
+    ''', (channel_id,))
+    return db_cursor.fetchone()
+
+async def claim_ticket_record(channel_id: int, claimer_id: int):
+    db_cursor.execute('''
+    UPDATE tickets SET claimer_id = ?, reclamado = ? WHERE channel_id = ?
+    ''', (claimer_id, datetime.now().isoformat(), channel_id))
+    db_conn.commit()
+
+async def close_ticket_record(channel_id: int, motivo_cierre: str):
+    db_cursor.execute('''
+    UPDATE tickets SET estado = 'cerrado', cerrado = ?, motivo_cierre = ?
+    WHERE channel_id = ? AND estado = 'abierto'
+    ''', (datetime.now().isoformat(), motivo_cierre, channel_id))
+    db_conn.commit()
+
+async def count_open_tickets(user_id: int, guild_id: int) -> int:
+    db_cursor.execute('''
+    SELECT COUNT(*) FROM tickets
+    WHERE guild_id = ? AND creator_id = ? AND estado = 'abierto'
+    ''', (guild_id, user_id))
+    return db_cursor.fetchone()[0]
+
+async def get_ticket_stats(guild_id: int) -> Dict[str, int]:
+    db_cursor.execute('''
+    SELECT estado, COUNT(*) FROM tickets WHERE guild_id = ? GROUP BY estado
+    ''', (guild_id,))
+    return dict(db_cursor.fetchall())
 
 # Sistema de Tickets
 class CloseTicketModal(ui.Modal, title="Cerrar Ticket"):
     motivo = ui.TextInput(label="Motivo del cierre", style=discord.TextStyle.paragraph)
 
     async def on_submit(self, interaction: discord.Interaction):
-        log_channel = bot.get_channel(LOG_CHANNEL_ID)
-        creator_id = interaction.channel.topic.split("Creador: ")[1] if "Creador: " in interaction.channel.topic else "Desconocido"
-        creator = interaction.guild.get_member(int(creator_id)) if creator_id.isdigit() else None
+        log_channel = get_log_channel(interaction.guild)
+        record = await get_ticket(interaction.channel.id)
+        if record:
+            creator_id = str(record[2])
+        else:
+            # Tickets creados antes del registro: el creador sólo está en el topic
+            topic = interaction.channel.topic or ""
+            creator_id = topic.split("Creador: ")[1] if "Creador: " in topic else "Desconocido"
+        creator = await member_cache.resolve(interaction.guild, int(creator_id)) if creator_id.isdigit() else None
+        await close_ticket_record(interaction.channel.id, self.motivo.value)
         
         # Registrar en logs
         if log_channel:
@@ -761,7 +3492,7 @@ class CloseTicketModal(ui.Modal, title="Cerrar Ticket"):
                 ),
                 color=discord.Color.red()
             )
-            await log_channel.send(embed=embed)
+            message_scheduler.log(log_channel, embed=embed)
         
         # Notificar al usuario
         if creator:
@@ -795,10 +3526,12 @@ class TicketView(ui.View):
             read_messages=True,
             send_messages=True
         )
+        await claim_ticket_record(interaction.channel.id, interaction.user.id)
         
-        log_channel = bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = get_log_channel(interaction.guild)
         if log_channel:
-            await log_channel.send(
+            message_scheduler.log(
+                log_channel,
                 f"📌 Ticket reclamado: {interaction.channel.mention}\n"
                 f"🛠️ Staff: {interaction.user.mention}"
             )
@@ -815,24 +3548,25 @@ class TicketModal(ui.Modal, title="Nuevo Ticket"):
     descripcion = ui.TextInput(label="Descripción detallada", style=discord.TextStyle.paragraph)
 
     async def on_submit(self, interaction: discord.Interaction):
-        category = bot.get_channel(TICKET_CATEGORY_ID)
+        config = guild_configs.get(interaction.guild.id)
+        category = get_guild_channel(interaction.guild, config.ticket_category_id)
         if not category:
             return await interaction.response.send_message("❌ No se encontró la categoría para tickets.", ephemeral=True)
         
+        if await count_open_tickets(interaction.user.id, interaction.guild.id) >= MAX_TICKETS_POR_USUARIO:
+            return await interaction.response.send_message("❌ Ya tenés un ticket abierto.", ephemeral=True)
+        
+        # Permisos incluidos en la creación: un solo round-trip a la API
+        overwrites = dict(category.overwrites)
+        overwrites[interaction.guild.default_role] = discord.PermissionOverwrite(read_messages=False)
+        overwrites[interaction.user] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
+        
         ticket_channel = await category.create_text_channel(
             name=f"ticket-{interaction.user.name}",
-            topic=f"Motivo: {self.motivo}\nCreador: {interaction.user.id}"
-        )
-        
-        await ticket_channel.set_permissions(
-            interaction.guild.default_role,
-            read_messages=False
-        )
-        await ticket_channel.set_permissions(
-            interaction.user,
-            read_messages=True,
-            send_messages=True
+            topic=f"Motivo: {self.motivo}",
+            overwrites=overwrites
         )
+        await create_ticket_record(ticket_channel.id, interaction.guild.id, interaction.user.id, str(self.motivo))
         
         embed = discord.Embed(
             title=f"Ticket de {interaction.user.name}",
@@ -841,7 +3575,7 @@ class TicketModal(ui.Modal, title="Nuevo Ticket"):
         )
         
         await ticket_channel.send(
-            content=f"{interaction.user.mention} | <@&{STAFF_ROLES[0]}>",
+            content=f"{interaction.user.mention} | <@&{config.staff_roles[0]}>" if config.staff_roles else interaction.user.mention,
             embed=embed,
             view=TicketView()
         )
@@ -866,9 +3600,8 @@ async def advertir(interaction: discord.Interaction, usuario: discord.Member, mo
     if usuario.top_role.position >= interaction.user.top_role.position:
         return await interaction.response.send_message("❌ No puedes advertir a alguien con igual o mayor rango.", ephemeral=True)
     
-    # Registrar infracción
-    await add_infraction(usuario.id, interaction.guild.id, motivo)
-    total = await get_infractions(usuario.id, interaction.guild.id)
+    # Registrar infracción (el total sale de la caché, sin COUNT extra)
+    total = await add_infraction(usuario.id, interaction.guild.id, motivo)
     
     # Crear embed de respuesta
     embed = discord.Embed(
@@ -895,6 +3628,11 @@ async def advertir(interaction: discord.Interaction, usuario: discord.Member, mo
         await usuario.send(embed=user_embed)
     except discord.HTTPException:
         pass
+    
+    # Escalado automático según el total de advertencias activas
+    accion = await apply_escalation(usuario, total)
+    if accion:
+        await interaction.followup.send(f"{accion} ({usuario.mention} llegó a {total} advertencias)")
 
 @bot.tree.command(name="mutear", description="Silencia a un usuario por un tiempo determinado")
 @app_commands.describe(
@@ -918,9 +3656,9 @@ async def mutear(interaction: discord.Interaction, usuario: discord.Member,
     if usuario.top_role.position >= interaction.user.top_role.position:
         return await interaction.response.send_message("❌ No puedes mutear a alguien con igual o mayor rango.", ephemeral=True)
     
-    mute_role = discord.utils.get(interaction.guild.roles, name=MUTE_ROLE_NAME)
+    mute_role = get_mute_role(interaction.guild)
     if not mute_role:
-        return await interaction.response.send_message(f"❌ No existe el rol '{MUTE_ROLE_NAME}'.", ephemeral=True)
+        return await interaction.response.send_message(f"❌ No existe el rol '{guild_configs.get(interaction.guild.id).mute_role_name}'.", ephemeral=True)
     
     try:
         # Aplicar mute
@@ -949,9 +3687,7 @@ async def mutear(interaction: discord.Interaction, usuario: discord.Member,
             pass
         
         # Temporizador para auto-desmutear
-        await asyncio.sleep(int(duracion.value))
-        if mute_role in usuario.roles:
-            await usuario.remove_roles(mute_role)
+        asyncio.create_task(schedule_unmute(usuario, mute_role, int(duracion.value)))
             
     except Exception as e:
         await interaction.response.send_message(f"❌ Error al mutear: {str(e)}", ephemeral=True)
@@ -998,9 +3734,9 @@ async def desmutear(interaction: discord.Interaction, usuario: discord.Member):
     if not await is_staff(interaction.user):
         return await interaction.response.send_message("❌ No tienes permisos para usar este comando.", ephemeral=True)
     
-    mute_role = discord.utils.get(interaction.guild.roles, name=MUTE_ROLE_NAME)
+    mute_role = get_mute_role(interaction.guild)
     if not mute_role:
-        return await interaction.response.send_message(f"❌ No existe el rol '{MUTE_ROLE_NAME}'.", ephemeral=True)
+        return await interaction.response.send_message(f"❌ No existe el rol '{guild_configs.get(interaction.guild.id).mute_role_name}'.", ephemeral=True)
     
     if mute_role not in usuario.roles:
         return await interaction.response.send_message(f"❌ {usuario.mention} no está muteado.", ephemeral=True)
@@ -1009,14 +3745,148 @@ async def desmutear(interaction: discord.Interaction, usuario: discord.Member):
         await usuario.remove_roles(mute_role)
         
         embed = discord.Embed(
-            title="🔊 Usuario desmuteado",
-            description=f"**Usuario:** {usuario.mention}\n**Moderador:** {interaction.user.mention}",
-            color=discord.Color.green()
+            title="🔊 Usuario desmuteado",
+            description=f"**Usuario:** {usuario.mention}\n**Moderador:** {interaction.user.mention}",
+            color=discord.Color.green()
+        )
+        await interaction.response.send_message(embed=embed)
+        
+    except Exception as e:
+        await interaction.response.send_message(f"❌ Error al desmutear: {str(e)}", ephemeral=True)
+
+class InfractionBrowser(ui.View):
+    """Vista paginada del historial de infracciones de un usuario.
+
+    Usa paginación por clave sobre `fecha` (nunca OFFSET), así cualquier página
+    cuesta lo mismo que la primera. Las páginas ya vistas quedan en una caché
+    pequeña para ir y volver sin consultar.
+    """
+
+    def __init__(self, usuario: discord.Member, guild_id: int, total: int):
+        super().__init__(timeout=300)
+        self.usuario = usuario
+        self.guild_id = guild_id
+        self.total = total
+        self.page = 0
+        self.pages: OrderedDict = OrderedDict()            # página -> [(motivo, fecha)]
+        self.bounds: Dict[int, tuple] = {}                 # página -> (fecha más nueva, fecha más vieja)
+        self.has_next: Dict[int, bool] = {}
+
+    def _cache(self, page: int, rows: List[tuple]):
+        self.pages[page] = rows
+        self.pages.move_to_end(page)
+        if len(self.pages) > INFRACCIONES_CACHE_PAGINAS:
+            self.pages.popitem(last=False)
+        if rows:
+            self.bounds[page] = (rows[0][1], rows[-1][1])
+
+    async def load_page(self, page: int):
+        if page in self.pages:
+            self.pages.move_to_end(page)
+            self.page = page
+            return
+
+        cursor = db_conn.cursor()
+        if page == 0:
+            cursor.execute('''
+            SELECT motivo, fecha FROM infracciones
+            WHERE user_id = ? AND guild_id = ?
+            ORDER BY fecha DESC LIMIT ?
+            ''', (self.usuario.id, self.guild_id, INFRACCIONES_POR_PAGINA + 1))
+            rows = cursor.fetchall()
+        elif page - 1 in self.bounds and page > self.page:
+            # Hacia atrás en el tiempo: lo más nuevo por debajo de la página anterior
+            cursor.execute('''
+            SELECT motivo, fecha FROM infracciones
+            WHERE user_id = ? AND guild_id = ? AND fecha < ?
+            ORDER BY fecha DESC LIMIT ?
+            ''', (self.usuario.id, self.guild_id, self.bounds[page - 1][1], INFRACCIONES_POR_PAGINA + 1))
+            rows = cursor.fetchall()
+        else:
+            # Página expulsada de la caché: lo más viejo por encima de la página siguiente
+            cursor.execute('''
+            SELECT motivo, fecha FROM infracciones
+            WHERE user_id = ? AND guild_id = ? AND fecha > ?
+            ORDER BY fecha ASC LIMIT ?
+            ''', (self.usuario.id, self.guild_id, self.bounds[page + 1][0], INFRACCIONES_POR_PAGINA))
+            rows = list(reversed(cursor.fetchall()))
+            rows.append(None)  # Sabemos que hay página siguiente
+        cursor.close()
+
+        self.has_next[page] = len(rows) > INFRACCIONES_POR_PAGINA
+        self._cache(page, rows[:INFRACCIONES_POR_PAGINA])
+        self.page = page
+
+    def build_embed(self) -> discord.Embed:
+        embed = discord.Embed(
+            title=f"📝 Infracciones de {self.usuario.display_name}",
+            description=f"Advertencias activas: **{self.total}**",
+            color=discord.Color.orange()
         )
-        await interaction.response.send_message(embed=embed)
-        
-    except Exception as e:
-        await interaction.response.send_message(f"❌ Error al desmutear: {str(e)}", ephemeral=True)
+
+        rows = self.pages.get(self.page, [])
+        start = self.page * INFRACCIONES_POR_PAGINA + 1
+        for i, (motivo, fecha) in enumerate(rows, start):
+            fecha_obj = datetime.fromisoformat(fecha)
+            embed.add_field(
+                name=f"Infracción #{i} - {fecha_obj.strftime('%d/%m/%Y')}",
+                value=f"**Motivo:** {motivo}",
+                inline=False
+            )
+        if not rows:
+            embed.add_field(name="Sin registros", value="Este usuario no tiene infracciones.", inline=False)
+
+        embed.set_footer(text=f"Página {self.page + 1}")
+        self.previous.disabled = self.page == 0
+        self.next.disabled = not self.has_next.get(self.page, False)
+        return embed
+
+    @ui.button(label="◀️ Anterior", style=discord.ButtonStyle.gray)
+    async def previous(self, interaction: discord.Interaction, button: ui.Button):
+        await self.load_page(max(0, self.page - 1))
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+    @ui.button(label="Siguiente ▶️", style=discord.ButtonStyle.gray)
+    async def next(self, interaction: discord.Interaction, button: ui.Button):
+        if self.has_next.get(self.page):
+            await self.load_page(self.page + 1)
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+    @ui.button(label="📄 Exportar", style=discord.ButtonStyle.blurple)
+    async def export(self, interaction: discord.Interaction, button: ui.Button):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        archivo = await export_infractions(self.usuario.id, self.guild_id)
+        await interaction.followup.send(
+            file=discord.File(archivo, filename=f"infracciones-{self.usuario.id}.csv"),
+            ephemeral=True
+        )
+
+
+async def export_infractions(user_id: int, guild_id: int):
+    """Vuelca todo el historial a un CSV leyendo por bloques, sin cargarlo entero en memoria"""
+    archivo = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    archivo.write("fecha,motivo\n".encode('utf-8'))
+
+    cursor = db_conn.cursor()
+    cursor.execute('''
+    SELECT fecha, motivo FROM infracciones
+    WHERE user_id = ? AND guild_id = ?
+    ORDER BY fecha DESC
+    ''', (user_id, guild_id))
+    try:
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            archivo.write(buffer.getvalue().encode('utf-8'))
+            await asyncio.sleep(0)  # Ceder el event loop entre bloques
+    finally:
+        cursor.close()
+
+    archivo.seek(0)
+    return archivo
 
 @bot.tree.command(name="infracciones", description="Muestra las infracciones de un usuario")
 @app_commands.describe(usuario="Usuario a consultar")
@@ -1027,31 +3897,9 @@ async def infracciones(interaction: discord.Interaction, usuario: discord.Member
         return await interaction.response.send_message("❌ No tienes permisos para usar este comando.", ephemeral=True)
     
     total = await get_infractions(usuario.id, interaction.guild.id)
-    db_cursor.execute('''
-    SELECT motivo, fecha FROM infracciones 
-    WHERE user_id = ? AND guild_id = ?
-    ORDER BY fecha DESC LIMIT 5
-    ''', (usuario.id, interaction.guild.id))
-    infracciones = db_cursor.fetchall()
-    
-    embed = discord.Embed(
-        title=f"📝 Infracciones de {usuario.display_name}",
-        description=f"Total: **{total}** infracciones",
-        color=discord.Color.orange()
-    )
-    
-    for i, (motivo, fecha) in enumerate(infracciones, 1):
-        fecha_obj = datetime.fromisoformat(fecha)
-        embed.add_field(
-            name=f"Infracción #{i} - {fecha_obj.strftime('%d/%m/%Y')}",
-            value=f"**Motivo:** {motivo}",
-            inline=False
-        )
-    
-    if total > 5:
-        embed.set_footer(text=f"Mostrando las 5 más recientes de {total} infracciones")
-    
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    view = InfractionBrowser(usuario, interaction.guild.id, total)
+    await view.load_page(0)
+    await interaction.response.send_message(embed=view.build_embed(), view=view, ephemeral=True)
 
 @bot.tree.command(name="limpiar_infracciones", description="Borra todas las infracciones de un usuario")
 @app_commands.describe(usuario="Usuario a limpiar")
@@ -1078,6 +3926,88 @@ async def limpiar_infracciones(interaction: discord.Interaction, usuario: discor
 async def ticket(interaction: discord.Interaction):
     await interaction.response.send_modal(TicketModal())
 
+@bot.tree.command(name="tickets", description="Muestra estadísticas de tickets del servidor")
+@app_commands.default_permissions(manage_messages=True)
+async def tickets(interaction: discord.Interaction):
+    if not await is_staff(interaction.user):
+        return await interaction.response.send_message("❌ Solo el staff puede usar este comando.", ephemeral=True)
+    
+    stats = await get_ticket_stats(interaction.guild.id)
+    embed = discord.Embed(
+        title="🎫 Tickets del servidor",
+        description=(
+            f"**Abiertos:** {stats.get('abierto', 0)}\n"
+            f"**Cerrados:** {stats.get('cerrado', 0)}"
+        ),
+        color=discord.Color.blue()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="configurar", description="Configura los canales y roles del bot en este servidor")
+@app_commands.describe(
+    canal_logs="Canal donde se registran tickets y moderación",
+    categoria_tickets="Categoría donde se crean los tickets",
+    rol_mute="Rol que se asigna al mutear",
+    canal_musica="Canal donde se fija la guía de comandos",
+    retencion_dias="Días que se conservan infracciones y tickets cerrados antes de archivarlos"
+)
+@app_commands.default_permissions(administrator=True)
+async def configurar(interaction: discord.Interaction, canal_logs: Optional[discord.TextChannel] = None,
+                     categoria_tickets: Optional[discord.CategoryChannel] = None,
+                     rol_mute: Optional[discord.Role] = None, canal_musica: Optional[discord.TextChannel] = None,
+                     retencion_dias: Optional[app_commands.Range[int, 30, 3650]] = None):
+    changes = {}
+    if canal_logs:
+        changes['log_channel_id'] = canal_logs.id
+    if categoria_tickets:
+        changes['ticket_category_id'] = categoria_tickets.id
+    if rol_mute:
+        changes['mute_role_id'] = rol_mute.id
+        changes['mute_role_name'] = rol_mute.name
+    if canal_musica:
+        changes['music_commands_channel_id'] = canal_musica.id
+    if retencion_dias:
+        changes['retention_days'] = retencion_dias
+    if changes:
+        guild_configs.update(interaction.guild.id, **changes)
+    
+    config = guild_configs.get(interaction.guild.id)
+    mute_role = interaction.guild.get_role(config.mute_role_id) if config.mute_role_id else None
+    embed = discord.Embed(
+        title="⚙️ Configuración del servidor",
+        description=(
+            f"**Canal de logs:** {f'<#{config.log_channel_id}>' if get_log_channel(interaction.guild) else 'sin configurar'}\n"
+            f"**Categoría de tickets:** {f'<#{config.ticket_category_id}>' if get_guild_channel(interaction.guild, config.ticket_category_id) else 'sin configurar'}\n"
+            f"**Rol de mute:** {mute_role.mention if mute_role else config.mute_role_name}\n"
+            f"**Canal de música:** {f'<#{config.music_commands_channel_id}>' if get_guild_channel(interaction.guild, config.music_commands_channel_id) else 'sin configurar'}\n"
+            f"**Retención:** {config.retention_days or RETENTION_DAYS} días\n"
+            f"**Roles de staff:** {' '.join(f'<@&{role_id}>' for role_id in config.staff_roles if interaction.guild.get_role(role_id)) or 'ninguno'}"
+        ),
+        color=discord.Color.blurple()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="staff_rol", description="Agrega o quita un rol de staff en este servidor")
+@app_commands.describe(accion="Agregar o quitar", rol="Rol de staff")
+@app_commands.choices(accion=[
+    app_commands.Choice(name="Agregar", value="agregar"),
+    app_commands.Choice(name="Quitar", value="quitar")
+])
+@app_commands.default_permissions(administrator=True)
+async def staff_rol(interaction: discord.Interaction, accion: app_commands.Choice[str], rol: discord.Role):
+    staff_roles = [role_id for role_id in guild_configs.get(interaction.guild.id).staff_roles
+                   if interaction.guild.get_role(role_id)]
+    if accion.value == "agregar" and rol.id not in staff_roles:
+        staff_roles.append(rol.id)
+    elif accion.value == "quitar" and rol.id in staff_roles:
+        staff_roles.remove(rol.id)
+    guild_configs.update(interaction.guild.id, staff_roles=staff_roles)
+    
+    await interaction.response.send_message(
+        f"✅ Roles de staff: {' '.join(f'<@&{role_id}>' for role_id in staff_roles) or 'ninguno'}",
+        ephemeral=True
+    )
+
 @bot.tree.command(name="modpanel", description="Muestra el panel de moderación")
 @app_commands.default_permissions(manage_messages=True)
 async def modpanel(interaction: discord.Interaction):
@@ -1094,33 +4024,186 @@ async def modpanel(interaction: discord.Interaction):
         ephemeral=True
     )
 
+# Sistema de purga
+class PurgeJob:
+    """Trabajo de borrado en segundo plano sobre el historial de un canal.
+
+    Recorre el historial del más nuevo al más antiguo: los mensajes de menos
+    de 14 días se borran en lotes de 100 y los más antiguos uno por uno,
+    espaciados para respetar el rate limit. Un lote que falla se cuenta y el
+    trabajo sigue. El filtro por expresión regular corre en un executor, así
+    un patrón lento no frena el event loop.
+    """
+
+    def __init__(self, channel: discord.TextChannel, limit: int, check, after: Optional[datetime] = None,
+                 pattern: Optional[re.Pattern] = None):
+        self.channel = channel
+        self.limit = limit
+        self.check = check
+        self.after = after
+        self.pattern = pattern
+        self.scanned = 0
+        self.deleted = 0
+        self.failed = 0
+        self.cancelled = False
+        self.finished = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def status(self) -> str:
+        if self.cancelled:
+            estado = "⛔ Cancelado"
+        elif self.finished:
+            estado = "✅ Terminado"
+        else:
+            estado = "🧹 Borrando..."
+        fallidos = f" / {self.failed} sin borrar" if self.failed else ""
+        return f"{estado} — {self.deleted} borrados / {self.scanned} revisados{fallidos}"
+
+    async def _delete_bulk(self, batch: List[discord.Message]):
+        if not batch:
+            return
+        try:
+            await self.channel.delete_messages(batch)
+            self.deleted += len(batch)
+        except discord.HTTPException as e:
+            # Mensajes ya borrados o un error de la API: se sigue con el resto
+            self.failed += len(batch)
+            print(f"[Purga] Falló un lote de {len(batch)} mensajes en {self.channel.id}: {e}")
+
+    async def _matches(self, message: discord.Message) -> bool:
+        if not self.check(message):
+            return False
+        if self.pattern is None:
+            return True
+        return await bot.loop.run_in_executor(None, self.pattern.search, message.content) is not None
+
+    async def run(self):
+        batch: List[discord.Message] = []
+        bulk_cutoff = discord.utils.utcnow() - PURGE_BULK_MAX_AGE
+        try:
+            async for message in self.channel.history(limit=PURGE_MAX_SCAN, after=self.after, oldest_first=False):
+                if self.cancelled or self.deleted + len(batch) >= self.limit:
+                    break
+                self.scanned += 1
+                if not await self._matches(message):
+                    continue
+
+                if message.created_at > bulk_cutoff:
+                    batch.append(message)
+                    if len(batch) >= PURGE_BULK_SIZE:
+                        await self._delete_bulk(batch)
+                        batch = []
+                    continue
+
+                # A partir de aquí el historial es más antiguo que 14 días
+                await self._delete_bulk(batch)
+                batch = []
+                try:
+                    await message.delete()
+                    self.deleted += 1
+                except discord.NotFound:
+                    pass
+                except discord.HTTPException:
+                    self.failed += 1
+                await asyncio.sleep(PURGE_SINGLE_DELAY)
+
+            if not self.cancelled:
+                await self._delete_bulk(batch)
+        finally:
+            self.finished = True
+
+
+class PurgeView(ui.View):
+    def __init__(self, job: PurgeJob):
+        super().__init__(timeout=None)
+        self.job = job
+
+    @ui.button(label="Cancelar", style=discord.ButtonStyle.red)
+    async def cancel(self, interaction: discord.Interaction, button: ui.Button):
+        self.job.cancel()
+        button.disabled = True
+        await interaction.response.edit_message(content=self.job.status(), view=self)
+
+
+purge_jobs: Dict[int, PurgeJob] = {}  # Channel ID -> trabajo en curso
+
+async def run_purge_job(interaction: discord.Interaction, job: PurgeJob, view: PurgeView):
+    task = asyncio.create_task(job.run())
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=PURGE_PROGRESS_INTERVAL)
+            if not task.done():
+                try:
+                    await interaction.edit_original_response(content=job.status(), view=view)
+                except discord.HTTPException:
+                    pass
+        task.result()
+    except Exception as e:
+        print(f"Error en purga: {traceback.format_exc()}")
+        await interaction.followup.send(f"❌ Error al borrar mensajes: {e}", ephemeral=True)
+    finally:
+        purge_jobs.pop(job.channel.id, None)
+        view.stop()
+        try:
+            await interaction.edit_original_response(content=job.status(), view=None)
+        except discord.HTTPException:
+            pass
+
 @bot.tree.command(name="limpiar", description="Borra mensajes en el canal")
-@app_commands.describe(cantidad="Número de mensajes a borrar (1-100)")
+@app_commands.describe(
+    cantidad=f"Número máximo de mensajes a borrar (1-{PURGE_MAX_DELETE})",
+    usuario="Sólo mensajes de este usuario",
+    patron="Sólo mensajes cuyo contenido coincida con esta expresión regular",
+    adjuntos="Sólo mensajes con archivos adjuntos",
+    minutos="Sólo mensajes de los últimos N minutos"
+)
 @app_commands.default_permissions(manage_messages=True)
-async def limpiar(interaction: discord.Interaction, cantidad: int):
+async def limpiar(interaction: discord.Interaction, cantidad: int, usuario: Optional[discord.User] = None,
+                  patron: Optional[str] = None, adjuntos: bool = False, minutos: Optional[int] = None):
     if not await is_staff(interaction.user):
         return await interaction.response.send_message("❌ Solo el staff puede usar este comando.", ephemeral=True)
     
-    cantidad = min(100, max(1, cantidad))
+    if interaction.channel.id in purge_jobs:
+        return await interaction.response.send_message("❌ Ya hay una limpieza en curso en este canal.", ephemeral=True)
+    
+    cantidad = min(PURGE_MAX_DELETE, max(1, cantidad))
     
-    # Primero respondemos a la interacción
-    await interaction.response.defer(ephemeral=True)
+    regex = None
+    if patron:
+        if len(patron) > PURGE_PATTERN_MAX:
+            return await interaction.response.send_message(
+                f"❌ La expresión regular es demasiado larga (máx. {PURGE_PATTERN_MAX} caracteres).", ephemeral=True)
+        try:
+            regex = re.compile(patron, re.IGNORECASE)
+        except re.error:
+            return await interaction.response.send_message("❌ Expresión regular inválida.", ephemeral=True)
     
-    # Luego purgamos los mensajes
-    deleted = await interaction.channel.purge(limit=cantidad)
+    def check(message: discord.Message) -> bool:
+        if message.pinned:
+            return False
+        if usuario and message.author.id != usuario.id:
+            return False
+        if adjuntos and not message.attachments:
+            return False
+        return True
     
-    # Finalmente enviamos la confirmación
-    await interaction.followup.send(
-        f"🧹 Se borraron {len(deleted)} mensajes.",
-        ephemeral=True
-    )
+    after = discord.utils.utcnow() - timedelta(minutes=minutos) if minutos and minutos > 0 else None
+    job = PurgeJob(interaction.channel, cantidad, check, after, regex)
+    view = PurgeView(job)
+    purge_jobs[interaction.channel.id] = job
+    
+    await interaction.response.send_message(job.status(), view=view, ephemeral=True)
+    
+    # El trabajo corre en segundo plano y no bloquea otros comandos
+    asyncio.create_task(run_purge_job(interaction, job, view))
 
 
 
-async def post_music_commands():
-    channel = bot.get_channel(MUSIC_COMMANDS_CHANNEL_ID)
+async def post_music_commands(guild: discord.Guild):
+    channel = get_guild_channel(guild, guild_configs.get(guild.id).music_commands_channel_id)
     if not channel:
-        print("❌ Canal de comandos musicales no encontrado.")
         return
 
     # Verifica si ya existe el mensaje fijado
@@ -1138,21 +4221,32 @@ async def post_music_commands():
     embed.add_field(
         name="🎵 Reproducción de Música",
         value=(
-            "`!play <nombre o link>` — Reproduce o agrega una canción\n"
+            "`!play <nombre o link>` — Reproduce o agrega canciones (varias separadas por `;` o líneas)\n"
             "`!skip` — Salta la canción actual\n"
             "`!stop` — Detiene todo y desconecta\n"
             "`!pause` / `!resume` — Pausa o reanuda\n"
+            "`!volume <0-200>` / `!duck on/off` — Volumen y ducking al instante\n"
             "`!nowplaying` / `!np` — Muestra la canción actual"
         ),
         inline=False
     )
 
+    embed.add_field(
+        name="⚡ Comandos de barra",
+        value=(
+            "`/play` — Igual que `!play`, con respuesta inmediata y progreso\n"
+            "`/queue` — Panel de control con botones (se actualiza solo)\n"
+            "`/skip` · `/pause` · `/loop` · `/nowplaying` · `/stop`"
+        ),
+        inline=False
+    )
+
     embed.add_field(
         name="🧾 Cola y Historial",
         value=(
             "`!queue` / `!q` — Muestra la cola\n"
             "`!history [número]` — Ver historial (máx. 20)\n"
-            "`!replay <número>` — Reproduce una canción del historial"
+            "`!replay <número|título>` — Reproduce una canción ya escuchada"
         ),
         inline=False
     )
@@ -1193,13 +4287,15 @@ async def post_music_commands():
         name="🛡️ Moderación y Soporte (Staff)",
         value=(
             "`/ticket` — Crear ticket de soporte\n"
+            "`/tickets` — Estadísticas de tickets\n"
             "`/advertir` — Enviar advertencia\n"
             "`/mutear` / `/desmutear` — Silenciar o restaurar voz\n"
             "`/banear` — Expulsar usuarios\n"
             "`/infracciones` — Ver historial disciplinario\n"
-            "`/limpiar` — Borrar mensajes\n"
+            "`/limpiar` — Borrar mensajes (filtros por usuario, texto, adjuntos o tiempo)\n"
             "`/modpanel` — Panel de herramientas\n"
-            "`/limpiar_infracciones` — Eliminar historial disciplinario"
+            "`/limpiar_infracciones` — Eliminar historial disciplinario\n"
+            "`/configurar` / `/staff_rol` — Configuración del servidor (admins)"
         ),
         inline=False
     )
@@ -1213,6 +4309,439 @@ async def post_music_commands():
     except Exception as e:
         print(f"❌ Error al enviar o fijar el embed: {e}")
 
+# --------------------------
+# Diagnóstico de memoria
+# --------------------------
+
+def deep_sizeof(obj, seen: Optional[set] = None) -> int:
+    """Tamaño aproximado de un objeto y todo lo que contiene (sin contar dos veces)"""
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset, deque)):
+            stack.extend(current)
+    return total
+
+
+def guild_memory_report() -> List[tuple]:
+    """(guild_id, cola/estado, historial, playlists) en bytes, de mayor a menor"""
+    state_maps = [music_queue.queues, music_queue.current, music_queue.loop_modes, music_queue.autoplay_enabled,
+                  music_queue.resume_attempts, music_queue.volumes, music_queue.ducked, music_queue.is_playing]
+    guild_ids = set(song_history) | set(music_queue.playlists)
+    for state_map in state_maps:
+        guild_ids |= set(state_map)
+
+    rows = []
+    for guild_id in guild_ids:
+        state = sum(deep_sizeof(state_map[guild_id]) for state_map in state_maps if guild_id in state_map)
+        history = deep_sizeof(song_history.get(guild_id, []))
+        playlists = deep_sizeof(music_queue.playlists.get(guild_id, {}))
+        rows.append((guild_id, state, history, playlists))
+    rows.sort(key=lambda row: -(row[1] + row[2] + row[3]))
+    return rows
+
+
+def largest_objects(limit: int = MEMPROF_TOP) -> List[tuple]:
+    """Contenedores retenidos más grandes según su tamaño superficial"""
+    sized = []
+    for obj in gc.get_objects():
+        if isinstance(obj, (dict, list, set, deque)):
+            sized.append((sys.getsizeof(obj), type(obj).__name__, len(obj)))
+    sized.sort(reverse=True)
+    return sized[:limit]
+
+
+def resident_memory() -> int:
+    """RSS actual en bytes (0 si no se puede leer)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def format_bytes(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+class MemoryProfiler:
+    """Snapshots de tracemalloc con diff contra el anterior.
+
+    Tomar y comparar snapshots es lento con muchas trazas: `snapshot_diff` y
+    `write_entry` corren en un executor, nunca en el event loop.
+    """
+
+    def __init__(self):
+        self.last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+    @staticmethod
+    def start():
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMPROF_FRAMES)
+
+    def snapshot_diff(self) -> List[str]:
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        lines = []
+        if self.last_snapshot is None:
+            for stat in snapshot.statistics('lineno')[:MEMPROF_TOP]:
+                lines.append(f"{format_bytes(stat.size)} ({stat.count}) {stat.traceback[0]}")
+        else:
+            for stat in snapshot.compare_to(self.last_snapshot, 'lineno')[:MEMPROF_TOP]:
+                lines.append(f"{'+' if stat.size_diff >= 0 else ''}{format_bytes(stat.size_diff)} "
+                             f"→ {format_bytes(stat.size)} {stat.traceback[0]}")
+        self.last_snapshot = snapshot
+        return lines
+
+    @staticmethod
+    def periodic_entry() -> Dict:
+        # Contadores del estado del bot: se leen en el event loop, que es su dueño
+        return {
+            'fecha': datetime.now().isoformat(),
+            'rss': resident_memory(),
+            'guilds': len(bot.guilds),
+            'voice_clients': len(bot.voice_clients),
+            'queued_songs': sum(len(q) for q in music_queue.queues.values()),
+            'history_songs': sum(len(h) for h in song_history.values()),
+            'playlists': sum(len(p) for p in music_queue.playlists.values()),
+        }
+
+    def write_entry(self, entry: Dict):
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            entry['traced'] = current
+            entry['traced_peak'] = peak
+            entry['top'] = [
+                {'size': stat.size, 'count': stat.count, 'where': str(stat.traceback[0])}
+                for stat in tracemalloc.take_snapshot().statistics('lineno')[:MEMPROF_TOP]
+            ]
+        with open(MEMPROF_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+memory_profiler = MemoryProfiler()
+if MEMPROF_ENABLED:
+    memory_profiler.start()
+
+@tasks.loop(minutes=MEMPROF_INTERVAL)
+async def memprof_loop():
+    try:
+        entry = memory_profiler.periodic_entry()
+        await bot.loop.run_in_executor(None, memory_profiler.write_entry, entry)
+    except Exception:
+        print(f"Error en snapshot de memoria: {traceback.format_exc()}")
+
+@bot.command(name="mem")
+async def mem_command(ctx, action: str = None):
+    """Diagnóstico de memoria (solo dueños). Subcomandos: start, stop, snapshot, guilds, top"""
+    if ctx.author.id not in OWNER_IDS:
+        return await ctx.send("❌ Solo los dueños del bot pueden usar este comando.")
+    
+    if not action:
+        tracing = "activo" if tracemalloc.is_tracing() else "inactivo"
+        return await ctx.send(
+            f"🧠 **Memoria:** RSS {format_bytes(resident_memory())} | tracemalloc {tracing}\n"
+            "`!mem start` / `!mem stop` — Activa o detiene tracemalloc\n"
+            "`!mem snapshot` — Snapshot y diff contra el anterior\n"
+            "`!mem guilds` — Memoria aproximada por servidor\n"
+            "`!mem top` — Objetos retenidos más grandes"
+        )
+    
+    action = action.lower()
+    
+    if action == "start":
+        memory_profiler.start()
+        await ctx.send("✅ tracemalloc activado")
+    
+    elif action == "stop":
+        tracemalloc.stop()
+        memory_profiler.last_snapshot = None
+        await ctx.send("⏹️ tracemalloc detenido")
+    
+    elif action == "snapshot":
+        if not tracemalloc.is_tracing():
+            return await ctx.send("❌ tracemalloc no está activo. Usa `!mem start`")
+        lines = await bot.loop.run_in_executor(None, memory_profiler.snapshot_diff)
+        current, peak = tracemalloc.get_traced_memory()
+        header = f"📸 Trazado: {format_bytes(current)} (pico {format_bytes(peak)})"
+        await ctx.send(header + "\n```\n" + "\n".join(lines)[:1800] + "\n```")
+    
+    elif action == "guilds":
+        rows = guild_memory_report()
+        if not rows:
+            return await ctx.send("📭 No hay estado de música en memoria")
+        lines = [f"{'servidor':<20}{'estado':>10}{'historial':>11}{'playlists':>11}"]
+        for guild_id, state, history, playlists in rows[:MEMPROF_TOP]:
+            lines.append(f"{guild_id:<20}{format_bytes(state):>10}{format_bytes(history):>11}{format_bytes(playlists):>11}")
+        total = sum(row[1] + row[2] + row[3] for row in rows)
+        await ctx.send(f"🏠 **{len(rows)} servidores** — total {format_bytes(total)}\n```\n" + "\n".join(lines) + "\n```")
+    
+    elif action == "top":
+        rows = await bot.loop.run_in_executor(None, largest_objects)
+        lines = [f"{format_bytes(size):>10} {kind:<6} len={length}" for size, kind, length in rows]
+        await ctx.send("📦 **Objetos más grandes:**\n```\n" + "\n".join(lines) + "\n```")
+    
+    else:
+        await ctx.send("❌ Subcomando no válido. Usa `!mem` para ver opciones")
+
+# --------------------------
+# Mantenimiento de la base
+# --------------------------
+
+class DatabaseMaintenance:
+    """Retención, archivo y compactación de `moderacion.db`.
+
+    Corre en un hilo con su propia conexión, así nunca bloquea el event loop.
+    Las filas vencidas se mueven a `archivo` en bloques comprimidos de
+    `MAINTENANCE_BATCH` filas, cada bloque en su propia transacción corta para
+    no retener el lock de escritura. Después se devuelven páginas libres con
+    incremental_vacuum y se corre PRAGMA optimize.
+
+    Una base creada antes de auto_vacuum incremental necesita un VACUUM completo
+    que la reescribe y bloquea las escrituras mientras dura. Nunca se hace en la
+    corrida automática: sólo cuando un dueño lanza `!mantenimiento run`.
+    """
+
+    # Consultas calientes del bot: su plan se revisa antes y después de cada corrida
+    PLAN_QUERIES = {
+        'advertencias de un usuario': ('SELECT fecha FROM infracciones WHERE user_id = ? AND guild_id = ? ORDER BY fecha', (0, 0)),
+        'retención de infracciones': ('SELECT rowid FROM infracciones WHERE guild_id = ? AND fecha < ?', (0, '')),
+        'tickets abiertos de un usuario': ("SELECT COUNT(*) FROM tickets WHERE guild_id = ? AND creator_id = ? AND estado = 'abierto'", (0, 0)),
+        'tickets por estado': ('SELECT estado, COUNT(*) FROM tickets WHERE guild_id = ? GROUP BY estado', (0,)),
+        'spotify por ISRC': ('SELECT video_id FROM spotify_map WHERE isrc = ?', ('',)),
+    }
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self.running = False
+        self.last_run_date = None
+        self.last_report: Optional[Dict] = None
+
+    def inspect(self, conn: sqlite3.Connection) -> Dict:
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        pages = conn.execute('PRAGMA page_count').fetchone()[0]
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        rows = {
+            table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            for table in ('infracciones', 'tickets', 'archivo')
+        }
+        plans = {}
+        for name, (sql, params) in self.PLAN_QUERIES.items():
+            steps = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+            # Sano: sin recorrer tablas enteras ni ordenar en un B-tree temporal
+            healthy = not any(
+                (step.startswith('SCAN') and 'INDEX' not in step) or 'TEMP B-TREE' in step
+                for step in steps
+            )
+            plans[name] = (healthy, ' | '.join(steps))
+        return {'size': pages * page_size, 'free': free_pages * page_size, 'rows': rows, 'plans': plans}
+
+    def _archive(self, conn: sqlite3.Connection, guild_id: int, table: str, date_column: str,
+                 condition: str, cutoff: str) -> int:
+        archived = 0
+        while True:
+            cursor = conn.execute(f'''
+            SELECT rowid, * FROM {table}
+            WHERE guild_id = ? AND {date_column} < ? {condition}
+            ORDER BY {date_column} LIMIT ?
+            ''', (guild_id, cutoff, MAINTENANCE_BATCH))
+            rows = cursor.fetchall()
+            if not rows:
+                return archived
+            columns = [column[0] for column in cursor.description][1:]
+            records = [dict(zip(columns, row[1:])) for row in rows]
+            payload = zlib.compress(json.dumps(records, ensure_ascii=False).encode('utf-8'), 9)
+            with conn:
+                conn.execute('''
+                INSERT INTO archivo (guild_id, tabla, desde, hasta, filas, datos, fecha)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (guild_id, table, records[0][date_column], records[-1][date_column], len(records),
+                      payload, datetime.now().isoformat()))
+                conn.executemany(f'DELETE FROM {table} WHERE rowid = ?', [(row[0],) for row in rows])
+            archived += len(rows)
+
+    def archive_expired(self, conn: sqlite3.Connection) -> Dict[str, int]:
+        retention = dict(conn.execute('SELECT guild_id, retention_days FROM guild_config WHERE retention_days IS NOT NULL'))
+        guild_ids = [guild_id for (guild_id,) in conn.execute(
+            'SELECT DISTINCT guild_id FROM infracciones UNION SELECT DISTINCT guild_id FROM tickets'
+        )]
+        archived = {'infracciones': 0, 'tickets': 0}
+        for guild_id in guild_ids:
+            days = retention.get(guild_id) or RETENTION_DAYS
+            cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+            # Nunca se archiva una advertencia que todavía cuenta para la escalada:
+            # sin caducidad (WARNING_DECAY_DAYS falso) cuentan todas y no se archiva ninguna
+            if WARNING_DECAY_DAYS:
+                warning_cutoff = (datetime.now() - timedelta(days=max(days, WARNING_DECAY_DAYS))).isoformat()
+                archived['infracciones'] += self._archive(conn, guild_id, 'infracciones', 'fecha', '', warning_cutoff)
+            archived['tickets'] += self._archive(conn, guild_id, 'tickets', 'cerrado', "AND estado = 'cerrado'", cutoff)
+        return archived
+
+    def run(self, convert: bool = False) -> Dict:
+        started = time.perf_counter()
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        pending_conversion = False
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            before = self.inspect(conn)
+            archived = self.archive_expired(conn)
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                # Una sola vez: pasar a auto_vacuum incremental exige reconstruir el archivo
+                if convert:
+                    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                    conn.execute('VACUUM')
+                else:
+                    pending_conversion = True
+            else:
+                # execute() da un solo paso (una página); executescript corre el pragma hasta el final
+                conn.executescript(f'PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES});')
+            conn.execute('PRAGMA optimize')
+            after = self.inspect(conn)
+        finally:
+            conn.close()
+        return {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'duracion': time.perf_counter() - started,
+            'archivadas': archived,
+            'antes': before,
+            'despues': after,
+            'conversion_pendiente': pending_conversion,
+        }
+
+    async def run_async(self, convert: bool = False) -> Optional[Dict]:
+        if self.running:
+            return None
+        self.running = True
+        try:
+            report = await bot.loop.run_in_executor(None, self.run, convert)
+        finally:
+            self.running = False
+        self.last_report = report
+        self.last_run_date = datetime.now().date()
+        # Las filas archivadas ya no contaban para la escalada: la caché de infracciones sigue siendo válida
+        print(f"[DB] Mantenimiento: {report['archivadas']} archivadas, "
+              f"{format_bytes(report['antes']['size'])} -> {format_bytes(report['despues']['size'])} "
+              f"en {report['duracion']:.1f}s")
+        if report['conversion_pendiente']:
+            print("[DB] La base aún no usa auto_vacuum incremental: ejecuta `!mantenimiento run` para convertirla")
+        return report
+
+
+db_maintenance = DatabaseMaintenance()
+
+def format_maintenance_report(report: Dict) -> str:
+    before, after = report['antes'], report['despues']
+    lines = [
+        f"{'':<32}{'antes':>12}{'después':>12}",
+        f"{'tamaño':<32}{format_bytes(before['size']):>12}{format_bytes(after['size']):>12}",
+        f"{'páginas libres':<32}{format_bytes(before['free']):>12}{format_bytes(after['free']):>12}",
+    ]
+    for table in before['rows']:
+        lines.append(f"{'filas ' + table:<32}{before['rows'][table]:>12}{after['rows'][table]:>12}")
+    lines.append("")
+    for name, (healthy, plan) in after['plans'].items():
+        was_healthy = before['plans'][name][0]
+        lines.append(f"{'✅' if healthy else '⚠️'} {name}{'' if was_healthy == healthy else ' (cambió)'}: {plan}")
+    return "\n".join(lines)
+
+@tasks.loop(minutes=MAINTENANCE_CHECK_MINUTES)
+async def maintenance_loop():
+    now = datetime.now()
+    start, end = MAINTENANCE_WINDOW
+    if not start <= now.hour < end or db_maintenance.last_run_date == now.date():
+        return
+    try:
+        await db_maintenance.run_async()
+    except Exception:
+        print(f"Error en mantenimiento de la base: {traceback.format_exc()}")
+
+@bot.command(name="mantenimiento")
+async def maintenance_command(ctx, action: str = None):
+    """Mantenimiento de la base (solo dueños). Subcomandos: run
+
+    `run` además hace, una sola vez, el VACUUM completo que pasa una base
+    antigua a auto_vacuum incremental; bloquea las escrituras mientras dura,
+    así que conviene lanzarlo en horas de poca actividad.
+    """
+    if ctx.author.id not in OWNER_IDS:
+        return await ctx.send("❌ Solo los dueños del bot pueden usar este comando.")
+
+    if action == "run":
+        if db_maintenance.running:
+            return await ctx.send("⏳ Ya hay un mantenimiento en curso.")
+        await ctx.send("🧹 Ejecutando mantenimiento...")
+        report = await db_maintenance.run_async(convert=True)
+    else:
+        report = db_maintenance.last_report
+        if not report:
+            return await ctx.send(
+                f"📭 Todavía no hubo mantenimiento (ventana {MAINTENANCE_WINDOW[0]}-{MAINTENANCE_WINDOW[1]} h). "
+                "Usa `!mantenimiento run` para ejecutarlo ahora."
+            )
+
+    archivadas = report['archivadas']
+    await ctx.send(
+        f"🗄️ **Mantenimiento del {report['fecha']}** ({report['duracion']:.1f}s) — archivadas "
+        f"{archivadas['infracciones']} infracciones y {archivadas['tickets']} tickets\n"
+        f"```\n{format_maintenance_report(report)[:1800]}\n```"
+        + ("\n⚠️ La base aún no usa auto_vacuum incremental: `!mantenimiento run` la convierte "
+           "(VACUUM completo, bloquea escrituras)." if report.get('conversion_pendiente') else "")
+    )
+
+@bot.command(name="biblioteca")
+async def library_command(ctx, action: str = None):
+    """Estado de la biblioteca local (solo dueños). Subcomandos: scan"""
+    if ctx.author.id not in OWNER_IDS:
+        return await ctx.send("❌ Solo los dueños del bot pueden usar este comando.")
+    if not media_library.enabled():
+        return await ctx.send("❌ Biblioteca local desactivada. Configura `MUSIC_LIBRARY` con un directorio válido.")
+
+    if action == "scan":
+        if media_library.scanning:
+            return await ctx.send("⏳ Ya hay un escaneo en curso.")
+        await ctx.send("🔎 Escaneando biblioteca...")
+        await media_library.scan_async()
+
+    scan = media_library.last_scan
+    if not scan:
+        return await ctx.send("⏳ La biblioteca todavía no terminó su primer escaneo.")
+    await ctx.send(
+        f"📚 **Biblioteca:** {scan['total']} archivos en `{media_library.root}`\n"
+        f"Último escaneo {scan['fecha']} ({scan['duracion']:.1f}s): {scan['nuevos']} nuevos, "
+        f"{scan['actualizados']} actualizados, {scan['eliminados']} eliminados\n"
+        f"Canciones servidas desde la biblioteca: {media_library.hits}"
+    )
+
+@bot.command(name="carga")
+async def load_command(ctx):
+    """Estado del control de admisión (solo dueños)"""
+    if ctx.author.id not in OWNER_IDS:
+        return await ctx.send("❌ Solo los dueños del bot pueden usar este comando.")
+    stats = admission.stats()
+    encolados, rechazados = stats['encolados'], stats['rechazados']
+    await ctx.send(
+        f"🚦 **Admisión:** {stats['activas']}/{stats['capacidad']} extracciones activas, {stats['en_cola']} en cola\n"
+        f"🖥️ CPU {stats['cpu']:.0%} por núcleo | ffmpeg vivos: {stats['ffmpeg']}/{ADMISSION_MAX_FFMPEG}\n"
+        f"✅ Admitidos: {stats['admitidos']}\n"
+        f"⏳ Encolados: {encolados['usuario']} por límite de usuario/servidor, {encolados['global']} por presupuesto global\n"
+        f"⛔ Rechazados: {rechazados['usuario']} por límite, {rechazados['global']} por carga, {rechazados['ffmpeg']} por ffmpeg"
+    )
+
 @bot.command(name="shutdown")
 async def shutdown(ctx):
     """Apaga el bot (solo staff autorizado)"""
@@ -1220,9 +4749,295 @@ async def shutdown(ctx):
         return await ctx.send("❌ No tenés permisos para apagar el bot.")
 
     await ctx.send("🛑 Apagando bot... ¡Hasta luego!")
+    snapshot_loop.cancel()
+    await save_snapshot()
+    audio_workers.shutdown()
+    if trace_recorder:
+        trace_recorder.close()
     await bot.close()
 
 
+# --------------------------
+# Grabación de eventos del gateway
+# --------------------------
+
+class TraceRecorder:
+    """Graba los eventos del gateway en JSONL con los identificadores anonimizados.
+
+    Cada snowflake se reemplaza por un ID falso estable (hash con sal aleatoria
+    por grabación), así las relaciones entre servidores, canales y usuarios se
+    conservan sin exponer los reales. Nombres (de usuarios, servidores, canales,
+    roles y archivos), avatares, tokens y valores de texto se enmascaran; las
+    URLs de adjuntos se sustituyen y los embeds se vacían. El contenido de los
+    mensajes sólo se conserva si es un comando, y de los comandos de barra sólo
+    los nombres del comando y sus opciones.
+    """
+
+    MASKED_KEYS = {'username', 'global_name', 'nick', 'avatar', 'banner', 'email', 'token',
+                   'topic', 'session_id', 'resume_gateway_url', 'bio', 'filename', 'description'}
+    URL_KEYS = {'url', 'proxy_url'}
+    COMMAND_KEYS = {'data', 'options'}  # Estructuras de comandos: su 'name' se conserva
+    URL_PLACEHOLDER = 'https://anon.invalid/'
+    DROPPED_EVENTS = {'PRESENCE_UPDATE', 'TYPING_START'}
+
+    def __init__(self, path: str):
+        self.path = path
+        self.salt = secrets.token_bytes(16)
+        self.file = open(path, 'a', encoding='utf-8')
+        self.started = time.monotonic()
+        self.recorded = 0
+        self.ids: Dict[str, str] = {}
+        self._write({'type': 'header', 'started': datetime.now().isoformat(), 'config': self._config()})
+
+    def anonymize_id(self, value) -> str:
+        value = str(value)
+        if value not in self.ids:
+            digest = hashlib.blake2b(value.encode(), key=self.salt, digest_size=8).digest()
+            # Mantiene el formato de snowflake (entero de 18-19 dígitos)
+            self.ids[value] = str(10 ** 17 + int.from_bytes(digest, 'big') % (9 * 10 ** 17))
+        return self.ids[value]
+
+    def _config(self) -> Dict:
+        # IDs configurados, ya anonimizados, para que el replay pueda reasignarlos
+        return {
+            'STAFF_ROLES': [self.anonymize_id(role_id) for role_id in STAFF_ROLES],
+            'LOG_CHANNEL_ID': self.anonymize_id(LOG_CHANNEL_ID),
+            'TICKET_CATEGORY_ID': self.anonymize_id(TICKET_CATEGORY_ID),
+            'MUSIC_COMMANDS_CHANNEL_ID': self.anonymize_id(MUSIC_COMMANDS_CHANNEL_ID),
+            'OWNER_IDS': [self.anonymize_id(owner_id) for owner_id in OWNER_IDS],
+        }
+
+    SNOWFLAKE_PATTERN = re.compile(r"\d{15,20}")
+
+    @staticmethod
+    def _is_snowflake(value) -> bool:
+        return isinstance(value, (str, int)) and str(value).isdigit() and len(str(value)) >= 15
+
+    def _scrub(self, value, key: str = '', command: bool = False):
+        if key == 'embeds' and isinstance(value, list):
+            return [{} for _ in value]
+        if isinstance(value, dict):
+            # Los mapas "resolved" de las interacciones usan IDs como claves
+            return {
+                (self.anonymize_id(k) if self._is_snowflake(k) else k): self._scrub(v, k, key in self.COMMAND_KEYS)
+                for k, v in value.items()
+            }
+        if isinstance(value, list):
+            return [self._scrub(v, key, command) for v in value]
+        if key in self.URL_KEYS and isinstance(value, str):
+            return self.URL_PLACEHOLDER
+        masked = key in self.MASKED_KEYS or (key == 'name' and not command)
+        # Valores de opciones de texto: los numéricos (p. ej. duraciones) se conservan
+        masked = masked or (key == 'value' and not str(value).isdigit())
+        if masked and isinstance(value, str):
+            return f"anon-{self.anonymize_id(value)[-6:]}"
+        if self._is_snowflake(value) and (key in ('id', 'value', 'roles', 'mention_roles')
+                                          or key.endswith('_id') or key.endswith('_ids')):
+            return self.anonymize_id(value)
+        if key == 'content' and isinstance(value, str):
+            if not value.startswith(bot.command_prefix):
+                return 'x' * min(len(value), 200)
+            # Comandos: se conservan, con las menciones anonimizadas
+            return self.SNOWFLAKE_PATTERN.sub(lambda m: self.anonymize_id(m.group()), value)
+        return value
+
+    def _write(self, entry: Dict):
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def record(self, raw):
+        try:
+            payload = json.loads(raw)
+        except (TypeError, ValueError):
+            return
+        if payload.get('op') != 0 or payload.get('t') in self.DROPPED_EVENTS:
+            return
+        self._write({
+            'type': 'event',
+            'ts': round(time.monotonic() - self.started, 4),
+            't': payload['t'],
+            'd': self._scrub(payload.get('d'))
+        })
+        self.recorded += 1
+        if self.recorded % 100 == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.flush()
+        self.file.close()
+
+
+trace_recorder = TraceRecorder(TRACE_RECORD_PATH) if TRACE_RECORD_PATH and __name__ == "__main__" else None
+
+if trace_recorder:
+    @bot.event
+    async def on_socket_raw_receive(msg):
+        trace_recorder.record(msg)
+
+
+# --------------------------
+# Auto-moderación
+# --------------------------
+
+class SlidingWindowCounter:
+    """Contador de eventos en una ventana deslizante de cubetas de 1 segundo.
+
+    Memoria fija por contador y costo constante por evento.
+    """
+    __slots__ = ('window', 'counts', 'stamps')
+
+    def __init__(self, window: int):
+        self.window = window
+        self.counts = [0] * window
+        self.stamps = [0] * window
+
+    def hit(self, now: float) -> int:
+        """Registra un evento y devuelve cuántos hubo dentro de la ventana"""
+        second = int(now)
+        i = second % self.window
+        if self.stamps[i] != second:
+            self.stamps[i] = second
+            self.counts[i] = 0
+        self.counts[i] += 1
+        return self.count(now)
+
+    def count(self, now: float) -> int:
+        """Eventos dentro de la ventana, sin registrar uno nuevo"""
+        oldest = int(now) - self.window
+        return sum(c for c, t in zip(self.counts, self.stamps) if t > oldest)
+
+    def reset(self):
+        for i in range(self.window):
+            self.counts[i] = 0
+
+
+class UserActivity:
+    __slots__ = ('messages', 'last_hash', 'last_time', 'duplicates', 'punished_until')
+
+    def __init__(self):
+        self.messages = SlidingWindowCounter(AUTOMOD_USER_RATE[1])
+        self.last_hash = 0
+        self.last_time = 0.0
+        self.duplicates = 0
+        self.punished_until = 0.0
+
+
+class AutoModerator:
+    """Detector de spam y raids basado en ventanas deslizantes.
+
+    Sigue el ritmo de mensajes por usuario y por servidor, los mensajes
+    idénticos repetidos y las ráfagas de ingresos. El trabajo por mensaje es
+    constante y la cantidad de usuarios seguidos está acotada por un LRU.
+    """
+
+    def __init__(self):
+        self.users: OrderedDict = OrderedDict()  # (guild_id, user_id) -> UserActivity
+        self.guild_messages: Dict[int, SlidingWindowCounter] = {}
+        self.guild_joins: Dict[int, SlidingWindowCounter] = {}
+        self.raid_until: Dict[int, float] = {}
+        self.triggered = 0
+
+    def in_raid(self, guild_id: int, now: float) -> bool:
+        return self.raid_until.get(guild_id, 0) > now
+
+    def recent_joins(self, guild_id: int, now: float) -> int:
+        counter = self.guild_joins.get(guild_id)
+        return counter.count(now) if counter else 0
+
+    def _activity(self, guild_id: int, user_id: int) -> UserActivity:
+        key = (guild_id, user_id)
+        activity = self.users.get(key)
+        if activity is None:
+            activity = self.users[key] = UserActivity()
+            if len(self.users) > AUTOMOD_MAX_TRACKED:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(key)
+        return activity
+
+    def check_message(self, message: discord.Message) -> Optional[str]:
+        """Devuelve el motivo si el mensaje debe sancionarse"""
+        now = time.monotonic()
+        guild_id = message.guild.id
+
+        guild_counter = self.guild_messages.get(guild_id)
+        if guild_counter is None:
+            guild_counter = self.guild_messages[guild_id] = SlidingWindowCounter(AUTOMOD_GUILD_RATE[1])
+        # Un servidor concurrido no es un raid: el ritmo de mensajes sólo cuenta con ingresos recientes
+        if (guild_counter.hit(now) > AUTOMOD_GUILD_RATE[0]
+                and self.recent_joins(guild_id, now) >= AUTOMOD_RAID_MIN_JOINS):
+            self.raid_until[guild_id] = now + AUTOMOD_RAID_SECONDS
+
+        activity = self._activity(guild_id, message.author.id)
+        if activity.punished_until > now:
+            return None
+
+        # En modo raid los límites por usuario se reducen a la mitad
+        divisor = 2 if self.in_raid(guild_id, now) else 1
+        reason = None
+
+        if activity.messages.hit(now) > AUTOMOD_USER_RATE[0] // divisor:
+            reason = "Spam: demasiados mensajes en poco tiempo"
+
+        content_hash = hash(message.content.strip().lower()) if message.content else 0
+        if content_hash and content_hash == activity.last_hash and now - activity.last_time <= AUTOMOD_DUPLICATES[1]:
+            activity.duplicates += 1
+        else:
+            activity.duplicates = 1
+        activity.last_hash = content_hash
+        activity.last_time = now
+        if activity.duplicates >= max(2, AUTOMOD_DUPLICATES[0] // divisor):
+            reason = reason or "Spam: mensajes repetidos"
+
+        if reason:
+            activity.punished_until = now + AUTOMOD_MUTE_SECONDS
+            activity.messages.reset()
+            activity.duplicates = 0
+            self.triggered += 1
+        return reason
+
+    def check_join(self, member: discord.Member) -> bool:
+        """Registra un ingreso y devuelve True si el servidor está en modo raid"""
+        now = time.monotonic()
+        guild_id = member.guild.id
+        counter = self.guild_joins.get(guild_id)
+        if counter is None:
+            counter = self.guild_joins[guild_id] = SlidingWindowCounter(AUTOMOD_JOIN_BURST[1])
+        if counter.hit(now) >= AUTOMOD_JOIN_BURST[0]:
+            if not self.in_raid(guild_id, now):
+                log_channel = get_log_channel(member.guild)
+                if log_channel:
+                    message_scheduler.log(log_channel, f"🚨 Posible raid en **{member.guild.name}**: modo raid activado")
+            self.raid_until[guild_id] = now + AUTOMOD_RAID_SECONDS
+        return self.in_raid(guild_id, now)
+
+
+auto_moderator = AutoModerator()
+
+async def automod_punish(member: discord.Member, reason: str, channel=None):
+    """Sanciona por las vías normales: infracción registrada, mute y escalado"""
+    try:
+        total = await add_infraction(member.id, member.guild.id, f"[AutoMod] {reason}")
+        muted = await apply_mute(member, AUTOMOD_MUTE_SECONDS, reason)
+        accion = await apply_escalation(member, total)
+
+        log_channel = get_log_channel(member.guild)
+        if log_channel:
+            detalle = f"\n{accion}" if accion else ""
+            message_scheduler.log(log_channel, embed=discord.Embed(
+                title="🤖 Auto-moderación",
+                description=(
+                    f"**Usuario:** {member.mention}\n"
+                    f"**Motivo:** {reason}\n"
+                    f"**Canal:** {channel.mention if channel else '—'}\n"
+                    f"**Mute:** {'sí' if muted else 'no (falta el rol)'} | **Advertencias:** {total}"
+                    f"{detalle}"
+                ),
+                color=discord.Color.dark_red()
+            ))
+    except discord.HTTPException as e:
+        print(f"[AutoMod] Error sancionando a {member.id}: {e}")
+
+
 # --------------------------
 # Eventos
 # --------------------------
@@ -1230,27 +5045,80 @@ async def shutdown(ctx):
 @bot.event
 async def on_voice_state_update(member, before, after):
     if member != bot.user:
+        # Si el último oyente se fue del canal del bot, programar la desconexión
+        voice_client = member.guild.voice_client
+        if (before.channel and before.channel != after.channel and voice_client
+                and voice_client.channel == before.channel and not IdleReaper.has_listeners(voice_client)):
+            idle_reaper.mark_alone(member.guild.id)
         return
     
     if before.channel and not after.channel:
         music_queue.clear(before.channel.guild.id)
-        await music_queue.cancel_disconnect_timer(before.channel.guild.id)
+        idle_reaper.mark_active(before.channel.guild.id)
+        presence_manager.request()
     elif before.channel and after.channel and before.channel != after.channel:
-        await after.channel.send("🔊 Me han movido a este canal de voz")
+        message_scheduler.post(after.channel, "🔊 Me han movido a este canal de voz", key="moved")
+
+@bot.event
+async def on_message(message: discord.Message):
+    if (AUTOMOD_ENABLED and message.guild and not message.author.bot and isinstance(message.author, discord.Member)
+            and not await is_staff(message.author)):
+        # El staff queda fuera antes de contar: no altera estadísticas ni el modo raid
+        reason = auto_moderator.check_message(message)
+        if reason:
+            # La sanción corre aparte para no demorar el procesamiento del mensaje
+            asyncio.create_task(automod_punish(message.author, reason, message.channel))
+    await bot.process_commands(message)
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    if not AUTOMOD_ENABLED or member.bot:
+        return
+    if auto_moderator.check_join(member):
+        asyncio.create_task(apply_mute(member, AUTOMOD_RAID_SECONDS, "Ingreso durante modo raid"))
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    # Un canal de ticket borrado a mano no debe seguir contando como abierto
+    await close_ticket_record(channel.id, "Canal eliminado")
+
+@bot.event
+async def on_interaction(interaction: discord.Interaction):
+    # Los envíos de fondo ceden el paso a las respuestas de interacción
+    message_scheduler.note_interaction()
+    member_cache.remember(interaction.user)
+
+@bot.event
+async def on_command(ctx):
+    member_cache.remember(ctx.author)
 
 @bot.event
 async def on_ready():
     bot.add_view(TicketView())
+    bot.add_view(MusicPanel())
+    asyncio.create_task(ydl_pool.warm())
     await bot.tree.sync()
     print(f"✅ Bot listo como {bot.user}")
-    await bot.change_presence(activity=discord.Activity(
-        type=discord.ActivityType.listening,
-        name="!help"
-    ))
-    await post_music_commands()
+    presence_manager.last_name = None  # Tras reconectar, la presencia se vuelve a enviar
+    presence_manager.request()
+    for guild in bot.guilds:
+        await post_music_commands(guild)
+    if not snapshot_loop.is_running():
+        # Sólo en el primer on_ready: los reconnects del gateway no deben restaurar de nuevo
+        await restore_snapshot()
+        snapshot_loop.start()
+        reaper_loop.start()
+        if audio_workers.enabled():
+            worker_health_loop.start()
+        memprof_loop.start()
+        maintenance_loop.start()
+        if media_library.enabled():
+            library_loop.start()
 
 # --------------------------
 # Ejecución del Bot
 # --------------------------
 
-bot.run(os.getenv("TOKEN"))
+# Los workers de audio importan este módulo al arrancar: sólo el proceso principal conecta
+if __name__ == "__main__":
+    bot.run(os.getenv("TOKEN"))
@@ -0,0 +1,347 @@
+"""Reproduce una grabación del gateway contra el bot con REST y voz simulados.
+
+Uso:
+    TRACE_RECORD=trafico.jsonl python main.py     # grabar tráfico real
+    python replay.py trafico.jsonl --speed 10     # reproducirlo a 10x
+
+El bot se importa sin conectarse a Discord: las llamadas REST, la voz y
+yt-dlp se reemplazan por stubs con latencia configurable. Al terminar se
+informa la distribución de latencia por handler y el lag del event loop, para
+encontrar la carga a la que el despacho de comandos deja de dar abasto.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import traceback
+from collections import defaultdict
+from typing import Dict, List
+
+# --------------------------
+# Utilidades
+# --------------------------
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def load_trace(path: str):
+    header = {}
+    events = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry.get('type') == 'header':
+                # Una grabación puede tener varias sesiones: vale la configuración de la última
+                header = entry
+                events.clear()
+            elif entry.get('type') == 'event':
+                events.append(entry)
+    return header, events
+
+
+# --------------------------
+# Stubs de REST y voz
+# --------------------------
+
+class Stats:
+    def __init__(self):
+        self.handlers: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.loop_lag: List[float] = []
+        self.rest_calls: Dict[str, int] = defaultdict(int)
+        self.dispatched = 0
+
+
+class FakeVoiceClient:
+    """Cliente de voz que no envía audio: cada pista "dura" track_seconds"""
+
+    def __init__(self, channel, track_seconds: float):
+        self.channel = channel
+        self.guild = channel.guild
+        self.latency = 0.05
+        self.track_seconds = track_seconds
+        self._connected = True
+        self._playing = False
+        self._paused = False
+        self._timer = None
+        self._after = None
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._playing and not self._paused
+
+    def is_paused(self):
+        return self._paused
+
+    def play(self, source, *, after=None):
+        self._playing = True
+        self._after = after
+        self._timer = asyncio.get_running_loop().call_later(self.track_seconds, self._finish, None)
+
+    def _finish(self, error):
+        self._playing = False
+        self._paused = False
+        after, self._after = self._after, None
+        if after:
+            after(error)
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+        if self._playing:
+            self._finish(None)
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self._connected = False
+        self.guild._state._remove_voice_client(self.guild.id)
+
+
+def fake_message(bot, channel_id) -> Dict:
+    return {
+        'id': str(int(time.time() * 1000) << 22),
+        'channel_id': str(channel_id or 0),
+        'author': {
+            'id': str(bot.user.id if bot.user else 0),
+            'username': 'replay-bot',
+            'discriminator': '0000',
+            'avatar': None,
+            'bot': True,
+        },
+        'content': '',
+        'timestamp': '2024-01-01T00:00:00+00:00',
+        'edited_timestamp': None,
+        'tts': False,
+        'mention_everyone': False,
+        'mentions': [],
+        'mention_roles': [],
+        'attachments': [],
+        'embeds': [],
+        'pinned': False,
+        'type': 0,
+    }
+
+
+def install_stubs(main, stats: Stats, rest_latency: float, extract_latency: float, track_seconds: float):
+    import discord
+
+    bot = main.bot
+
+    async def stub_request(route, **kwargs):
+        stats.rest_calls[f"{route.method} {route.path}"] += 1
+        await asyncio.sleep(rest_latency)
+        path = route.path
+        if route.method == 'GET' and path.endswith('/pins'):
+            return []
+        if path.startswith('/applications/') and path.endswith('/commands'):
+            return []
+        if path.endswith('/callback'):
+            return {'interaction': {'id': '0', 'type': 2}}
+        if path.endswith('/messages') or '/webhooks/' in path:
+            return fake_message(bot, getattr(route, 'channel_id', None))
+        return {}
+
+    bot.http.request = stub_request
+
+    async def stub_change_presence(*args, **kwargs):
+        stats.rest_calls['GATEWAY presence'] += 1
+
+    bot.change_presence = stub_change_presence
+
+    async def stub_connect(channel, *args, **kwargs):
+        await asyncio.sleep(rest_latency)
+        voice_client = FakeVoiceClient(channel, track_seconds)
+        channel.guild._state._add_voice_client(channel.guild.id, voice_client)
+        return voice_client
+
+    discord.VoiceChannel.connect = stub_connect
+    discord.StageChannel.connect = stub_connect
+
+    async def stub_extract_info(query: str) -> Dict:
+        await asyncio.sleep(extract_latency)
+        title = query.replace('ytsearch:', '')
+        return {
+            'url': f"stub://{abs(hash(title))}",
+            'title': title,
+            'duration': 180,
+            'webpage_url': f"https://stub.invalid/{abs(hash(title))}",
+        }
+
+    main.ydl_pool.extract_info = stub_extract_info
+
+    async def stub_start_playback(guild_id, voice_client, song, start_at: float = 0.0):
+        tracked = main.TrackedSource(discord.AudioSource(), start_at)
+        main.music_queue.sources[guild_id] = tracked
+        voice_client.play(tracked, after=lambda e: asyncio.ensure_future(main.on_track_end(guild_id, tracked, e)))
+
+    main.start_playback = stub_start_playback
+
+
+def install_probes(bot, stats: Stats):
+    original_run_event = bot._run_event
+
+    async def timed_run_event(coro, event_name, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            await original_run_event(coro, event_name, *args, **kwargs)
+        finally:
+            stats.handlers[event_name].append((time.perf_counter() - start) * 1000)
+
+    bot._run_event = timed_run_event
+
+    original_call = bot.tree._call
+
+    async def timed_call(interaction):
+        start = time.perf_counter()
+        name = f"/{interaction.data.get('name', '?')}" if interaction.data else '/?'
+        try:
+            await original_call(interaction)
+        except Exception:
+            stats.errors[name] += 1
+        finally:
+            stats.handlers[name].append((time.perf_counter() - start) * 1000)
+
+    bot.tree._call = timed_call
+
+    async def on_error(event_method, *args, **kwargs):
+        stats.errors[event_method] += 1
+
+    bot.on_error = on_error
+
+    async def on_command_error(ctx, error):
+        stats.errors[f"!{ctx.command.name if ctx.command else '?'}"] += 1
+
+    bot.on_command_error = on_command_error
+
+
+async def monitor_loop_lag(stats: Stats, interval: float = 0.05):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(max(0.0, (time.perf_counter() - start - interval) * 1000))
+
+
+# --------------------------
+# Reproducción
+# --------------------------
+
+def apply_config(main, config: Dict):
+    """Reasigna los IDs configurados a los anonimizados de la grabación"""
+    for name, value in config.items():
+        if isinstance(value, list):
+            setattr(main, name, [int(v) for v in value])
+        else:
+            setattr(main, name, int(value))
+
+
+async def replay(args):
+    header, events = load_trace(args.trace)
+    if not events:
+        print("❌ La grabación no tiene eventos")
+        return
+
+    # La base y los snapshots del bot se crean en un directorio descartable
+    trace_path = os.path.abspath(args.trace)
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(tempfile.mkdtemp(prefix='replay-'))
+    os.environ.pop('TRACE_RECORD', None)
+    sys.path.insert(0, repo_dir)
+    import main
+
+    apply_config(main, header.get('config', {}))
+    stats = Stats()
+    bot = main.bot
+    await bot._async_setup_hook()
+    bot._connection._chunk_guilds = False
+    install_stubs(main, stats, args.rest_latency / 1000, args.extract_latency / 1000, args.track_seconds)
+    install_probes(bot, stats)
+    await bot.setup_hook()
+
+    lag_task = asyncio.create_task(monitor_loop_lag(stats))
+    parsers = bot._connection.parsers
+    started = time.perf_counter()
+    first_ts = events[0]['ts']
+
+    print(f"▶️ Reproduciendo {len(events)} eventos de {trace_path} a {args.speed}x")
+    for entry in events:
+        target = (entry['ts'] - first_ts) / args.speed
+        delay = target - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        parser = parsers.get(entry['t'])
+        if not parser:
+            continue
+        try:
+            parser(entry['d'])
+            stats.dispatched += 1
+        except Exception:
+            stats.errors[f"parse:{entry['t']}"] += 1
+            if args.verbose:
+                traceback.print_exc()
+
+    # Dejar terminar los handlers pendientes
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - started
+    lag_task.cancel()
+    report(stats, elapsed)
+    admission = main.admission.stats()
+    print(f"\n🚦 Admisión: {admission['admitidos']} admitidos | encolados {admission['encolados']} | "
+          f"rechazados {admission['rechazados']}")
+
+
+def report(stats: Stats, elapsed: float):
+    print(f"\n📊 {stats.dispatched} eventos despachados en {elapsed:.1f}s ({stats.dispatched / elapsed:.1f} ev/s)\n")
+    print(f"{'handler':<32}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)")
+    for name, samples in sorted(stats.handlers.items(), key=lambda item: -percentile(item[1], 99)):
+        print(f"{name:<32}{len(samples):>7}{percentile(samples, 50):>10.1f}{percentile(samples, 95):>10.1f}"
+              f"{percentile(samples, 99):>10.1f}{max(samples):>10.1f}")
+
+    lag = stats.loop_lag
+    print(f"\n⏱️ Lag del event loop: p50 {percentile(lag, 50):.1f}ms | p99 {percentile(lag, 99):.1f}ms | "
+          f"max {max(lag) if lag else 0:.1f}ms")
+
+    if stats.errors:
+        print("\n❌ Errores:")
+        for name, count in sorted(stats.errors.items(), key=lambda item: -item[1]):
+            print(f"  {name}: {count}")
+
+    print(f"\n🌐 Llamadas REST simuladas: {sum(stats.rest_calls.values())}")
+    for name, count in sorted(stats.rest_calls.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {name}: {count}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Reproduce tráfico grabado del gateway contra el bot")
+    parser.add_argument('trace', help="Archivo JSONL grabado con TRACE_RECORD")
+    parser.add_argument('--speed', type=float, default=1.0, help="Multiplicador de velocidad (1-100)")
+    parser.add_argument('--rest-latency', type=float, default=50, help="Latencia simulada de REST (ms)")
+    parser.add_argument('--extract-latency', type=float, default=800, help="Latencia simulada de yt-dlp (ms)")
+    parser.add_argument('--track-seconds', type=float, default=30, help="Duración simulada de cada pista (s)")
+    parser.add_argument('--drain', type=float, default=5, help="Espera final para handlers pendientes (s)")
+    parser.add_argument('--verbose', action='store_true', help="Muestra las trazas de los errores de parseo")
+    args = parser.parse_args()
+    args.speed = min(100.0, max(1.0, args.speed))
+    asyncio.run(replay(args))
+
+
+if __name__ == "__main__":
+    main_cli()
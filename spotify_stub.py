@@ -0,0 +1,126 @@
+"""Stub local de la API de Spotify para probar la resolución sin red.
+
+Uso:
+    python spotify_stub.py --port 8765
+    SPOTIFY_CLIENT_ID=stub SPOTIFY_CLIENT_SECRET=stub \
+    SPOTIFY_API_URL=http://127.0.0.1:8765/v1/ \
+    SPOTIFY_TOKEN_URL=http://127.0.0.1:8765/api/token python main.py
+
+Responde /api/token, /v1/tracks, /v1/albums/<id>/tracks y
+/v1/playlists/<id>/tracks con datos deterministas derivados del ID, y cuenta
+cada llamada: así se verifica que los metadatos se piden por lotes, que el
+token se reutiliza y que las canciones ya mapeadas no vuelven a consultar.
+"""
+import argparse
+import hashlib
+import json
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ID_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+calls = defaultdict(int)
+calls_lock = threading.Lock()
+
+# --------------------------
+# Datos simulados
+# --------------------------
+
+def child_id(parent_id: str, index: int) -> str:
+    digest = hashlib.sha256(f"{parent_id}:{index}".encode()).digest()
+    return ''.join(ID_ALPHABET[byte % len(ID_ALPHABET)] for byte in digest[:22])
+
+
+def fake_track(track_id: str) -> dict:
+    number = int(hashlib.sha256(track_id.encode()).hexdigest()[:6], 16)
+    return {
+        'id': track_id,
+        'name': f"Canción {number % 1000}",
+        'artists': [{'name': f"Artista {number % 97}"}],
+        'duration_ms': 120000 + number % 180000,
+        'external_ids': {'isrc': f"STUB{number % 10 ** 8:08d}"},
+        'type': 'track',
+    }
+
+
+def paging(base_url: str, path: str, items: list, total: int, offset: int, limit: int) -> dict:
+    next_url = f"{base_url}{path}?offset={offset + limit}&limit={limit}" if offset + limit < total else None
+    return {'items': items, 'total': total, 'offset': offset, 'limit': limit, 'next': next_url}
+
+# --------------------------
+# Servidor
+# --------------------------
+
+class Handler(BaseHTTPRequestHandler):
+    collection_size = 120
+
+    def _send(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, name: str):
+        with calls_lock:
+            calls[name] += 1
+            print(f"[stub] {name} (total {calls[name]})")
+
+    def do_POST(self):
+        if urlparse(self.path).path.endswith('/api/token'):
+            self._count('token')
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            return self._send(200, {'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600})
+        self._send(404, {'error': {'status': 404, 'message': 'not found'}})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        base_url = f"http://{self.headers.get('Host')}"
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['20'])[0])
+
+        if parts[-1:] == ['tracks'] and len(parts) == 2:
+            ids = query.get('ids', [''])[0].split(',')
+            self._count(f"tracks x{len(ids)}")
+            if len(ids) > 50:
+                return self._send(400, {'error': {'status': 400, 'message': 'Too many ids requested'}})
+            return self._send(200, {'tracks': [fake_track(track_id) for track_id in ids]})
+
+        if len(parts) == 4 and parts[1] in ('albums', 'playlists') and parts[3] in ('tracks', 'items'):
+            kind, collection_id = parts[1], parts[2]
+            self._count(f"{kind}/tracks")
+            ids = [child_id(collection_id, i) for i in range(offset, min(offset + limit, self.collection_size))]
+            if kind == 'albums':
+                # Como la API real: canciones simplificadas, sin ISRC
+                items = [{key: value for key, value in fake_track(track_id).items() if key != 'external_ids'} for track_id in ids]
+            else:
+                items = [{'track': fake_track(track_id)} for track_id in ids]
+            return self._send(200, paging(base_url, url.path, items, self.collection_size, offset, limit))
+
+        self._send(404, {'error': {'status': 404, 'message': 'not found'}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Stub local de la API de Spotify")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--collection-size', type=int, default=120, help="Canciones por álbum/playlist simulados")
+    args = parser.parse_args()
+    Handler.collection_size = args.collection_size
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    print(f"🎧 Stub de Spotify en http://127.0.0.1:{args.port}/v1/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n📊 Llamadas: {dict(calls)}")
+
+
+if __name__ == "__main__":
+    main_cli()
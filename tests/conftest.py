@@ -0,0 +1,18 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("yt_dlp")
+pytest.importorskip("spotipy")
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    """main.py importado en un directorio temporal (crea moderacion.db al importarse)"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(Path(__file__).resolve().parent.parent))
+    sys.modules.pop("main", None)
+    return importlib.import_module("main")
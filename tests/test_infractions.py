@@ -0,0 +1,36 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def main(main, monkeypatch):
+    module = main
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE infracciones (id INTEGER PRIMARY KEY, user_id INTEGER, guild_id INTEGER, motivo TEXT, fecha TEXT)")
+    monkeypatch.setattr(module, "db_conn", conn)
+    monkeypatch.setattr(module, "db_cursor", conn.cursor())
+    monkeypatch.setattr(module, "infraction_cache", module.InfractionCache())
+    yield module
+    conn.close()
+
+
+def test_add_infraction_counts_stored_warnings_once(main):
+    for _ in range(3):
+        main.db_cursor.execute(
+            "INSERT INTO infracciones (user_id, guild_id, motivo, fecha) VALUES (?, ?, ?, ?)",
+            (1, 2, "previa", main.datetime.now().isoformat()),
+        )
+    main.db_conn.commit()
+
+    assert asyncio.run(main.add_infraction(1, 2, "nueva")) == 4
+    assert asyncio.run(main.get_infractions(1, 2)) == 4
+
+
+def test_escalation_fires_when_threshold_is_crossed(main):
+    alerta, maximo = main.ALERTA_ADVERTENCIAS, main.MAX_ADVERTENCIAS
+    assert main.crossed_threshold(alerta - 1, alerta) == alerta
+    assert main.crossed_threshold(alerta - 2, alerta + 1) == alerta
+    assert main.crossed_threshold(alerta - 1, maximo + 1) == maximo
+    assert main.crossed_threshold(alerta, alerta + 1) is None
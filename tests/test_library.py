@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+TRACKS = ("Artista - Canción de prueba.mp3", "Queen - Bohemian Rhapsody.mp3", "Otro - Tema uno.ogg")
+
+
+def write(path, data=b"audio"):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture(params=["fts", "like"])
+def library(main, tmp_path, request):
+    root = tmp_path / "musica"
+    root.mkdir()
+    for name in TRACKS:
+        write(root / name)
+    write(root / "notas.txt")
+    library = main.MediaLibrary(str(root), str(tmp_path / "biblioteca.db"))
+    if request.param == "like":
+        library.fts = False  # Como un SQLite compilado sin FTS5
+    return library
+
+
+def test_scan_is_incremental(library):
+    first = library.scan()
+    assert (first["total"], first["nuevos"], first["actualizados"], first["eliminados"]) == (3, 3, 0, 0)
+
+    again = library.scan()
+    assert (again["nuevos"], again["actualizados"], again["eliminados"]) == (0, 0, 0)
+
+    root = library.root
+    write(os.path.join(root, TRACKS[0]), b"audio modificado")
+    os.remove(os.path.join(root, TRACKS[1]))
+    write(os.path.join(root, "Nuevo - Tema dos.mp3"))
+    changed = library.scan()
+    assert (changed["total"], changed["nuevos"], changed["actualizados"], changed["eliminados"]) == (3, 1, 1, 1)
+    assert library.search("bohemian rhapsody") is None
+    assert library.search("tema dos")["title"] == "Nuevo - Tema dos"
+
+
+def test_search_matches_whole_words(library):
+    library.scan()
+    song = library.search("cancion prueba")
+    assert song["title"] == "Artista - Canción de prueba"
+    assert song["local_path"] == os.path.join(library.root, TRACKS[0])
+    assert library.search("queen bohemian rhapsody")["title"] == "Queen - Bohemian Rhapsody"
+    assert library.search("rhap") is None
+    assert library.search("de") is None
+    assert library.search("") is None
+
+
+def test_relevant_requires_title_coverage(main):
+    relevant = main.MediaLibrary.relevant
+    assert relevant(["bohemian", "rhapsody"], "Bohemian Rhapsody", "Queen", None)
+    assert relevant(["queen", "bohemian"], "Bohemian Rhapsody", "Queen", None)
+    assert not relevant(["queen"], "Bohemian Rhapsody", "Queen", None)
+    assert not relevant(["de"], "Canción de prueba", "Artista", None)
+    assert not relevant(["bohemian", "rapsodia"], "Bohemian Rhapsody", "Queen", None)
+    assert relevant(["cancion", "prueba"], "Canción de prueba", None, None)
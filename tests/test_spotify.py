@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import spotify_stub  # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    spotify_stub.calls.clear()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), spotify_stub.Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def resolver(main, stub, monkeypatch):
+    monkeypatch.setattr(main, "SPOTIFY_CLIENT_ID", "stub")
+    monkeypatch.setattr(main, "SPOTIFY_CLIENT_SECRET", "stub")
+    monkeypatch.setattr(main, "SPOTIFY_API_URL", f"{stub}/v1/")
+    monkeypatch.setattr(main, "SPOTIFY_TOKEN_URL", f"{stub}/api/token")
+
+    searches = []
+
+    async def fake_audio_source(query, gated=False):
+        # Sin red: una búsqueda devuelve un video determinista; un link se devuelve tal cual
+        if query.startswith("https://www.youtube.com/watch?v="):
+            url = query
+        else:
+            searches.append(query)
+            video_id = hashlib.sha256(query.encode()).hexdigest()[:11]
+            url = f"https://www.youtube.com/watch?v={video_id}"
+        return {"title": query, "url": url, "webpage_url": url, "duration": 0}
+
+    monkeypatch.setattr(main.MusicPlayer, "get_audio_source", staticmethod(fake_audio_source))
+    resolver = main.SpotifyResolver()
+    resolver.searches = searches
+    return resolver
+
+
+def run(main, coro):
+    async def wrapper():
+        main.bot.loop = asyncio.get_running_loop()
+        return await coro
+    return asyncio.run(wrapper())
+
+
+def track_calls():
+    return {name: count for name, count in spotify_stub.calls.items() if name.startswith("tracks x")}
+
+
+def test_metadata_is_batched_and_token_reused(main, resolver):
+    track_ids = [spotify_stub.child_id("lote", i) for i in range(60)]
+
+    async def resolve_all():
+        return await asyncio.gather(*(resolver.resolve(track_id) for track_id in track_ids))
+
+    songs = run(main, resolve_all())
+    assert all(songs)
+    calls = track_calls()
+    assert sum(calls.values()) == 2
+    assert all(int(name.split("x")[1]) <= main.SPOTIFY_BATCH_SIZE for name in calls)
+    assert spotify_stub.calls["token"] == 1
+    assert len(resolver.searches) == 60
+
+
+def test_album_expansion_uses_one_metadata_call(main, resolver):
+    album = f"https://open.spotify.com/album/{spotify_stub.child_id('album', 0)}"
+    track_ids = run(main, resolver.expand(album))
+    assert len(track_ids) == main.SPOTIFY_MAX_TRACKS
+    assert track_calls() == {f"tracks x{main.SPOTIFY_MAX_TRACKS}": 1}
+
+
+def test_second_resolve_hits_spotify_map(main, resolver):
+    track_id = spotify_stub.child_id("mapa", 0)
+    first = run(main, resolver.resolve(track_id))
+    calls_before = dict(spotify_stub.calls)
+
+    fresh = main.SpotifyResolver()  # Sin metadatos en memoria: sólo queda spotify_map
+    second = run(main, fresh.resolve(track_id))
+    assert second["webpage_url"] == first["webpage_url"]
+    assert dict(spotify_stub.calls) == calls_before
+    assert len(resolver.searches) == 1
+    assert fresh.map_hits == 1